@@ -27,7 +27,9 @@
 '''
 
 import time, platform
+from collections import OrderedDict
 from serial import Serial
+from access1581.bitstream import TrackDecompressor, BitBuffer, decompressMap, compressBitstream
 
 class ArduinoFloppyControlInterface:
     '''
@@ -43,16 +45,25 @@ class ArduinoFloppyControlInterface:
         self.serialDevice = serialDevice
         self.trackRange = diskFormat.trackRange
         self.hexZeroByte = bytes(chr(0),'utf-8')
-        self.decompressMap = { 0: "", 1: "01", 2: "001", 3: "0001"}
+        self.decompressMap = decompressMap
+        self.decompressor = TrackDecompressor(self.decompressMap)
         self.connectionEstablished = False
         self.ignoreIndexPulse = False # more conservative and slower but works
         self.isRunning = False
+        self.motorMode = None
+        self.commandQueue = []
+        self.serialWrites = 0
+        self.commandsSent = 0
         self.serial = False
         self.currentTrack = 100 #invalid value on purpose
         self.currentHead = 2 #invalid value on purpose
         self.total_duration_trackread = 0
         self.total_duration_cmds = 0
         self.total_duration_decompress = 0
+        self.compressedTrackData = b''
+        #duration and size of the most recent track read request
+        self.lastReadDuration = 0
+        self.lastReadBytes = 0
         self.cmd = {
             "version"        : ( b'?', "Detecting firmware version" ),
                 #returns firmware version, currently V1.3
@@ -77,11 +88,16 @@ class ArduinoFloppyControlInterface:
         }
 
     def __del__(self):
+        self.closeSerialConnection()
+
+    def closeSerialConnection(self):
         if self.connectionEstablished is True:
-            self.sendCommand("rewind")
-            self.sendCommand("motor_off")
+            self.queueCommand("rewind")
+            self.queueCommand("motor_off")
+            self.flushCommands()
             self.isRunning = False
             self.serial.close()
+            self.connectionEstablished = False
 
     def setIgnoreIndexPulse(self, b ):
         self.ignoreIndexPulse = b
@@ -98,52 +114,84 @@ class ArduinoFloppyControlInterface:
         print ("Connection to microcontroller established via " + self.serialDevice )
         self.serial.reset_input_buffer()
         self.serial.rtscts = True
-        self.sendCommand("version")
-        self.sendCommand("rewind")
+        self.queueCommand("version")
+        self.queueCommand("rewind")
+        self.flushCommands()
         #print( self.serial.get_settings())
 
     def connectionIsUsable(self, cmd):
-        executeCMD = False
+        '''
+        keeps track of the motor state. a command that needs a running motor
+        gets motor_on_read queued in front of it
+        '''
         if cmd == "motor_off":
             self.isRunning = False
-            executeCMD = True
+            self.motorMode = None
         elif cmd == "motor_on_read" or cmd == "motor_on_write":
             self.isRunning = True
-            executeCMD = True
+            self.motorMode = cmd
         elif self.isRunning is False:
-            self.sendCommand("motor_on_read")
-            executeCMD = True
-        elif self.isRunning is True:
-            executeCMD=True
-        return executeCMD
+            self.queueCommand("motor_on_read")
+        return True
 
-    def sendCommand(self, cmdname, param=b''):
-        (cmd, label) = self.cmd[cmdname]
+    def queueCommand(self, cmdname, param=b''):
+        '''
+        adds a command to the queue that is sent with the next flushCommands.
+        switching the motor on in the mode it is already running in is
+        skipped, the firmware would switch it off and on again
+        '''
+        if cmdname == self.motorMode:
+            return
+        if cmdname == "version" or self.connectionIsUsable(cmdname) is True:
+            self.commandQueue.append( (cmdname, param) )
+            if cmdname == "rewind":
+                self.currentTrack = 0
+        else:
+            raise Exception ( self.cmd[cmdname][1] + ": Connection was not usable!")
+
+    def flushCommands(self, trailer=b''):
+        '''
+        writes all queued commands with a single serial write and reads
+        their replies one after the other. trailer is appended to the same
+        write, it is meant for a read command whose reply is handled by the
+        caller after the replies of the queued commands
+        '''
+        queue = self.commandQueue
+        self.commandQueue = []
+        if len(queue) == 0 and trailer == b'':
+            return
         if self.connectionEstablished is False:
             self.openSerialConnection()
-        if cmdname == "version" or self.connectionIsUsable(cmdname) is True:
-            starttime_serialcmd = time.time()
-            #print ("...Processing cmd '" + cmdname+ "'")
-            self.serial.reset_input_buffer()
-            self.serial.reset_output_buffer()
-            self.serial.write( cmd + param)
+        starttime_serialcmd = time.time()
+        self.serial.write( b''.join( self.cmd[cmdname][0] + param for (cmdname, param) in queue ) + trailer )
+        self.serialWrites += 1
+        self.commandsSent += len(queue)
+        for (cmdname, param) in queue:
             reply = self.serial.read(1)
             if cmdname == "version":
                 firmware = self.serial.read(4)
                 print ("Firmware version on Arduino: " + str(firmware))
-            duration_serialcmd = int((time.time() - starttime_serialcmd)*1000)/1000
-            self.total_duration_cmds += duration_serialcmd
-            if param != b'':
-                label2 = label + " " + str(param)
-            else:
-                label2 = label
             if not reply == b'1':
+                (cmd, label) = self.cmd[cmdname]
+                if param != b'':
+                    label = label + " " + str(param)
+                #the replies of the following commands can't be trusted
+                self.serial.reset_input_buffer()
+                self.currentTrack = 100
+                self.currentHead = 2
                 if cmdname == "motor_on_write":
-                    raise Exception ( label2 + ": Something went wrong! Disk is probably write protected!")
+                    raise Exception ( label + ": Something went wrong! Disk is probably write protected!")
                 else:
-                    raise Exception ( label2 + ": Something went wrong! Reply was " + str(reply))
-        else:
-            raise Exception ( label + ": Connection was not usable!")
+                    raise Exception ( label + ": Something went wrong! Reply was " + str(reply))
+        self.total_duration_cmds += int((time.time() - starttime_serialcmd)*1000)/1000
+
+    def sendCommand(self, cmdname, param=b''):
+        '''
+        sends a single command right away, together with everything that is
+        queued already
+        '''
+        self.queueCommand(cmdname, param)
+        self.flushCommands()
 
     def testCTS(self):
         print ("Starting CTS self test (diagnostics), please wait...")
@@ -161,20 +209,29 @@ class ArduinoFloppyControlInterface:
             #time.sleep(1)
         print ("CTS test was successful.")
 
-    def selectTrackAndHead(self, track, head):
+    def selectTrackAndHead(self, track, head, flush = True):
+        '''
+        queues the commands needed to move to track and head, nothing is
+        queued for a track or head that is already selected. with flush set
+        to False, the commands stay queued for the following read command
+        '''
+        if self.isRunning is False:
+            self.queueCommand("motor_on_read")
         if self.currentTrack != track:
             if not track in self.trackRange:
                 raise Exception("Error: Track is not in range")
             trs = str(track) if track > 9 else '0'+str(track)
             btrack = bytes( trs,'utf-8' )
-            self.sendCommand( "select_track", btrack )# Moving head to track
+            self.queueCommand( "select_track", btrack )# Moving head to track
             self.currentTrack = track
         if self.currentHead != head:
             if head >= 0 and head < 2:
-                self.sendCommand("head" + str(head))
+                self.queueCommand("head" + str(head))
                 self.currentHead = head
             else:
                 print ('ERROR: Head should be 0 or 1!')
+        if flush is True:
+            self.flushCommands()
 
     def handleWriteProtection(self):
         writingAllowed = self.serial.read(1)
@@ -211,7 +268,12 @@ class ArduinoFloppyControlInterface:
         Quote: "Write a track to disk from the UART - the data should be
         pre-MFM encoded raw track data where '1's are the pulses/phase
         reversals to trigger"
+        the bit cells are packed into bytes, most significant bit first, as
+        MFMTrackEncoder (see trackencoder) produces them. a string of '1' and
+        '0' characters is packed first
         '''
+        if isinstance(data, str):
+            data = BitBuffer.fromBitString(data).toBytes()
         datalen = len(data)
         if datalen > 65535:
             raise Exception ( "track data to write is far too long!")
@@ -220,128 +282,135 @@ class ArduinoFloppyControlInterface:
         self.sendCommand("write_track") #calls writeTrackFromUART in sketch
         if self.handleWriteProtection() is False:
             return
-        '''
-        chunksize = 2048
-        byteDataChunks = []
-        pointer = 0
-        startPortions = [ 32, 32, 32, 32]
-        for p in startPortions:
-            old = pointer
-            pointer += p
-            print(f"Appending from {old} to {old+p}")
-            byteDataChunks.append( data[ old: old + p ].encode() )
-        print(f"Pointer is at {pointer} of len {datalen}")
-        xran = range(0, int((datalen-pointer)/chunksize))
-        print(xran)
-        for i in xran:
-            offset = chunksize * i + pointer
-            chunk = data[offset:offset+chunksize ]
-            bytechunk = chunk.encode() #bytes( chunk, 'utf-8' )
-            print(f"Appending from {offset} to {offset+chunksize}")
-            byteDataChunks.append( bytechunk )
-        byteDataChunks.append( data[offset+chunksize:].encode())
-        '''
-        byteData = bytes( data,'utf-8' )
-        lenByteData = len(byteData)
-        #calculate low byte and high byte of datalen
-        datalen_hb = int(datalen / 255)
-        datalen_lb = datalen - (255 * datalen_hb)
-
-        print (f"Debug Datalengths: {datalen}, {datalen_hb}, {datalen_lb}, {lenByteData}")
-        #send data length high byte
-        self.serial.write( bytes( chr(datalen_hb),'utf-8' ))
-        #send data length low byte
-        self.serial.write( bytes( chr(datalen_lb),'utf-8' ))
-        #index pulse setting 1= WRITE FROM INDEX PULSE
-        self.serial.write( bytes( chr(1),'utf-8' ))
+        #data length high byte, low byte, 1 = write from index pulse
+        (datalen_hb, datalen_lb) = divmod(datalen, 256)
+        self.serial.write( bytes( (datalen_hb, datalen_lb, 1) ) )
         reply = self.serial.read(1)
-        #print ("Reply pulse setting :" + str(reply))
         if reply != b'!':
             raise Exception("Track write: We didn't get the '!' that we expected:" + str(reply))
-        numb = self.serial.write( byteData )
-        print(f"Bytes written via Serial: {numb}")
-        '''
-        count = 0
-        for c in byteDataChunks:
-            print (f"Portion {count}")
-            count +=1
-            #print (c)
-            numb = self.serial.write( c )
-            #while self.serial.cts is False:
-            #    print("Waiting...")
-            #print ("Continue...")
-            print(f"  Bytes written via Serial: {numb}")
-        '''
-
-        self.serial.flush()#???
+        self.serial.write(data)
+        self.serial.flush()
         reply = self.serial.read(1)
         if reply == b'X':
             raise Exception("Track write failed: Buffer underflow")
         elif reply != b'1':
             raise Exception("Track write failed " + str(reply))
-#        self.serial.rtscts = False
         self.serial.reset_input_buffer()
-        self.serial.reset_output_buffer()
-        print (f"Finished writing track {track} head {head}")
-        time.sleep(1)
+        print (f"Finished writing track {track} head {head} in {time.time() - starttime_trackwrite:.2f} seconds")
         #FIXME improve read/write motor switching
         self.sendCommand("motor_on_read")#in case we were in write mode
 
+    def getReadTrackCommand(self):
+        if self.ignoreIndexPulse is True:
+            return self.cmd["read_track_ignoring_index_pulse"][0]
+        return self.cmd["read_track_from_index_pulse"][0]
+
     def getCompressedTrackData(self, track, head):
-        self.selectTrackAndHead(track, head)
+        self.selectTrackAndHead(track, head, False)
         starttime_trackread = time.time()
-        if self.ignoreIndexPulse is True:
-            self.serial.write(self.cmd["read_track_ignoring_index_pulse"][0])
-        else:
-            self.serial.write(self.cmd["read_track_from_index_pulse"][0])
+        self.flushCommands(self.getReadTrackCommand())
+        trackbytes = self.readTrackBytes()
+        self.lastReadDuration = time.time() - starttime_trackread
+        self.lastReadBytes = len(trackbytes)
+        self.compressedTrackData = trackbytes
+        duration_trackread = int(self.lastReadDuration*1000)/1000
+        self.total_duration_trackread += duration_trackread
+#        print  ("    Track read duration:                            " + str(duration_trackread) + " seconds")
+        return trackbytes
+
+    def getCompressedRevolutions(self, track, head, revolutions):
+        '''
+        reads several consecutive revolutions of the current track with a
+        single serial write: the firmware only knows single revolution
+        reads, so all read commands are queued at once and the firmware
+        starts the next one at the following index pulse without waiting
+        for another command round trip. the replies are cut at their
+        terminating zero bytes.
+        '''
+        self.selectTrackAndHead(track, head, False)
+        starttime_trackread = time.time()
+        self.flushCommands(self.getReadTrackCommand() * revolutions)
+        revolutionData = [ self.readTrackBytes(True) for r in range(0, revolutions) ]
+        self.lastReadDuration = time.time() - starttime_trackread
+        self.lastReadBytes = sum( len(trackbytes) for trackbytes in revolutionData )
+        self.compressedTrackData = revolutionData[-1]
+        self.total_duration_trackread += int(self.lastReadDuration*1000)/1000
+        return revolutionData
+
+    def streamCompressedTrackData(self, track, head, consumer, chunkSize = 1024):
+        '''
+        reads a single revolution like getCompressedTrackData, but hands the
+        track data to consumer (a callable) in chunks of about chunkSize
+        bytes while they are still arriving, so the decoding can keep up
+        with the disk. returns the complete track data
+        '''
+        self.selectTrackAndHead(track, head, False)
+        starttime_trackread = time.time()
+        self.flushCommands(self.getReadTrackCommand())
+        chunks = []
+        chunk = b''
+        received = 0
+        while received < 12200:
+            #blocks for the first byte, then takes whatever has arrived
+            data = self.serial.read( max( 1, min(self.serial.in_waiting, 12200 - received) ) )
+            if len(data) == 0:
+                break
+            end = data.find(self.hexZeroByte)
+            if end != -1:
+                data = data[:end + 1]
+            chunk += data
+            received += len(data)
+            if end != -1:
+                break
+            if len(chunk) >= chunkSize:
+                consumer(chunk)
+                chunks.append(chunk)
+                chunk = b''
+        consumer(chunk)
+        chunks.append(chunk)
+        trackbytes = b''.join(chunks)
+        self.compressedTrackData = trackbytes
+        self.lastReadDuration = time.time() - starttime_trackread
+        self.lastReadBytes = len(trackbytes)
+        self.total_duration_trackread += int(self.lastReadDuration*1000)/1000
+        if len(trackbytes) < 10223:
+            print ("Track length suspicously short: " + str(len(trackbytes)) + " bytes")
+        return trackbytes
+
+    def readTrackBytes(self, untilTerminator = False):
+        '''
+        reads the reply to a single read track command. with untilTerminator
+        set, the reply is cut at its terminating zero byte on every platform,
+        which is needed when the replies of further read commands follow
+        right behind it
+        '''
         #speedup for Linux where pyserial seems to be very optimized
-        if platform.system() == "Linux":
+        if untilTerminator is True or platform.system() == "Linux":
             trackbytes = self.serial.read_until( self.hexZeroByte , 12200)
-            #workaround for problematic disks
-            tracklength = len(trackbytes)
-            if tracklength < 10223:
-                print ("Track length suspicously short: " + str(tracklength) + " bytes")
         else:
             self.serial.timeout = 1
             trackbytes = self.serial.read(10380)
             self.serial.timeout = 0
             trackbytes = trackbytes + self.serial.readline()
             self.serial.timeout = None
-        duration_trackread = int((time.time() - starttime_trackread)*1000)/1000
-        self.total_duration_trackread += duration_trackread
-#        print  ("    Track read duration:                            " + str(duration_trackread) + " seconds")
         tracklength = len(trackbytes)
         if tracklength < 10223:
             print ("Track length suspicously short: " + str(tracklength) + " bytes")
         return trackbytes
 
     def getDecompressedBitstream(self, track, head):
-        compressedBytes = self.getCompressedTrackData(track, head)
-        starttime_decompress = time.time()
-        decompressedBitstream = ""
-        #print( "Length of compressed bitstream: "+ str(len(compressedBitstream)) )
-        for byte in compressedBytes:
-            bits=bin(byte)[2:].zfill(8)
-            for chunk in range(0,4):
-                value=int(bits[chunk*2:chunk*2+2])&3
-                if value > 3:
-                    print ("ERROR decompressBitstream illegal value!")
-                decompressedBitstream += self.decompressMap[value]
+        return self.decompressTrackData( self.getCompressedTrackData(track, head) )
 
+    def decompressTrackData(self, compressedBytes):
+        starttime_decompress = time.time()
+        decompressedBitstream = self.decompressor.decompressToBitBuffer(compressedBytes)
         duration_decompress = int((time.time() - starttime_decompress)*1000)/1000
 #        print  ("    Decompress duration:                            " + str(duration_decompress) + " seconds")
         self.total_duration_decompress += duration_decompress
         return decompressedBitstream
-        '''
-        Looking for a way to performance-improve this method. Tried to
-        experiment with bitstring.Bits(), but that appears to be way slower than
-        the code used now. Will come back to this at some point in the future.
-        Example code:
-            self.decompressMap2 = { '0b00': '', '0b01': '01', '0b10': '001', '0b11': '0001'}
-            b = bitstring.Bits(bytes = compressedBytes)
-            for bits in b.cut(2):
-                decompressedBitstream += self.decompressMap2[str(bits)]
-        '''
+
+    def getLastCompressedTrackData(self):
+        return self.compressedTrackData
 
     def getStats(self):
         tdtr = str(int(self.total_duration_trackread*100)/100)
@@ -350,10 +419,19 @@ class ArduinoFloppyControlInterface:
         return (tdtr, tdtc, tdtd)
 
 class ArduinoSimulator(ArduinoFloppyControlInterface):
-
-    def __init__(self, diskFormat, rawTrackData):
+    '''
+    replays a recorded disk, either from a capture file (CaptureFileReader)
+    or from a dict of bitstreams of an old debug dump. tracks of a capture
+    file are only decompressed when they are requested, the most recently
+    used ones are kept in a small LRU cache.
+    '''
+    def __init__(self, diskFormat, rawTrackData, cacheSize = 4):
         super().__init__("bla", diskFormat)
         self.rawTrackData = rawTrackData
+        self.isCapture = not isinstance(rawTrackData, dict)
+        self.lastTrack = None
+        self.cacheSize = cacheSize
+        self.trackCache = OrderedDict()
 
     def __del__(self):
         pass
@@ -361,11 +439,115 @@ class ArduinoSimulator(ArduinoFloppyControlInterface):
     def openSerialConnection(self):
         pass
 
-    def connectionIsUsable(self, cmd):
-        return True
+    def closeSerialConnection(self):
+        if self.isCapture is True:
+            self.rawTrackData.close()
+
+    def flushCommands(self, trailer=b''):
+        #counts what would have been sent to the Arduino
+        if len(self.commandQueue) > 0 or trailer != b'':
+            self.serialWrites += 1
+        self.commandsSent += len(self.commandQueue)
+        self.commandQueue = []
+
+    def getCompressedTrackData(self, track, head):
+        self.selectTrackAndHead(track, head)
+        if self.isCapture is True:
+            trackbytes = self.getCacheEntry(track, head)[0]
+        else:
+            bitstream = self.rawTrackData[track][head]
+            if isinstance(bitstream, BitBuffer):
+                bitstream = bitstream.toBitString()
+            trackbytes = compressBitstream(bitstream)
+        self.lastTrack = (track, head)
+        self.lastReadDuration = 0
+        self.lastReadBytes = len(trackbytes)
+        self.compressedTrackData = trackbytes
+        return trackbytes
+
+    def getCacheEntry(self, track, head):
+        '''
+        the LRU cache holds [compressed track data, bitstream] of the tracks
+        of the capture file read last, the bitstream is None until the track
+        is decompressed
+        '''
+        key = (track, head)
+        if key in self.trackCache:
+            self.trackCache.move_to_end(key)
+            return self.trackCache[key]
+        entry = [ self.rawTrackData.getCompressedTrackData(track, head), None ]
+        if self.cacheSize > 0:
+            self.trackCache[key] = entry
+            if len(self.trackCache) > self.cacheSize:
+                self.trackCache.popitem(last=False)
+        return entry
+
+    def decompressTrackData(self, compressedBytes):
+        '''
+        the track read last is not decompressed again, its bitstream comes
+        from the cache or from the old dump
+        '''
+        if self.lastTrack is not None and compressedBytes is self.compressedTrackData:
+            if self.isCapture is False:
+                return self.getDumpBitstream(*self.lastTrack)
+            entry = self.trackCache.get(self.lastTrack)
+            if entry is not None and entry[0] is compressedBytes:
+                if entry[1] is None:
+                    entry[1] = super().decompressTrackData(compressedBytes)
+                return entry[1]
+        return super().decompressTrackData(compressedBytes)
+
+    def getCompressedRevolutions(self, track, head, revolutions):
+        '''
+        replays all reads of the track stored in the capture file one after
+        the other as consecutive revolutions
+        '''
+        self.selectTrackAndHead(track, head)
+        if self.isCapture is True:
+            reads = self.rawTrackData.getCompressedTrackReads(track, head)
+        else:
+            reads = [ self.getCompressedTrackData(track, head) ]
+        revolutionData = [ reads[r % len(reads)] for r in range(0, revolutions) ]
+        self.lastTrack = (track, head)
+        self.lastReadDuration = 0
+        self.lastReadBytes = sum( len(trackbytes) for trackbytes in revolutionData )
+        self.compressedTrackData = revolutionData[-1]
+        return revolutionData
+
+    def streamCompressedTrackData(self, track, head, consumer, chunkSize = 1024):
+        '''
+        hands the recorded track to consumer in chunks as a serial
+        connection would
+        '''
+        trackbytes = self.getCompressedTrackData(track, head)
+        for start in range(0, len(trackbytes), chunkSize):
+            consumer( trackbytes[start : start + chunkSize] )
+        return trackbytes
+
+    def getDumpBitstream(self, track, head):
+        bitstream = self.rawTrackData[track][head]
+        if not isinstance(bitstream, BitBuffer):
+            #stored debug images contain strings of '0' and '1' characters
+            bitstream = BitBuffer.fromBitString(bitstream)
+            self.rawTrackData[track][head] = bitstream
+        return bitstream
 
     def getDecompressedBitstream(self, track, head):
-        return self.rawTrackData[track][head]
+        if self.isCapture is True:
+            return super().getDecompressedBitstream(track, head)
+        self.selectTrackAndHead(track, head)
+        self.lastTrack = (track, head)
+        #old dumps hold no compressed data
+        self.compressedTrackData = None
+        self.lastReadDuration = 0
+        self.lastReadBytes = 0
+        return self.getDumpBitstream(track, head)
+
+    def getLastCompressedTrackData(self):
+        if self.isCapture is True:
+            return super().getLastCompressedTrackData()
+        #old debug dumps only contain bitstreams, compress on demand
+        return self.getCompressedTrackData(*self.lastTrack)
 
 if __name__ == '__main__':
     main()
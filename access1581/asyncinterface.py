@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    asyncio front-end for the Arduino floppy controller. the command set and
+    the bookkeeping of motor, track and head state are the ones of
+    ArduinoFloppyControlInterface, only the serial I/O is replaced by a
+    transport that is driven by the event loop. one event loop can drive
+    several Arduinos this way without a thread per drive.
+
+'''
+
+import abc
+import asyncio
+import os
+import time
+from access1581.arduinointerface import ArduinoFloppyControlInterface
+
+class AsyncSerialTransport(abc.ABC):
+    '''
+    base class of the transports. a transport collects the incoming data in
+    buffer, read and readUntil take the replies of the Arduino from there.
+    subclasses implement open, write and waitForData
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+
+    @abc.abstractmethod
+    async def open(self):
+        '''
+        opens the connection, called from within the running event loop
+        '''
+
+    @abc.abstractmethod
+    async def write(self, data):
+        '''
+        returns once all of data was handed to the connection
+        '''
+
+    @abc.abstractmethod
+    async def waitForData(self):
+        '''
+        returns once more data was added to buffer, raises an exception if
+        the connection was closed
+        '''
+
+    async def read(self, count):
+        while len(self.buffer) < count:
+            await self.waitForData()
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+    async def readUntil(self, terminator, maxBytes):
+        '''
+        returns everything up to and including terminator, but not more than
+        maxBytes
+        '''
+        start = 0
+        while True:
+            position = self.buffer.find(terminator, start, maxBytes)
+            if position >= 0:
+                return await self.read(position + len(terminator))
+            if len(self.buffer) >= maxBytes:
+                return await self.read(maxBytes)
+            start = max(0, len(self.buffer) - len(terminator) + 1)
+            await self.waitForData()
+
+    def resetInput(self):
+        self.buffer.clear()
+
+    def close(self):
+        pass
+
+class FdTransport(AsyncSerialTransport):
+    '''
+    non blocking I/O on a file descriptor, incoming data is collected by a
+    reader callback registered with loop.add_reader. a serial device is
+    opened and configured with pyserial first, an already opened file
+    descriptor (a pty or a socket) is used as it is
+    '''
+    def __init__(self, serialDevice = None, fd = None, baudrate = 2000000):
+        super().__init__()
+        if serialDevice is None and fd is None:
+            raise Exception("FdTransport needs a serial device or a file descriptor")
+        self.serialDevice = serialDevice
+        self.fd = fd
+        self.baudrate = baudrate
+        self.serial = None
+        self.loop = None
+        self.dataAvailable = None
+        self.isClosed = False
+
+    def __str__(self):
+        return self.serialDevice if self.serialDevice is not None else "fd " + str(self.fd)
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        if self.fd is None:
+            from serial import Serial
+            self.serial = Serial(self.serialDevice, self.baudrate, timeout=0, exclusive=True)
+            self.serial.reset_input_buffer()
+            self.serial.rtscts = True
+            self.fd = self.serial.fileno()
+        os.set_blocking(self.fd, False)
+        self.dataAvailable = asyncio.Event()
+        self.loop.add_reader(self.fd, self.onReadable)
+
+    def onReadable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if data == b'':
+            #the other side is gone, wake up all readers
+            self.isClosed = True
+            self.loop.remove_reader(self.fd)
+        self.buffer.extend(data)
+        self.dataAvailable.set()
+
+    async def waitForData(self):
+        if self.isClosed is True:
+            raise Exception("Serial connection " + str(self) + " was closed")
+        self.dataAvailable.clear()
+        await self.dataAvailable.wait()
+
+    async def waitWritable(self):
+        writable = self.loop.create_future()
+        self.loop.add_writer(self.fd, writable.set_result, None)
+        try:
+            await writable
+        finally:
+            self.loop.remove_writer(self.fd)
+
+    async def write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                await self.waitWritable()
+
+    def close(self):
+        if self.loop is not None and self.isClosed is False:
+            self.loop.remove_reader(self.fd)
+        self.isClosed = True
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+class PySerialAsyncioTransport(AsyncSerialTransport):
+    '''
+    transport based on the optional package pyserial-asyncio
+    '''
+    def __init__(self, serialDevice, baudrate = 2000000):
+        super().__init__()
+        self.serialDevice = serialDevice
+        self.baudrate = baudrate
+        self.reader = None
+        self.writer = None
+
+    def __str__(self):
+        return self.serialDevice
+
+    async def open(self):
+        try:
+            import serial_asyncio
+        except ImportError:
+            raise Exception("pyserial-asyncio is not installed, use FdTransport instead")
+        (self.reader, self.writer) = await serial_asyncio.open_serial_connection(
+            url=self.serialDevice,
+            baudrate=self.baudrate,
+            rtscts=True
+        )
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def waitForData(self):
+        data = await self.reader.read(65536)
+        if data == b'':
+            raise Exception("Serial connection " + str(self) + " was closed")
+        self.buffer.extend(data)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class AsyncArduinoFloppyController(ArduinoFloppyControlInterface):
+    '''
+    Arduino floppy controller with coroutines instead of blocking calls:
+        await controller.open()
+        trackbytes = await controller.readTrack(track, head)
+        await controller.close()
+    the commands of one controller are serialized by a lock, different
+    controllers run concurrently. status and tracksRead can be polled to
+    report the progress of each drive. the blocking methods inherited from
+    ArduinoFloppyControlInterface must not be used.
+    '''
+    def __init__(self, transport, diskFormat):
+        super().__init__(str(transport), diskFormat)
+        self.transport = transport
+        self.lock = asyncio.Lock()
+        self.status = "closed"
+        self.tracksRead = 0
+        self.tracksWritten = 0
+
+    def __del__(self):
+        #the connection is shut down by close()
+        pass
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        await self.close()
+
+    def openSerialConnection(self):
+        raise Exception("AsyncArduinoFloppyController is opened with 'await open()'")
+
+    def flushCommands(self, trailer=b''):
+        raise Exception("AsyncArduinoFloppyController sends its commands with 'await sendQueuedCommands()'")
+
+    async def open(self):
+        await self.transport.open()
+        self.connectionEstablished = True
+        print ("Connection to microcontroller established via " + self.serialDevice )
+        async with self.lock:
+            self.queueCommand("version")
+            self.queueCommand("rewind")
+            await self.sendQueuedCommands()
+            self.status = "idle"
+
+    async def close(self):
+        if self.connectionEstablished is False:
+            return
+        async with self.lock:
+            self.queueCommand("rewind")
+            self.queueCommand("motor_off")
+            await self.sendQueuedCommands()
+            self.transport.close()
+            self.connectionEstablished = False
+            self.status = "closed"
+
+    async def sendQueuedCommands(self, trailer=b''):
+        '''
+        counterpart of flushCommands: all queued commands and trailer go out
+        with a single write, then the replies of the queued commands are read
+        '''
+        queue = self.commandQueue
+        self.commandQueue = []
+        if len(queue) == 0 and trailer == b'':
+            return
+        starttime_serialcmd = time.time()
+        await self.transport.write( b''.join( self.cmd[cmdname][0] + param for (cmdname, param) in queue ) + trailer )
+        self.serialWrites += 1
+        self.commandsSent += len(queue)
+        for (cmdname, param) in queue:
+            reply = await self.transport.read(1)
+            if cmdname == "version":
+                firmware = await self.transport.read(4)
+                print ("Firmware version on Arduino " + self.serialDevice + ": " + str(firmware))
+            if not reply == b'1':
+                (cmd, label) = self.cmd[cmdname]
+                if param != b'':
+                    label = label + " " + str(param)
+                self.transport.resetInput()
+                self.currentTrack = 100
+                self.currentHead = 2
+                if cmdname == "motor_on_write":
+                    raise Exception ( label + ": Something went wrong! Disk is probably write protected!")
+                else:
+                    raise Exception ( label + ": Something went wrong! Reply was " + str(reply))
+        self.total_duration_cmds += int((time.time() - starttime_serialcmd)*1000)/1000
+
+    async def runCommand(self, cmdname, param=b''):
+        async with self.lock:
+            self.queueCommand(cmdname, param)
+            await self.sendQueuedCommands()
+
+    async def readTrack(self, track, head, revolutions = 1):
+        '''
+        returns the compressed track data of one revolution, or a list of
+        them if more than one revolution is requested
+        '''
+        async with self.lock:
+            self.status = "reading track " + str(track) + " head " + str(head)
+            self.selectTrackAndHead(track, head, False)
+            starttime_trackread = time.time()
+            await self.sendQueuedCommands(self.getReadTrackCommand() * revolutions)
+            revolutionData = [ await self.readTrackBytes() for r in range(0, revolutions) ]
+            self.total_duration_trackread += int((time.time() - starttime_trackread)*1000)/1000
+            self.compressedTrackData = revolutionData[-1]
+            self.tracksRead += 1
+            self.status = "idle"
+        return revolutionData[0] if revolutions == 1 else revolutionData
+
+    async def readTrackBytes(self):
+        trackbytes = await self.transport.readUntil(self.hexZeroByte, 12200)
+        if len(trackbytes) < 10223:
+            print ("Track length suspicously short: " + str(len(trackbytes)) + " bytes")
+        return trackbytes
+
+    async def readDecompressedTrack(self, track, head):
+        '''
+        like readTrack, the decompression runs in the default executor of
+        the event loop so that the other drives are not held up
+        '''
+        compressedBytes = await self.readTrack(track, head)
+        starttime_decompress = time.time()
+        bitstream = await asyncio.get_running_loop().run_in_executor(None, self.decompressor.decompressToBitBuffer, compressedBytes)
+        self.total_duration_decompress += int((time.time() - starttime_decompress)*1000)/1000
+        return bitstream
+
+    async def expectReply(self, expected, label):
+        reply = await self.transport.read(1)
+        if reply != expected:
+            raise Exception(label + ": Reply was " + str(reply) + " instead of " + str(expected))
+
+    async def writeTrack(self, track, head, data, fromIndexPulse = True):
+        '''
+        erases the track and writes data, the pre-MFM encoded raw track data
+        as bytes (see writeTrackData)
+        '''
+        if len(data) > 65535:
+            raise Exception ( "track data to write is far too long!")
+        async with self.lock:
+            self.status = "writing track " + str(track) + " head " + str(head)
+            self.queueCommand("motor_on_write")
+            self.selectTrackAndHead(track, head, False)
+            self.queueCommand("erase_track")
+            await self.sendQueuedCommands()
+            await self.expectReply(b'Y', "Erasing track: Disk is probably write protected")
+            await self.expectReply(b'1', "Erasing track")
+            self.queueCommand("write_track")
+            await self.sendQueuedCommands()
+            await self.expectReply(b'Y', "Writing track: Disk is probably write protected")
+            (datalen_hb, datalen_lb) = divmod(len(data), 256)
+            await self.transport.write( bytes( (datalen_hb, datalen_lb, 1 if fromIndexPulse is True else 0) ) )
+            await self.expectReply(b'!', "Writing track")
+            await self.transport.write(data)
+            reply = await self.transport.read(1)
+            if reply == b'X':
+                raise Exception("Track write failed: Buffer underflow")
+            elif reply != b'1':
+                raise Exception("Track write failed " + str(reply))
+            self.queueCommand("motor_on_read")
+            await self.sendQueuedCommands()
+            self.tracksWritten += 1
+            self.status = "idle"
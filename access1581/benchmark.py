@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import contextlib
+import io
+import json
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+from access1581.capturefile import CaptureFileReader, isCaptureFile, loadRawTracks
+from access1581.bitstream import *
+from access1581.diskformats import *
+from access1581.imagefile import ImageFileWriter
+from access1581.imager import SingleIBMTrackSectorParser, SingleTrackSectorListValidator
+
+try:
+    import resource
+except ImportError:
+    #not available on Windows
+    resource = None
+
+def legacyDecompress(compressedBytes):
+    '''
+    the original per byte decompression loop of
+    ArduinoFloppyControlInterface.getDecompressedBitstream, kept as reference
+    '''
+    decompressedBitstream = ""
+    for byte in compressedBytes:
+        bits=bin(byte)[2:].zfill(8)
+        for chunk in range(0,4):
+            value=int(bits[chunk*2:chunk*2+2])&3
+            decompressedBitstream += decompressMap[value]
+    return decompressedBitstream
+
+def legacyGetMarkers(bitstream, diskFormat):
+    '''
+    the original regex based marker search of
+    SingleIBMTrackSectorParser.getMarkers working on '0'/'1' strings,
+    kept as reference
+    '''
+    sectorMarkers = []
+    dataMarkers = []
+    dataMarkersTmp = []
+    sectorDataBitSize = diskFormat.sectorSize * 16
+    rawSectors = re.split( diskFormat.sectorStartMarker, bitstream)
+    del rawSectors[-1]
+    previousBits = 0
+    for rawSector in rawSectors:
+        previousBits += len( rawSector ) + len(diskFormat.sectorStartMarker)
+        sectorMarkers.append( previousBits )
+    if len(sectorMarkers) > 0:
+        for dataMarker in re.finditer( diskFormat.sectorDataStartMarker, bitstream):
+            endPosDataMarker = dataMarker.span()[1]
+            if endPosDataMarker >= sectorMarkers[0] + diskFormat.legalOffsetRangeLowerBorder:
+                dataMarkersTmp.append(endPosDataMarker)
+        cnt = 0
+        for dataMarker in dataMarkersTmp:
+            if dataMarker + sectorDataBitSize + 32 <= len( bitstream ):
+                dataMarkers.append( dataMarker )
+                cnt+=1
+            else:
+                sectorMarkers.remove(sectorMarkers[cnt])
+    return list(zip(sectorMarkers, dataMarkers))
+
+class DecompressionBenchmark:
+    '''
+    compares the decompression engines on the tracks of a stored dump. the
+    bitstreams of the dump are compressed again first, so every engine gets
+    the same input the Arduino would deliver.
+    '''
+    def __init__(self, rawTracks, rounds = 3):
+        self.rounds = rounds
+        self.bitstreams = []
+        for trackno in sorted(rawTracks):
+            for headno in sorted(rawTracks[trackno]):
+                self.bitstreams.append( rawTracks[trackno][headno] )
+        self.compressedTracks = [ compressBitstream(b) for b in self.bitstreams ]
+        self.decompressor = TrackDecompressor()
+
+    def measure(self, label, func, convert = None):
+        best = None
+        for r in range(0, self.rounds):
+            starttime = time.time()
+            result = func()
+            duration = time.time() - starttime
+            best = duration if best is None or duration < best else best
+        if convert is not None:
+            result = [ convert(r) for r in result ]
+        if result != self.bitstreams:
+            raise Exception( label + ": decompressed bitstreams differ from the original ones!")
+        print ( f"{label:28s}: {best:8.3f} seconds for {len(self.compressedTracks)} tracks, {best/len(self.compressedTracks)*1000:7.3f} ms per track")
+        return best
+
+    def run(self, skipLegacy = False):
+        results = {}
+        if skipLegacy is False:
+            results["legacy"] = self.measure( "Legacy loop", lambda: [ legacyDecompress(t) for t in self.compressedTracks ] )
+        results["table"] = self.measure( "Lookup table", lambda: [ self.decompressor.decompress(t) for t in self.compressedTracks ] )
+        results["packed"] = self.measure( "Lookup table to BitBuffer", lambda: [ self.decompressor.decompressToBitBuffer(t) for t in self.compressedTracks ], BitBuffer.toBitString )
+        if numpy is not None:
+            results["numpy"] = self.measure( "NumPy per track", lambda: [ self.decompressor.decompressNumpy(t) for t in self.compressedTracks ] )
+            batchDecompressor = TrackDecompressor(useNumpy = True)
+            results["numpy_batch"] = self.measure( "NumPy batch", lambda: batchDecompressor.decompressBatch( self.compressedTracks ) )
+        else:
+            print ("NumPy is not installed, skipping NumPy decompression")
+        if "legacy" in results:
+            for engine in results:
+                print ( f"Speedup of {engine:12s}: {results['legacy']/results[engine]:8.1f}x" )
+        return results
+
+class MarkerScanBenchmark:
+    '''
+    compares the regex based marker search on '0'/'1' strings with the
+    single pass address mark scanner working on BitBuffers
+    '''
+    def __init__(self, rawTracks, diskFormat, rounds = 3):
+        self.rounds = rounds
+        self.diskFormat = diskFormat
+        self.bitstreams = []
+        for trackno in sorted(rawTracks):
+            for headno in sorted(rawTracks[trackno]):
+                self.bitstreams.append( rawTracks[trackno][headno] )
+        self.bitBuffers = [ BitBuffer.fromBitString(b) for b in self.bitstreams ]
+        self.parser = SingleIBMTrackSectorParser(diskFormat, None)
+
+    def scan(self, bitBuffer):
+        self.parser.decompressedBitstream = bitBuffer
+        self.parser.firstSectorOffset = -1
+        return self.parser.getMarkers()
+
+    def measure(self, label, func):
+        best = None
+        for r in range(0, self.rounds):
+            starttime = time.time()
+            result = func()
+            duration = time.time() - starttime
+            best = duration if best is None or duration < best else best
+        print ( f"{label:28s}: {best:8.3f} seconds for {len(self.bitstreams)} tracks, {best/len(self.bitstreams)*1000:7.3f} ms per track")
+        return (best, result)
+
+    def run(self):
+        (legacyDuration, legacyResult) = self.measure( "Regex split/finditer", lambda: [ legacyGetMarkers(b, self.diskFormat) for b in self.bitstreams ] )
+        (scanDuration, scanResult) = self.measure( "Single pass scanner", lambda: [ self.scan(b) for b in self.bitBuffers ] )
+        if scanResult != legacyResult:
+            raise Exception("Single pass scanner found other markers than the regex search!")
+        print ( f"Speedup of the scanner     : {legacyDuration/scanDuration:8.1f}x" )
+        return { "legacy": legacyDuration, "scanner": scanDuration }
+
+def loadCompressedTracks(path, diskFormat):
+    '''
+    returns a list of (trackno, headno, compressed track data) with logical
+    head numbers from a capture file or an old bitstream dump
+    '''
+    if isCaptureFile(path):
+        with CaptureFileReader(path) as capture:
+            return [
+                (trackno, diskFormat.getPhysicalHead(headno), capture.getCompressedTrackData(trackno, headno))
+                for (trackno, headno) in sorted(capture.index)
+            ]
+    rawTracks = loadRawTracks(path)
+    return [
+        (trackno, headno, compressBitstream(rawTracks[trackno][headno]))
+        for trackno in sorted(rawTracks) for headno in sorted(rawTracks[trackno])
+    ]
+
+class ReadPathBenchmark:
+    '''
+    times every stage of the read path on its own, each stage gets the
+    results of the previous one as input:
+        decompress  compressed track data to BitBuffer
+        markers     address mark search
+        parse       cutting the sectors out of the bitstream
+        mfm         MFM decoding of sector headers and data
+        crc         crc validation of headers and data
+        assemble    joining the sectors of each track and writing the image
+                    file with its hashes
+    the numbers of several captures (one image each) are added up. results
+    are kept as seconds per track, so that they can be compared with a
+    baseline recorded on other captures.
+    '''
+    stages = ("decompress", "markers", "parse", "mfm", "crc", "assemble")
+
+    def __init__(self, captures, diskFormat, rounds = 3):
+        self.captures = captures
+        self.diskFormat = diskFormat
+        self.rounds = rounds
+        self.trackCount = sum( len(tracks) for tracks in captures )
+        self.trackLength = diskFormat.expectedSectorsPerTrack * diskFormat.sectorSize
+        self.decompressor = TrackDecompressor()
+        self.parser = SingleIBMTrackSectorParser(diskFormat, None)
+        self.validator = SingleTrackSectorListValidator(1, diskFormat, None)
+
+    def decompress(self, tracks):
+        return [ self.decompressor.decompressToBitBuffer(compressedTrackData) for (t, h, compressedTrackData) in tracks ]
+
+    def findMarkers(self, bitBuffers):
+        markers = []
+        for bitBuffer in bitBuffers:
+            self.parser.decompressedBitstream = bitBuffer
+            self.parser.firstSectorOffset = -1
+            markers.append( self.parser.getMarkers() )
+        return markers
+
+    def cutSectors(self, bitBuffers, markers):
+        cuts = []
+        for (bitBuffer, trackMarkers) in zip(bitBuffers, markers):
+            self.parser.decompressedBitstream = bitBuffer
+            cuts.append( [ self.parser.cutSector(sectorStart, dataMarker) for (sectorStart, dataMarker) in trackMarkers ] )
+        return cuts
+
+    def decodeSectors(self, cuts):
+        return [ [ self.parser.decodeSector(sectorBitstream, dataMarker) for (sectorBitstream, dataMarker) in trackCuts ] for trackCuts in cuts ]
+
+    def checkCRCs(self, sectors):
+        validSectors = []
+        for trackSectors in sectors:
+            bitmap = self.validator.checkSectorCRCs(trackSectors)
+            validSectors.append( [ sectorprops for (index, sectorprops) in enumerate(trackSectors) if bitmap >> index & 1 ] )
+        return validSectors
+
+    def assemble(self, tracks, validSectors, directory):
+        imageFile = None
+        for (capture, captureTracks) in enumerate(self.captures):
+            imageFile = ImageFileWriter( os.path.join(directory, "benchmark" + str(capture) + "." + self.diskFormat.imageExtension), self.diskFormat )
+            for (trackno, headno, compressedTrackData) in captureTracks:
+                self.validator.startTrack()
+                self.validator.validSectorData = { sectorprops["sectorno"]: sectorprops["data"] for sectorprops in next(validSectors) }
+                imageFile.writeTrack(trackno, headno, self.validator.assembleTrackData())
+            imageFile.close()
+
+    def runOnce(self, timings = None):
+        '''
+        runs all stages once, adding the duration of each stage to timings
+        '''
+        timings = timings if timings is not None else {}
+        tracks = [ track for captureTracks in self.captures for track in captureTracks ]
+        log = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(log):
+            results = {}
+            for stage in self.stages:
+                starttime = time.perf_counter()
+                if stage == "decompress":
+                    results[stage] = self.decompress(tracks)
+                elif stage == "markers":
+                    results[stage] = self.findMarkers(results["decompress"])
+                elif stage == "parse":
+                    results[stage] = self.cutSectors(results["decompress"], results["markers"])
+                elif stage == "mfm":
+                    results[stage] = self.decodeSectors(results["parse"])
+                elif stage == "crc":
+                    results[stage] = self.checkCRCs(results["mfm"])
+                elif stage == "assemble":
+                    self.assemble(tracks, iter(results["crc"]), directory)
+                timings.setdefault(stage, []).append( time.perf_counter() - starttime )
+        return timings
+
+    def measurePeakMemory(self):
+        '''
+        peak of the memory allocated by Python during one pass (tracemalloc)
+        and the peak resident set size of the process
+        '''
+        tracemalloc.start()
+        self.runOnce()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if resource is None:
+            return (peak, None)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #kilobytes on Linux, bytes on macOS
+        return (peak, maxrss * 1024 if os.uname().sysname == "Linux" else maxrss)
+
+    def run(self):
+        timings = {}
+        for r in range(0, self.rounds):
+            self.runOnce(timings)
+        results = { stage: min(timings[stage]) / self.trackCount for stage in self.stages }
+        results["total"] = sum( results[stage] for stage in self.stages )
+        megabytes = self.trackLength / 1000000
+        for stage in self.stages + ("total",):
+            perTrack = results[stage]
+            print ( f"{stage:28s}: {perTrack*1000:8.3f} ms per track, {1/perTrack:9.1f} tracks/s, {megabytes/perTrack:8.2f} MB/s" )
+        (tracedPeak, maxrss) = self.measurePeakMemory()
+        print ( f"Peak memory                 : {tracedPeak/1000000:8.1f} MB allocated by Python" + ( f", {maxrss/1000000:8.1f} MB resident" if maxrss is not None else "" ) )
+        results["peak_memory"] = tracedPeak
+        return results
+
+def compareWithBaseline(results, baseline, tolerance = 0.1):
+    '''
+    prints the change of every stage against the baseline, returns False if
+    a stage got slower by more than tolerance
+    '''
+    passed = True
+    for stage in ReadPathBenchmark.stages + ("total",):
+        if not stage in baseline:
+            continue
+        ratio = results[stage] / baseline[stage]
+        verdict = "REGRESSION" if ratio > 1 + tolerance else ""
+        passed = passed and verdict == ""
+        print ( f"{stage:28s}: {ratio:8.2f}x the baseline time {verdict}" )
+    return passed
+
+def main():
+    parser = OptionParser("usage: %prog [options] [dump|capturefile ...]")
+    parser.add_option("-i", "--input",
+        dest="input",
+        help="bitstream dump to replay, default is raw_debug_image_d81.zip",
+        default="raw_debug_image_d81.zip"
+    )
+    parser.add_option("-n", "--rounds", dest="rounds",
+        help="number of rounds per measurement, the best one is reported, default: 3",
+        default=3
+    )
+    parser.add_option("--skip-legacy", dest="skipLegacy", action="store_true",
+        help="do not measure the slow legacy decompression loop",
+        default=False
+    )
+    parser.add_option("-d", "--disktype", dest="disktype",
+        help="disk format of the dump: " + getDiskFormatNames(),
+        default=defaultDiskType
+    )
+    parser.add_option("--stages-only", dest="stagesOnly", action="store_true",
+        help="only time the stages of the read path, skip the comparisons with the legacy implementations",
+        default=False
+    )
+    parser.add_option("--save-baseline", dest="saveBaseline",
+        help="store the stage timings as baseline in this json file",
+        default=None
+    )
+    parser.add_option("--baseline", dest="baseline",
+        help="compare the stage timings with the baseline stored in this json file",
+        default=None
+    )
+    parser.add_option("--tolerance", dest="tolerance",
+        help="relative slowdown against the baseline that counts as regression, default: 0.1",
+        default=0.1
+    )
+    (options, args) = parser.parse_args()
+    diskFormat = getDiskFormat(options.disktype)
+    if options.stagesOnly is False:
+        rawTracks = loadRawTracks(options.input)
+        print ("Decompression:")
+        DecompressionBenchmark( rawTracks, int(options.rounds) ).run(options.skipLegacy)
+        print ("Marker search:")
+        MarkerScanBenchmark( rawTracks, diskFormat, int(options.rounds) ).run()
+    inputs = args if len(args) > 0 else [ options.input ]
+    print ("Read path stages (" + ", ".join(inputs) + "):")
+    results = ReadPathBenchmark( [ loadCompressedTracks(path, diskFormat) for path in inputs ], diskFormat, int(options.rounds) ).run()
+    if options.saveBaseline is not None:
+        with open(options.saveBaseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print ("Stored baseline in " + options.saveBaseline)
+    if options.baseline is not None:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+        print ("Comparison with baseline " + options.baseline + ":")
+        if compareWithBaseline(results, baseline, float(options.tolerance)) is False:
+            raise Exception("At least one stage of the read path is slower than the baseline")
+
+if __name__ == '__main__':
+    main()
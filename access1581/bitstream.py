@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the Arduino firmware sends four 2-bit flux interval codes per byte (most
+# significant bits first), each code stands for a short run of bit cells
+decompressMap = { 0: "", 1: "01", 2: "001", 3: "0001"}
+
+def buildDecompressTable(codeMap):
+    '''
+    expands every possible compressed byte value into its bit pattern once,
+    so that decompressing a track is a plain lookup per byte
+    '''
+    table = []
+    for byte in range(256):
+        table.append( "".join( codeMap[ (byte >> shift) & 3 ] for shift in (6, 4, 2, 0) ) )
+    return table
+
+#pack tables of the code maps, see buildPackTable
+packTables = {}
+
+def buildPackTable(codeMap):
+    '''
+    expands every pair of compressed bytes into the number of bits and their
+    value, indexed by the pair read as a native 16 bit word. the table is
+    built on first use and shared by all decompressors of the same code map
+    '''
+    key = tuple( sorted( codeMap.items() ) )
+    if key in packTables:
+        return packTables[key]
+    runs = [ ( len(bits), int(bits, 2) if bits != '' else 0 ) for bits in buildDecompressTable(codeMap) ]
+    table = [None] * 65536
+    for first in range(256):
+        (firstLength, firstValue) = runs[first]
+        for second in range(256):
+            (secondLength, secondValue) = runs[second]
+            table[ int.from_bytes( bytes( (first, second) ), sys.byteorder ) ] = ( firstLength + secondLength, (firstValue << secondLength) | secondValue )
+    packTables[key] = table
+    return table
+
+def padPendingBits(value, count):
+    '''
+    the last incomplete byte of packed bits, padded with zeros
+    '''
+    return (value << (8 - count)).to_bytes(1, 'big') if count > 0 else b''
+
+def compressBitstream(bitstream):
+    '''
+    inverse operation of the decompression: turns a bitstream consisting of
+    "01", "001" and "0001" runs back into the byte format of the firmware.
+    needed to replay stored bitstreams through the real decompression code
+    '''
+    zeroRuns = bitstream.split('1')
+    if zeroRuns.pop() != '':
+        raise Exception("Bitstream can't be compressed, it does not end with a '1'")
+    codes = list( map( len, zeroRuns ) )
+    if len(codes) > 0 and ( min(codes) < 1 or max(codes) > 3 ):
+        raise Exception("Bitstream can't be compressed, it contains illegal run lengths")
+    codes.extend( [0] * (-len(codes) % 4) )
+    quads = iter(codes)
+    return bytes( (a << 6) | (b << 4) | (c << 2) | d for a, b, c, d in zip(quads, quads, quads, quads) )
+
+def compressPattern(bitString):
+    '''
+    the interval codes of the flux reversals in bitString as a string of
+    2-bit codes, for searching the compressed track data without
+    decompressing it. the run up to the first '1' depends on the bits in
+    front of the pattern, the codes start with the run after it
+    '''
+    zeroRuns = bitString[ bitString.find('1') + 1 : bitString.rfind('1') ].split('1')
+    if min( map(len, zeroRuns) ) < 1 or max( map(len, zeroRuns) ) > 3:
+        raise Exception("Bit pattern can't be compressed, it contains illegal run lengths")
+    return "".join( format( len(zeroRun), '02b' ) for zeroRun in zeroRuns )
+
+class TrackDecompressor:
+    '''
+    decompression engine for the compressed track data of the Arduino. uses a
+    precomputed 256 entry lookup table of expanded bit patterns.
+    decompressToBitBuffer packs the bits straight from a table of byte pairs
+    without building a string of '0' and '1' characters first. if numpy is
+    installed and useNumpy is set, decompressBatch expands many tracks in one
+    vectorized go (the lookup table is usually faster for single tracks).
+    '''
+    def __init__(self, codeMap = decompressMap, useNumpy = False):
+        self.codeMap = codeMap
+        self.useNumpy = useNumpy and numpy is not None
+        self.table = buildDecompressTable(codeMap)
+        self.packTable = None
+        if numpy is not None:
+            self.runLengths = numpy.array( [ len(codeMap[c]) for c in range(4) ], dtype=numpy.int32 )
+
+    def decompress(self, compressedBytes):
+        return "".join( map( self.table.__getitem__, compressedBytes ) )
+
+    def packBits(self, compressedBytes, pendingValue = 0, pendingCount = 0):
+        '''
+        decompresses straight into packed bytes, two compressed bytes at a
+        time. the bits that don't fill a whole byte yet are returned as
+        pendingValue and pendingCount and can be handed in again together
+        with the following compressed bytes
+        '''
+        if self.packTable is None:
+            self.packTable = buildPackTable(self.codeMap)
+        if len(compressedBytes) & 1:
+            #code 0 is padding, a zero byte adds no bits
+            compressedBytes = bytes(compressedBytes) + b'\x00'
+        words = memoryview( bytes(compressedBytes) ).cast('H')
+        table = self.packTable
+        packed = bytearray()
+        value = pendingValue
+        count = pendingCount
+        #the value is flushed every 32 words to keep its shifts cheap
+        for start in range(0, len(words), 32):
+            for (length, bits) in map( table.__getitem__, words[start : start + 32] ):
+                value = (value << length) | bits
+                count += length
+            rest = count & 7
+            packed += (value >> rest).to_bytes(count >> 3, 'big')
+            value &= (1 << rest) - 1
+            count = rest
+        return (bytes(packed), value, count)
+
+    def decompressToBitBuffer(self, compressedBytes):
+        (packed, value, count) = self.packBits(compressedBytes)
+        return BitBuffer( packed + padPendingBits(value, count), 0, (len(packed) << 3) + count )
+
+    def decompressNumpy(self, compressedBytes):
+        return self.decompressNumpyBatch( [compressedBytes] )[0]
+
+    def decompressBatch(self, compressedTracks):
+        '''
+        decompresses a list of tracks. with numpy all tracks are expanded in
+        one vectorized pass and split up afterwards
+        '''
+        if self.useNumpy is False:
+            return [ self.decompress(t) for t in compressedTracks ]
+        return self.decompressNumpyBatch(compressedTracks)
+
+    def decompressNumpyBatch(self, compressedTracks):
+        '''
+        the vectorized expansion behind decompressBatch and decompressNumpy
+        '''
+        if numpy is None:
+            raise Exception("numpy is not installed")
+        joined = numpy.frombuffer( b''.join( bytes(t) for t in compressedTracks ), dtype=numpy.uint8 )
+        codes = numpy.stack( ( joined >> 6, joined >> 4, joined >> 2, joined ), axis=1 ).ravel() & 3
+        runEnds = numpy.cumsum( self.runLengths[ codes ], dtype=numpy.int32 )
+        bits = numpy.full( int(runEnds[-1]) if len(runEnds) else 0, 48, dtype=numpy.uint8 )
+        #every non-empty run ends with a '1'
+        bits[ runEnds[ codes != 0 ] - 1 ] = 49
+        text = bits.tobytes().decode('ascii')
+        result = []
+        start = 0
+        codeOffset = 0
+        for t in compressedTracks:
+            codeOffset += len(t) * 4
+            end = int(runEnds[codeOffset - 1]) if codeOffset > 0 else 0
+            result.append( text[start:end] )
+            start = end
+        return result
+
+class BitPattern:
+    '''
+    bit pattern prepared for searching inside of a BitBuffer. for each of the
+    eight possible bit alignments we keep the completely covered bytes of the
+    pattern as search key, so the search itself can be done with bytes.find
+    '''
+    def __init__(self, bitString):
+        if len(bitString) < 16:
+            raise Exception("Bit patterns need to be at least 16 bits long")
+        self.bitString = bitString
+        self.length = len(bitString)
+        self.value = int(bitString, 2)
+        self.keys = []
+        for shift in range(0, 8):
+            padded = '0' * shift + bitString
+            padded += '0' * (-len(padded) % 8)
+            raw = int(padded, 2).to_bytes(len(padded) >> 3, 'big')
+            first = 1 if shift > 0 else 0
+            last = len(raw) - (1 if (shift + self.length) % 8 > 0 else 0)
+            self.keys.append( (shift, first, raw[first:last]) )
+
+    def __len__(self):
+        return self.length
+
+class BitBuffer:
+    '''
+    compact bitstream: the bits are packed into bytes (most significant bit
+    first). slicing a BitBuffer doesn't copy any data, the slice just points
+    to another bit offset of the same bytes object.
+    '''
+    __slots__ = ('data', 'offset', 'length')
+
+    def __init__(self, data = b'', offset = 0, length = None):
+        self.data = data if isinstance(data, bytes) else bytes(data)
+        self.offset = offset
+        self.length = len(self.data) * 8 - offset if length is None else length
+
+    @classmethod
+    def fromBitString(cls, bitString):
+        '''
+        packs a string of '0' and '1' characters
+        '''
+        bitcount = len(bitString)
+        if bitcount == 0:
+            return cls(b'', 0, 0)
+        pad = -bitcount % 8
+        return cls( int(bitString + '0' * pad, 2).to_bytes((bitcount + pad) >> 3, 'big'), 0, bitcount )
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if not isinstance(other, BitBuffer):
+            return NotImplemented
+        return self.length == other.length and self.getBits(0, self.length) == other.getBits(0, other.length)
+
+    def __repr__(self):
+        return "BitBuffer(" + str(self.length) + " bits)"
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                raise ValueError("BitBuffer slices don't support steps")
+            return BitBuffer(self.data, self.offset + start, max(0, stop - start))
+        if key < 0:
+            key += self.length
+        if key < 0 or key >= self.length:
+            raise IndexError("BitBuffer index out of range")
+        pos = self.offset + key
+        return (self.data[pos >> 3] >> (7 - (pos & 7))) & 1
+
+    def getBits(self, start, count):
+        '''
+        returns count bits beginning at bit offset start as integer
+        '''
+        if count <= 0:
+            return 0
+        pos = self.offset + start
+        first = pos >> 3
+        last = (pos + count + 7) >> 3
+        value = int.from_bytes(self.data[first:last], 'big')
+        return (value >> ((last << 3) - pos - count)) & ((1 << count) - 1)
+
+    def toBytes(self, start = 0, count = None):
+        '''
+        copies bits into a byte aligned bytes object, an incomplete last byte
+        is padded with zeros
+        '''
+        if count is None or count > self.length - start:
+            count = max(0, self.length - start)
+        pos = self.offset + start
+        if pos & 7 == 0 and count & 7 == 0:
+            return self.data[pos >> 3 : (pos + count) >> 3]
+        pad = -count % 8
+        return (self.getBits(start, count) << pad).to_bytes((count + pad) >> 3, 'big')
+
+    def toBitString(self):
+        if self.length == 0:
+            return ''
+        return format(self.getBits(0, self.length), '0' + str(self.length) + 'b')
+
+    def finditer(self, pattern, start = 0, end = None):
+        '''
+        returns the bit offsets of all occurrences of pattern (a BitPattern or
+        a string of '0' and '1' characters) in ascending order
+        '''
+        if not isinstance(pattern, BitPattern):
+            pattern = BitPattern(pattern)
+        end = self.length if end is None else min(end, self.length)
+        low = self.offset + max(0, start)
+        high = self.offset + end
+        matches = []
+        for (shift, first, key) in pattern.keys:
+            hit = self.data.find(key, low >> 3, (high + 7) >> 3)
+            while hit != -1:
+                pos = ((hit - first) << 3) + shift
+                if pos >= low and pos + pattern.length <= high and \
+                    self.getBits(pos - self.offset, pattern.length) == pattern.value:
+                    matches.append(pos - self.offset)
+                hit = self.data.find(key, hit + 1, (high + 7) >> 3)
+        matches.sort()
+        return matches
+
+    def find(self, pattern, start = 0, end = None):
+        matches = self.finditer(pattern, start, end)
+        return matches[0] if len(matches) > 0 else -1
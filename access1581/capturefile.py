@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    CAPTURE FILE LAYOUT (all numbers little endian)
+
+    header      magic "A1581CAP", version, disk format name, number of
+                read retries, start and end time of the capture, position
+                and number of entries of the index table
+    track data  the compressed track data of every read, exactly as the
+                Arduino sent it, one chunk after the other
+    index table one entry per read: track, physical head, read attempt,
+                timestamp, position and length of the track data
+
+    the index table is written when the capture is closed, so the track data
+    can be streamed to disk while the disk is read.
+
+'''
+
+import ast
+import mmap
+import os
+import struct
+import time
+import zipfile
+from optparse import OptionParser
+from access1581.bitstream import compressBitstream
+from access1581.diskformats import *
+
+captureMagic = b'A1581CAP'
+captureVersion = 1
+defaultCaptureFile = 'raw_debug_capture.cap'
+
+#magic, version, disk format name, retries, start time, end time,
+#index offset, index entry count
+captureHeader = struct.Struct('<8sH16sHddQI')
+#track, physical head, attempt, timestamp, data offset, data length
+captureIndexEntry = struct.Struct('<BBHdQI')
+
+def loadRawTracks(path):
+    '''
+    loads a bitstream dump written by older versions of the imager
+    (storeBitstream), either as plain .py file or zipped like
+    raw_debug_image_d81.zip
+    '''
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            content = z.read( z.namelist()[0] ).decode('ascii')
+    else:
+        with open(path, 'r') as f:
+            content = f.read()
+    return ast.literal_eval(content)
+
+def isCaptureFile(path):
+    with open(path, 'rb') as f:
+        return f.read( len(captureMagic) ) == captureMagic
+
+class CaptureFileWriter:
+    '''
+    streams the compressed track data of a capture into a capture file
+    '''
+    def __init__(self, path, diskFormatName, retries):
+        self.path = path
+        self.diskFormatName = diskFormatName
+        self.retries = retries
+        self.startTime = time.time()
+        self.index = []
+        self.file = open(path, 'wb')
+        self.writeHeader(0, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def writeHeader(self, endTime, indexOffset):
+        self.file.seek(0)
+        self.file.write( captureHeader.pack(
+            captureMagic,
+            captureVersion,
+            self.diskFormatName.encode('ascii'),
+            self.retries,
+            self.startTime,
+            endTime,
+            indexOffset,
+            len(self.index)
+        ) )
+
+    def addTrack(self, trackno, headno, compressedTrackData, attempt = 1, timestamp = None):
+        '''
+        headno is the physical head the track was read with
+        '''
+        offset = self.file.tell()
+        self.file.write(compressedTrackData)
+        self.index.append( (trackno, headno, attempt, time.time() if timestamp is None else timestamp, offset, len(compressedTrackData)) )
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.seek(0, 2)
+        indexOffset = self.file.tell()
+        for entry in self.index:
+            self.file.write( captureIndexEntry.pack(*entry) )
+        self.writeHeader(time.time(), indexOffset)
+        self.file.close()
+        self.file = None
+
+class CaptureFileReader:
+    '''
+    memory maps a capture file. only header and index table are parsed when
+    the file is opened, the track data is read on demand. if a track was
+    read several times, the last read is returned.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.file = open(path, 'rb')
+        try:
+            self.readIndex()
+        except Exception:
+            self.close()
+            raise
+
+    def readIndex(self):
+        path = self.path
+        #mmap refuses empty files
+        if os.fstat(self.file.fileno()).st_size < captureHeader.size:
+            raise Exception("Not a capture file, it is too short: " + path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, diskFormatName, self.retries, self.startTime, self.endTime, indexOffset, indexCount) = \
+            captureHeader.unpack_from(self.map, 0)
+        if magic != captureMagic:
+            raise Exception("Not a capture file: " + path)
+        if version != captureVersion:
+            raise Exception("Unsupported capture file version " + str(version) + ": " + path)
+        if indexOffset == 0:
+            raise Exception("Capture file was not closed properly, the index table is missing: " + path)
+        if indexOffset + indexCount * captureIndexEntry.size > len(self.map):
+            raise Exception("Capture file is truncated, the index table is incomplete: " + path)
+        self.diskFormatName = diskFormatName.rstrip(b'\0').decode('ascii')
+        self.entries = [ captureIndexEntry.unpack_from(self.map, indexOffset + i * captureIndexEntry.size) for i in range(0, indexCount) ]
+        self.index = {}
+        self.reads = {}
+        for (trackno, headno, attempt, timestamp, offset, length) in self.entries:
+            if offset + length > indexOffset:
+                raise Exception("Capture file is damaged, track data overlaps the index table: " + path)
+            self.index[ (trackno, headno) ] = (offset, length)
+            self.reads.setdefault( (trackno, headno), [] ).append( (offset, length) )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def hasTrack(self, trackno, headno):
+        return (trackno, headno) in self.index
+
+    def getCompressedTrackData(self, trackno, headno):
+        if not (trackno, headno) in self.index:
+            raise Exception("Track " + str(trackno) + " head " + str(headno) + " is not part of the capture file")
+        (offset, length) = self.index[ (trackno, headno) ]
+        return self.map[offset:offset + length]
+
+    def getCompressedTrackReads(self, trackno, headno):
+        '''
+        returns all stored reads of a track in the order they were read
+        '''
+        if not (trackno, headno) in self.reads:
+            raise Exception("Track " + str(trackno) + " head " + str(headno) + " is not part of the capture file")
+        return [ self.map[offset:offset + length] for (offset, length) in self.reads[ (trackno, headno) ] ]
+
+def convertRawTracks(dumpPath, capturePath, diskFormat, retries = 0):
+    '''
+    converts an old bitstream dump into a capture file. the dumps use the
+    logical head numbers, capture files the physical ones
+    '''
+    rawTracks = loadRawTracks(dumpPath)
+    with CaptureFileWriter(capturePath, diskFormat.name, retries) as capture:
+        for trackno in sorted(rawTracks):
+            for headno in sorted(rawTracks[trackno]):
+                capture.addTrack( trackno, diskFormat.getPhysicalHead(headno), compressBitstream( rawTracks[trackno][headno] ) )
+
+def main():
+    parser = OptionParser("usage: %prog [options] dump capturefile")
+    parser.add_option("-d", "--disktype", dest="disktype",
+        help="disk format of the dump: " + getDiskFormatNames(),
+        default=defaultDiskType
+    )
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("expecting the bitstream dump to convert and the capture file to write")
+    diskFormat = getDiskFormat(options.disktype)
+    convertRawTracks(args[0], args[1], diskFormat)
+    print ("Wrote capture file " + args[1])
+
+if __name__ == '__main__':
+    main()
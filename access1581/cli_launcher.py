@@ -22,6 +22,8 @@
 import platform, os
 from optparse import OptionParser
 from access1581.imager import *
+from access1581.instrumentation import Instrumentation, JsonLinesWriter, Profiler
+from access1581.scheduler import trackOrders
 
 class launcher:
 
@@ -31,14 +33,7 @@ class launcher:
             'Linux' : '/dev/ttyUSB0',
             'Windows' : 'COM5'
         }
-        self.diskFormatTypes = {
-            "cbm1581" : diskFormat1581,
-            "ibmdos"  : diskFormatDOS
-        }
-        self.defaultDisktype = 'cbm1581'
-        self.defaultOutputImageName = \
-            'image_' + self.defaultDisktype + '.' + \
-            self.diskFormatTypes[self.defaultDisktype]().imageExtension
+        self.defaultDisktype = defaultDiskType
         self.defaultRetries = 5
 
         parser = OptionParser("usage: %prog [options] arg")
@@ -49,12 +44,12 @@ class launcher:
         )
         parser.add_option("-o", "--output",
             dest="outputImage",
-            help="file path/name of image file to write to, default is "+self.defaultOutputImageName,
-            default=self.defaultOutputImageName
+            help="file path/name of image file to write to, default is image_<disktype>.<extension>, for example image_"+self.defaultDisktype+"."+getDiskFormat(self.defaultDisktype).imageExtension,
+            default=None
         )
         parser.add_option("-s", "--serialdevice",
             dest="serialDeviceName",
-            help="device name of the serial device, for example /dev/ttyUSB0 (use value 'simulated' to test functionality)",
+            help="device name of the serial device, for example /dev/ttyUSB0 (use value 'simulated' to test functionality or the name of a capture file *.cap to replay it, 'emulated' or emulated:<capture file> to run the serial code against an emulated Arduino)",
             default=self.serialDeviceAddresses[ platform.system() ]
         )
         parser.add_option("-r", "--retries", dest="retries",
@@ -62,21 +57,147 @@ class launcher:
             str(self.defaultRetries)+" retries",
             default=self.defaultRetries
         )
+        parser.add_option("-n", "--revolutions", dest="revolutions",
+            help="number of consecutive revolutions read with each track read request, default: 1",
+            default=1
+        )
+        parser.add_option("--resume", dest="resume", action="store_true",
+            help="continue an interrupted run, tracks noted as complete in the journal next to the image file are not read again",
+            default=False
+        )
+        parser.add_option("-t", "--tracks", dest="tracks",
+            help="tracks to read, for example 0-9,40 (an existing image file is patched), default: all tracks",
+            default=None
+        )
+        parser.add_option("--heads", dest="heads",
+            help="heads to read, for example 0 (an existing image file is patched), default: both heads",
+            default=None
+        )
+        parser.add_option("--sectors", dest="sectors",
+            help="sectors to read on each selected track, for example 1-3 (an existing image file is patched), default: all sectors",
+            default=None
+        )
+        parser.add_option("--repair", dest="repair", action="store_true",
+            help="read only the sectors listed in the bad sector map <image>.badsectors again and patch the existing image file",
+            default=False
+        )
+        parser.add_option("--order", dest="trackOrder",
+            help="order in which tracks are read: sequential [default], serpentine, elevator",
+            default="sequential"
+        )
+        parser.add_option("--defer-retries", dest="deferRetries", action="store_true",
+            help="read every track once first and retry the incomplete ones in later sweeps across the disk",
+            default=False
+        )
+        parser.add_option("-p", "--pipeline", dest="pipelined", action="store_true",
+            help="overlap reading tracks with decoding them in worker threads",
+            default=False
+        )
+        parser.add_option("-w", "--workers", dest="workers",
+            help="number of decode workers used with --pipeline, default: 2",
+            default=2
+        )
+        parser.add_option("--processes", dest="useProcesses", action="store_true",
+            help="use a process pool instead of threads for the decode workers of --pipeline",
+            default=False
+        )
+        parser.add_option("--streaming", dest="streaming", action="store_true",
+            help="decode each track while its data is still arriving from the Arduino (single revolution reads without --pipeline)",
+            default=False
+        )
+        parser.add_option("--fast", dest="realtime", action="store_false",
+            help="let an emulated Arduino (-s emulated) answer at once instead of modelling the timing of the drive",
+            default=True
+        )
+        parser.add_option("--trace-file", dest="traceFile",
+            help="write a JSON record with timings, retries and crc failures of every track to this file (JSON Lines)",
+            default=None
+        )
+        parser.add_option("--profile", dest="profileFile",
+            help="profile the read loop with cProfile and write the statistics to this file",
+            default=None
+        )
+        parser.add_option("--trace-memory", dest="traceMemory", action="store_true",
+            help="trace the memory allocations of the read loop with tracemalloc",
+            default=False
+        )
+        parser.add_option("--skip-format-check", dest="detectFormat", action="store_false",
+            help="don't check the disk format against the first track of the disk before imaging",
+            default=True
+        )
         (options, args) = parser.parse_args()
 
-        if options.serialDeviceName != "simulated" and platform.system() != "Windows" and not os.path.exists(options.serialDeviceName):
+        if options.serialDeviceName != "simulated" and not options.serialDeviceName.startswith("emulated") and platform.system() != "Windows" and not os.path.exists(options.serialDeviceName):
             raise Exception( "Serial device does not exist: " + options.serialDeviceName )
 
-        if not options.disktype in self.diskFormatTypes.keys():
-            raise Exception("Error: disk format " + options.disktype +  " is unknown")
-        diskFormat = self.diskFormatTypes[ options.disktype ]()
+        if not options.trackOrder in trackOrders:
+            raise Exception("Error: track order " + options.trackOrder + " is unknown")
+        if options.disktype == "auto":
+            #detected by the imager, the selection is checked against the
+            #format with most sectors per track
+            diskFormat = None
+            selection = self.getSelection( max( [ getDiskFormat(name) for name in diskFormatTypes ], key=lambda f: f.expectedSectorsPerTrack ), options )
+        else:
+            diskFormat = getDiskFormat(options.disktype)
+            selection = self.getSelection(diskFormat, options)
         options.storeBitstream = False #tmp debug
-        IBMDoubleDensityFloppyDiskImager( diskFormat, options.outputImage, int(options.retries), options.serialDeviceName, options.storeBitstream )
+        instrumentation = None
+        if options.traceFile is not None:
+            instrumentation = Instrumentation()
+            instrumentation.addHook( JsonLinesWriter(options.traceFile) )
+        profiler = None
+        if options.profileFile is not None or options.traceMemory is True:
+            profiler = Profiler(options.profileFile, options.traceMemory)
+        try:
+            IBMDoubleDensityFloppyDiskImager(
+                diskFormat,
+                options.outputImage,
+                int(options.retries),
+                options.serialDeviceName,
+                options.storeBitstream,
+                pipelined = options.pipelined,
+                decodeWorkers = int(options.workers),
+                useProcesses = options.useProcesses,
+                revolutions = int(options.revolutions),
+                resume = options.resume,
+                selection = selection,
+                repair = options.repair,
+                trackOrder = options.trackOrder,
+                deferRetries = options.deferRetries,
+                instrumentation = instrumentation,
+                profiler = profiler,
+                detectFormat = options.detectFormat,
+                streaming = options.streaming,
+                realtime = options.realtime
+            )
+        finally:
+            if instrumentation is not None:
+                instrumentation.close()
+
+    def parseNumberList(self, value, allowed, label):
+        '''
+        turns a string like "0-9,40" into a sorted list of numbers
+        '''
+        numbers = set()
+        for part in value.split(','):
+            bounds = part.split('-')
+            if len(bounds) > 2 or not all( b.strip().isdigit() for b in bounds ):
+                raise Exception("Error: can't parse " + label + " '" + value + "'")
+            numbers.update( range( int(bounds[0]), int(bounds[-1]) + 1 ) )
+        for number in numbers:
+            if not number in allowed:
+                raise Exception("Error: " + label + " " + str(number) + " is out of range")
+        return sorted(numbers)
+
+    def getSelection(self, diskFormat, options):
+        if options.tracks is None and options.heads is None and options.sectors is None:
+            return None
+        tracks = diskFormat.trackRange if options.tracks is None else self.parseNumberList(options.tracks, diskFormat.trackRange, "track")
+        heads = diskFormat.headRange if options.heads is None else self.parseNumberList(options.heads, diskFormat.headRange, "head")
+        sectors = None
+        if options.sectors is not None:
+            sectors = set( self.parseNumberList(options.sectors, range(1, diskFormat.expectedSectorsPerTrack + 1), "sector") )
+        return { (trackno, headno): sectors for trackno in tracks for headno in heads }
 
     def getDocDiskType(self):
-        dft = ''
-        for type in self.diskFormatTypes.keys():
-            defa = "" if type != self.defaultDisktype else " [default]"
-            dft += type + defa + ", "
-        dft = dft[0:len(dft)-2]
-        return "type of DD disk in floppy drive: " + dft
+        return "type of DD disk in floppy drive: " + getDiskFormatNames() + ", auto (detected from the first track)"
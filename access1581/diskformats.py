@@ -26,6 +26,18 @@
 
 '''
 
+from access1581.bitstream import BitPattern, compressPattern
+
+#bit patterns are compiled only once per bit string and shared by all disk
+#format instances (every parser and every decode worker gets its own)
+compiledPatterns = {}
+
+def compilePattern(bitString):
+    pattern = compiledPatterns.get(bitString)
+    if pattern is None:
+        pattern = compiledPatterns[bitString] = BitPattern(bitString)
+    return pattern
+
 class diskFormatRoot:
     def __init__(self):
         self.name           = 'root'
@@ -36,6 +48,15 @@ class diskFormatRoot:
         self.imageExtension = 'img'
         self.mfmSyncMarkA1  = '100010010001001' #special mfm sync mark
 
+    def getPhysicalHead(self, headno):
+        '''
+        maps the side number used in the sector headers to the head of the
+        drive that has to be selected to read it
+        '''
+        if self.swapsides is False:
+            return 1 if headno == 0 else 0
+        return headno
+
 class diskFormatDOS(diskFormatRoot):
     def __init__(self):
         super().__init__()
@@ -52,11 +73,35 @@ class diskFormatDOS(diskFormatRoot):
         self.legalOffsetRangeUpperBorder = 720
         self.legalOffsetRange = range(self.legalOffsetRangeLowerBorder,self.legalOffsetRangeUpperBorder+1)
 
+        #track layout used when tracks are written (see trackencoder), all
+        #lengths in bytes before MFM encoding
+        self.trackCapacity = 6250 #250 kbit/s at 300 rpm
+        self.gap4aLength = 80 #gap after the index pulse
+        self.indexMark = True #c2c2c2fc and gap 1 after gap 4a
+        self.gap1Length = 50
+        self.syncLength = 12 #00 bytes in front of each address mark
+        self.gap2Length = 22 #between ID field and data field
+        self.gap3Length = 84 #between the sectors
+        self.gapByte = 0x4e
+
         #TODO: check value 1320 *8 bits. 512 bytes as data content wrapped in
         #sector meta data bytes, 1320 is just a good guess that just works
         #maybe we can shrink it more
         self.sectorLength = 1320*8
 
+    def getMarkerPatterns(self):
+        '''
+        the compiled sector start marker (gap, sync bytes a1a1a1 and fe) and
+        the sync bytes both address marks share
+        '''
+        return ( compilePattern(self.sectorStartMarker), compilePattern(self.sectorDataStartMarker[:-len(self.mfmFB)]) )
+
+    def getCompressedSyncPattern(self):
+        '''
+        the sync bytes a1a1a1 as interval codes of the compressed track data
+        '''
+        return compilePattern( compressPattern( (self.mfmSyncMarkA1 + '0') * 3 ) )
+
     '''
     def hexString2bitString(self, hexString ):
         bitString = ""
@@ -72,3 +117,26 @@ class diskFormat1581(diskFormatDOS):
         self.expectedSectorsPerTrack = 10
         self.swapsides              = True
         self.imageExtension         = 'd81'
+        #ten sectors only fit with shorter gaps and without index mark
+        self.gap4aLength            = 32
+        self.indexMark              = False
+        self.gap3Length             = 35
+
+#all known disk formats by the name used on the command line
+diskFormatTypes = {
+    "cbm1581" : diskFormat1581,
+    "ibmdos"  : diskFormatDOS
+}
+defaultDiskType = "cbm1581"
+
+def registerDiskFormat(diskFormatClass):
+    diskFormatTypes[ diskFormatClass().name ] = diskFormatClass
+    return diskFormatClass
+
+def getDiskFormat(name):
+    if not name in diskFormatTypes:
+        raise Exception("Error: disk format " + name +  " is unknown")
+    return diskFormatTypes[name]()
+
+def getDiskFormatNames():
+    return ", ".join( name + (" [default]" if name == defaultDiskType else "") for name in diskFormatTypes )
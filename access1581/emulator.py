@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import os
+import pty
+import select
+import termios
+import threading
+import time
+import tty
+from optparse import OptionParser
+from access1581.bitstream import BitBuffer, compressBitstream
+from access1581.capturefile import CaptureFileReader, defaultCaptureFile, isCaptureFile, loadRawTracks
+from access1581.diskformats import *
+from access1581.trackencoder import mfmToCompressed
+
+class ArduinoFirmwareEmulator:
+    '''
+    speaks the serial protocol of Rob Smith's Arduino firmware on the master
+    side of a pseudo terminal, the slave side is a serial device that
+    ArduinoFloppyControlInterface can open like the real thing. the disk is
+    a recorded one: a CaptureFileReader or a dict of bitstreams of an old
+    debug dump, tracks are addressed by physical head like on the drive.
+    with realtime set, the timing of the hardware is modelled: the rotation
+    of the disk (a read from the index pulse waits for the index and takes a
+    whole revolution), the seek time per track step, the motor spin up and
+    the line rate of the serial connection.
+    tracks written with '>' are kept in writtenTracks and are read back from
+    there. old dumps need the disk format to map the physical heads to the
+    logical ones they use.
+    '''
+    def __init__(self, rawTrackData, diskFormat = None, realtime = True, rpm = 300, stepTime = 0.003, spinUpTime = 0.5, baudrate = 2000000, firmwareVersion = b'V1.3'):
+        self.rawTrackData = rawTrackData
+        self.isCapture = not isinstance(rawTrackData, dict)
+        self.diskFormat = diskFormat
+        self.realtime = realtime
+        self.revolutionTime = 60 / rpm
+        self.stepTime = stepTime
+        self.spinUpTime = spinUpTime
+        #8 data bits, start and stop bit
+        self.byteTime = 10 / baudrate
+        self.firmwareVersion = firmwareVersion
+        self.currentTrack = 0
+        self.currentHead = 0
+        self.motorMode = None
+        self.writtenTracks = {}
+        self.commandCount = 0
+        self.master = None
+        self.thread = None
+        self.stopped = False
+        self.startTime = time.time()
+
+    def start(self):
+        '''
+        opens the pseudo terminal and starts answering commands in a
+        background thread. returns the name of the serial device to use
+        '''
+        self.stopped = False
+        (self.master, slave) = pty.openpty()
+        tty.setraw(slave)
+        self.slave = slave
+        self.devicePath = os.ttyname(slave)
+        self.thread = threading.Thread(target=self.serve, name="firmwareemulator", daemon=True)
+        self.thread.start()
+        return self.devicePath
+
+    def stop(self):
+        '''
+        ends the thread and closes the pseudo terminal and the recorded disk.
+        a reply still being sent is dropped to unblock its write
+        '''
+        if self.master is not None:
+            self.stopped = True
+            termios.tcflush(self.slave, termios.TCIFLUSH)
+            os.close(self.slave)
+            self.thread.join()
+            os.close(self.master)
+            self.master = None
+        if self.isCapture is True:
+            self.rawTrackData.close()
+
+    def wait(self, seconds):
+        if self.realtime is True and seconds > 0:
+            time.sleep(seconds)
+
+    def read(self, count):
+        data = b''
+        while len(data) < count:
+            #wakes up now and then to notice a stop while the host is silent
+            if not select.select( [self.master], [], [], 0.1 )[0]:
+                if self.stopped is True:
+                    raise EOFError
+                continue
+            chunk = os.read(self.master, count - len(data))
+            if chunk == b'':
+                raise EOFError
+            data += chunk
+        return data
+
+    def send(self, data, duration = 0):
+        '''
+        writes data to the host no faster than the line rate, spread over
+        duration seconds if that takes longer
+        '''
+        view = memoryview(data)
+        byteTime = max( self.byteTime, duration / max(1, len(view)) )
+        chunkSize = 1024
+        starttime = time.time()
+        for offset in range(0, len(view), chunkSize):
+            if self.stopped is True:
+                raise EOFError
+            chunk = view[offset:offset + chunkSize]
+            while len(chunk) > 0:
+                chunk = chunk[os.write(self.master, chunk):]
+            self.wait( (offset + len(view[offset:offset + chunkSize])) * byteTime - (time.time() - starttime) )
+
+    def serve(self):
+        try:
+            while self.stopped is False:
+                self.handleCommand( self.read(1) )
+        except (EOFError, OSError):
+            #the pseudo terminal was closed
+            pass
+
+    def handleCommand(self, cmd):
+        self.commandCount += 1
+        if cmd == b'?':
+            self.send( b'1' + self.firmwareVersion )
+        elif cmd == b'+' or cmd == b'~':
+            #the firmware switches a running motor off and on again
+            self.wait(self.spinUpTime)
+            self.motorMode = cmd
+            self.send(b'1')
+        elif cmd == b'-':
+            self.motorMode = None
+            self.send(b'1')
+        elif cmd == b'.':
+            self.seek(0)
+            self.send(b'1')
+        elif cmd == b'[' or cmd == b']':
+            self.currentHead = 0 if cmd == b'[' else 1
+            self.send(b'1')
+        elif cmd == b'#':
+            track = self.read(2)
+            if not track.isdigit() or int(track) > 83:
+                self.send(b'0')
+                return
+            self.seek( int(track) )
+            self.send(b'1')
+        elif cmd == b'<':
+            fromIndexPulse = self.read(1) == b'\x01'
+            if self.motorMode is None:
+                self.send(b'0')
+                return
+            self.sendTrack(fromIndexPulse)
+        elif cmd == b'X':
+            self.send(b'1')
+            if self.checkWriteMode() is True:
+                self.wait(self.revolutionTime)
+                self.writtenTracks[ (self.currentTrack, self.currentHead) ] = None
+                self.send(b'1')
+        elif cmd == b'>':
+            self.send(b'1')
+            if self.checkWriteMode() is True:
+                self.receiveTrack()
+        elif cmd == b'&':
+            self.read(1)
+            self.send(b'1')
+        else:
+            self.send(b'0')
+
+    def seek(self, track):
+        self.wait( abs(track - self.currentTrack) * self.stepTime )
+        self.currentTrack = track
+
+    def checkWriteMode(self):
+        if self.motorMode != b'~':
+            self.send(b'N')
+            return False
+        self.send(b'Y')
+        return True
+
+    def getCompressedTrackData(self):
+        key = (self.currentTrack, self.currentHead)
+        if key in self.writtenTracks:
+            #an erased track has no flux reversals to report
+            if self.writtenTracks[key] is None:
+                return b''
+            return mfmToCompressed( self.writtenTracks[key] )
+        if self.isCapture is True:
+            if not self.rawTrackData.hasTrack(*key):
+                return b''
+            return self.rawTrackData.getCompressedTrackData(*key)
+        #old dumps use logical heads, the mapping only swaps heads (1581)
+        bitstream = self.rawTrackData.get(self.currentTrack, {}).get( self.diskFormat.getPhysicalHead(self.currentHead) )
+        if bitstream is None:
+            return b''
+        if isinstance(bitstream, BitBuffer):
+            bitstream = bitstream.toBitString()
+        return compressBitstream(bitstream)
+
+    def sendTrack(self, fromIndexPulse):
+        if fromIndexPulse is True:
+            #wait for the index pulse of the spinning disk
+            self.wait( self.revolutionTime - (time.time() - self.startTime) % self.revolutionTime )
+        trackbytes = self.getCompressedTrackData()
+        if not trackbytes.endswith(b'\0'):
+            trackbytes = bytes(trackbytes) + b'\0'
+        #the flux is sent while the disk turns, one revolution per track
+        self.send(trackbytes, self.revolutionTime)
+
+    def receiveTrack(self):
+        (datalen_hb, datalen_lb, fromIndexPulse) = self.read(3)
+        self.send(b'!')
+        data = self.read( (datalen_hb << 8) | datalen_lb )
+        self.wait(self.revolutionTime)
+        self.writtenTracks[ (self.currentTrack, self.currentHead) ] = data
+        self.send(b'1')
+
+def loadEmulatedDisk(serialDevice, diskFormat, realtime = True):
+    '''
+    starts an emulator for the serial device names 'emulated' (replays the
+    default capture file) and 'emulated:<capture file or old dump>'
+    '''
+    path = serialDevice.split(':', 1)[1] if ':' in serialDevice else defaultCaptureFile
+    if not os.path.exists(path) and path == defaultCaptureFile:
+        print ("Notice: " + path + " not found, emulating the old bitstream dump instead")
+        path = 'raw_debug_image_d81.py'
+    rawTrackData = CaptureFileReader(path) if isCaptureFile(path) else loadRawTracks(path)
+    return ArduinoFirmwareEmulator(rawTrackData, diskFormat, realtime)
+
+def main():
+    parser = OptionParser("usage: %prog [options] capturefile|dump")
+    parser.add_option("-d", "--disktype", dest="disktype",
+        help="disk format of the recorded disk: " + getDiskFormatNames(),
+        default=defaultDiskType
+    )
+    parser.add_option("--fast", dest="fast", action="store_true",
+        help="answer at once instead of modelling rotation, seek times and line rate",
+        default=False
+    )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expecting the capture file or dump to emulate")
+    emulator = ArduinoFirmwareEmulator(
+        CaptureFileReader(args[0]) if isCaptureFile(args[0]) else loadRawTracks(args[0]),
+        getDiskFormat(options.disktype),
+        realtime = not options.fast
+    )
+    print ("Emulated Arduino is listening on " + emulator.start() + ", press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
+        print ("Commands received: " + str(emulator.commandCount))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import glob
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+from access1581.diskformats import *
+from access1581.imager import IBMDoubleDensityFloppyDiskImager
+from access1581.instrumentation import Instrumentation, JsonLinesWriter
+
+def discoverSerialDevices():
+    '''
+    returns the USB serial devices an Arduino usually shows up as
+    '''
+    return sorted( glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*') )
+
+class DiskImagingFarm:
+    '''
+    images one disk per serial device at the same time. every drive gets its
+    own thread running a pipelined capture, the decoding of all drives is
+    done by a single shared process pool. serialDevices may also contain
+    'simulated' or capture files (*.cap) to replay.
+    the image names are built from outputPattern, which can use {index}
+    (number of the drive), {device} (base name of the serial device) and
+    {ext} (image file extension of the disk format). the track records of
+    all drives go to the same instrumentation. emulated drives answer at once
+    if realtime is False
+    '''
+    def __init__(self, diskFormat, serialDevices, outputPattern = "image_{index:02d}_{device}.{ext}", retries = 5, workers = None, trackOrder = "sequential", instrumentation = None, realtime = True):
+        self.diskFormat = diskFormat
+        self.serialDevices = serialDevices
+        self.outputPattern = outputPattern
+        self.retries = retries
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.trackOrder = trackOrder
+        self.instrumentation = instrumentation
+        self.realtime = realtime
+        self.results = {}
+        self.resultsLock = threading.Lock()
+
+    def getImageName(self, index, serialDevice):
+        device = os.path.splitext( os.path.basename(serialDevice) )[0]
+        return self.outputPattern.format(index=index, device=device, ext=self.diskFormat.imageExtension)
+
+    def imageDisk(self, index, serialDevice, pool):
+        imagename = self.getImageName(index, serialDevice)
+        starttime = time.time()
+        try:
+            imager = IBMDoubleDensityFloppyDiskImager(
+                self.diskFormat,
+                imagename,
+                self.retries,
+                serialDevice,
+                pipelined = True,
+                decodeWorkers = 2,
+                useProcesses = True,
+                trackOrder = self.trackOrder,
+                decodePool = pool,
+                instrumentation = self.instrumentation,
+                realtime = self.realtime
+            )
+            result = (imagename, time.time() - starttime, imager.trackCount, imager.badSectorCount, None)
+        except Exception as e:
+            result = (imagename, time.time() - starttime, 0, 0, e)
+        with self.resultsLock:
+            self.results[ (index, serialDevice) ] = result
+
+    def run(self):
+        print ("Imaging " + str(len(self.serialDevices)) + " disks with a shared pool of " + str(self.workers) + " decode processes")
+        starttime = time.time()
+        with ProcessPoolExecutor(self.workers) as pool:
+            drives = [
+                threading.Thread(target=self.imageDisk, args=(index, serialDevice, pool), name="drive" + str(index))
+                for (index, serialDevice) in enumerate(self.serialDevices)
+            ]
+            for drive in drives:
+                drive.start()
+            for drive in drives:
+                drive.join()
+        self.duration = time.time() - starttime
+        self.printStats()
+        return all( self.results[drive][4] is None for drive in self.results )
+
+    def printStats(self):
+        trackLength = self.diskFormat.expectedSectorsPerTrack * self.diskFormat.sectorSize
+        totalTracks = 0
+        for (index, serialDevice) in sorted(self.results):
+            (imagename, duration, trackCount, badSectorCount, error) = self.results[ (index, serialDevice) ]
+            if error is not None:
+                print ( f"Drive {index:2d} {serialDevice}: FAILED after {duration:.2f} seconds: {error}" )
+                continue
+            totalTracks += trackCount
+            print ( f"Drive {index:2d} {serialDevice}: {imagename}, {trackCount} tracks in {duration:.2f} seconds, {badSectorCount} bad sectors" )
+        kilobytes = totalTracks * trackLength / 1024
+        print ( "Total duration of the farm run      : " + str(int(self.duration*100)/100) + " seconds")
+        print ( f"Aggregate throughput                : {totalTracks} tracks, {kilobytes:.0f} KB, {kilobytes / max(self.duration, 0.001):.1f} KB/s" )
+
+def main():
+    parser = OptionParser("usage: %prog [options] [serialdevice ...]")
+    parser.add_option("-d", "--disktype", dest="disktype",
+        help="disk format of all disks: " + getDiskFormatNames(),
+        default=defaultDiskType
+    )
+    parser.add_option("-o", "--output", dest="outputPattern",
+        help="pattern of the image file names, {index}, {device} and {ext} are replaced, default: image_{index:02d}_{device}.{ext}",
+        default="image_{index:02d}_{device}.{ext}"
+    )
+    parser.add_option("-r", "--retries", dest="retries",
+        help="number of retries to read disk track again after invalid CRC check, default: 5 retries",
+        default=5
+    )
+    parser.add_option("-w", "--workers", dest="workers",
+        help="number of decode processes shared by all drives, default: number of CPU cores",
+        default=None
+    )
+    parser.add_option("--order", dest="trackOrder",
+        help="order in which tracks are read: sequential [default], serpentine, elevator",
+        default="sequential"
+    )
+    parser.add_option("--fast", dest="realtime", action="store_false",
+        help="let emulated drives (emulated:<capture file>) answer at once instead of modelling the timing of the drive",
+        default=True
+    )
+    parser.add_option("--trace-file", dest="traceFile",
+        help="write a JSON record of every track of all drives to this file (JSON Lines)",
+        default=None
+    )
+    (options, args) = parser.parse_args()
+    serialDevices = args if len(args) > 0 else discoverSerialDevices()
+    if len(serialDevices) == 0:
+        parser.error("no serial device given and none found")
+    for serialDevice in serialDevices:
+        if serialDevice != "simulated" and not serialDevice.startswith("emulated") and not os.path.exists(serialDevice):
+            raise Exception( "Serial device does not exist: " + serialDevice )
+    instrumentation = None
+    if options.traceFile is not None:
+        instrumentation = Instrumentation()
+        instrumentation.addHook( JsonLinesWriter(options.traceFile) )
+    farm = DiskImagingFarm(
+        getDiskFormat(options.disktype),
+        serialDevices,
+        options.outputPattern,
+        int(options.retries),
+        int(options.workers) if options.workers is not None else None,
+        options.trackOrder,
+        instrumentation,
+        options.realtime
+    )
+    try:
+        success = farm.run()
+    finally:
+        if instrumentation is not None:
+            instrumentation.close()
+    if success is False:
+        raise Exception("Imaging failed on at least one drive")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import binascii
+import time
+from access1581.diskformats import *
+from access1581.mfm import mfmDecodeBytes
+
+class DiskFormatDetector:
+    '''
+    reads sample tracks with both heads and collects the sector headers
+    (ID address marks with a valid crc) found there. sectors per track,
+    sector size and the side numbers written on each head are inferred from
+    them and compared with the registered disk formats. all registered
+    formats share the sync bytes and the ID address mark, the patterns of
+    any of them will do for the search
+    '''
+    def __init__(self, arduino, sampleTracks = (0,), diskFormat = None):
+        self.arduino = arduino
+        self.sampleTracks = sampleTracks
+        self.searchFormat = diskFormat if diskFormat is not None else getDiskFormat(defaultDiskType)
+        (self.sectorStartPattern, self.syncPattern) = self.searchFormat.getMarkerPatterns()
+        self.addressMarkLength = len(self.searchFormat.mfmFE)
+        self.idAddressMark = int(self.searchFormat.mfmFE, 2)
+        #physical head -> set of (track, side, sector, size code)
+        self.sectorIds = {}
+        self.duration = 0
+
+    def findSectorIds(self, bitstream):
+        sectorIds = set()
+        for syncStart in bitstream.finditer(self.syncPattern):
+            markerEnd = syncStart + self.syncPattern.length + self.addressMarkLength
+            if markerEnd + 6 * 16 > len(bitstream):
+                break
+            if bitstream.getBits(markerEnd - self.addressMarkLength, self.addressMarkLength) != self.idAddressMark:
+                continue
+            #a1a1a1fe, track, side, sector, size code, crc
+            header = mfmDecodeBytes(bitstream, markerEnd - 4 * 16, 10)
+            if binascii.crc_hqx(header, 0xffff) == 0:
+                sectorIds.add( tuple(header[4:8]) )
+        return sectorIds
+
+    def readSampleTracks(self):
+        starttime = time.time()
+        for trackno in self.sampleTracks:
+            for physicalHead in (0, 1):
+                bitstream = self.arduino.getDecompressedBitstream(trackno, physicalHead)
+                self.sectorIds.setdefault(physicalHead, set()).update( self.findSectorIds(bitstream) )
+        self.duration = time.time() - starttime
+
+    def hasSectorIds(self):
+        return any( len(self.sectorIds[physicalHead]) > 0 for physicalHead in self.sectorIds )
+
+    def getGeometry(self):
+        '''
+        sectors per track (the highest sector number), sector size and the
+        side numbers found on each physical head
+        '''
+        allIds = set().union( *self.sectorIds.values() )
+        sides = { physicalHead: set( sectorId[1] for sectorId in self.sectorIds[physicalHead] ) for physicalHead in self.sectorIds }
+        return {
+            "sectors"     : max( sectorId[2] for sectorId in allIds ),
+            "sectorSizes" : set( 128 << (sectorId[3] & 3) for sectorId in allIds ),
+            "sides"       : sides
+        }
+
+    def describe(self):
+        if self.hasSectorIds() is False:
+            return "no sector headers found on track " + ",".join( str(t) for t in self.sampleTracks )
+        geometry = self.getGeometry()
+        sides = ", ".join( "side " + "/".join( str(side) for side in sorted(geometry["sides"][physicalHead]) ) + " on head " + str(physicalHead) for physicalHead in sorted(geometry["sides"]) if len(geometry["sides"][physicalHead]) > 0 )
+        return str(geometry["sectors"]) + " sectors per track of " + "/".join( str(size) for size in sorted(geometry["sectorSizes"]) ) + " bytes, " + sides
+
+    def matches(self, diskFormat):
+        geometry = self.getGeometry()
+        if geometry["sectors"] != diskFormat.expectedSectorsPerTrack or geometry["sectorSizes"] != { diskFormat.sectorSize }:
+            return False
+        for physicalHead in geometry["sides"]:
+            for side in geometry["sides"][physicalHead]:
+                if diskFormat.getPhysicalHead(side) != physicalHead:
+                    return False
+        return True
+
+    def getMatchingFormats(self):
+        if self.hasSectorIds() is False:
+            return []
+        return [ name for name in diskFormatTypes if self.matches( getDiskFormat(name) ) ]
+
+def detectDiskFormat(arduino, diskFormat = None):
+    '''
+    reads the first track and returns the disk format it was written with.
+    if diskFormat is given, it is checked against the track instead, an
+    exception tells right away if it doesn't fit the disk
+    '''
+    detector = DiskFormatDetector(arduino, diskFormat = diskFormat)
+    detector.readSampleTracks()
+    matchingFormats = detector.getMatchingFormats()
+    print ( "Disk format detection: " + detector.describe() + f" ({detector.duration:.2f} seconds)" )
+    if diskFormat is None:
+        if len(matchingFormats) == 0:
+            raise Exception("Error: disk format could not be detected, " + detector.describe())
+        print ("Detected disk format is " + matchingFormats[0])
+        return getDiskFormat( matchingFormats[0] )
+    if detector.hasSectorIds() is False:
+        print ("Notice: can't check the disk format, " + detector.describe())
+        return diskFormat
+    if not diskFormat.name in matchingFormats:
+        hint = ", the disk looks like " + " or ".join(matchingFormats) if len(matchingFormats) > 0 else ""
+        raise Exception("Error: disk doesn't match disk format " + diskFormat.name + " (" + detector.describe() + ")" + hint)
+    return diskFormat
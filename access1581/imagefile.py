@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import hashlib
+import os
+
+def printHashes(hashes):
+    for (label, result) in zip( ("MD5   ", "SHA1  ", "SHA256"), hashes ):
+        print(label + ": " + result.hexdigest())
+
+def loadBadSectorMap(path):
+    '''
+    reads a bad sector map, a text file with one line "track head sector"
+    per bad sector. returns a dict (track, head) -> set of sector numbers
+    '''
+    badSectors = {}
+    if not os.path.exists(path):
+        return badSectors
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3:
+                badSectors.setdefault( (int(fields[0]), int(fields[1])), set() ).add( int(fields[2]) )
+    return badSectors
+
+def saveBadSectorMap(path, badSectors):
+    '''
+    writes the bad sector map, an empty map removes the file
+    '''
+    tracks = [ track for track in sorted(badSectors) if len(badSectors[track]) > 0 ]
+    if len(tracks) == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w') as f:
+        for (trackno, headno) in tracks:
+            for sectorno in sorted(badSectors[ (trackno, headno) ]):
+                f.write( str(trackno) + " " + str(headno) + " " + str(sectorno) + "\n" )
+
+class ImageFileWriter:
+    '''
+    writes the tracks of a disk image to their fixed offsets as soon as they
+    are available, in any order. the image file is created with its final
+    size up front, tracks that never arrive stay filled with zeros.
+    MD5/SHA1/SHA256 are updated whenever the next tracks in image order are
+    complete. every complete track is noted in a journal next to the image,
+    so an interrupted run can be resumed. the journal is removed once all
+    tracks are complete.
+    with patch set, an existing image is updated in place instead: only the
+    written tracks or sectors change, there is no journal and the hashes
+    are calculated over the whole file when it is closed.
+    '''
+    def __init__(self, imagename, diskFormat, resume = False, patch = False):
+        self.imagename = imagename
+        self.journalName = imagename + '.journal'
+        self.patch = patch
+        self.sectorSize = diskFormat.sectorSize
+        self.sectorsPerTrack = diskFormat.expectedSectorsPerTrack
+        self.trackLength = diskFormat.expectedSectorsPerTrack * diskFormat.sectorSize
+        self.trackOrder = [ (trackno, headno) for trackno in diskFormat.trackRange for headno in diskFormat.headRange ]
+        self.trackIndex = { track: index for (index, track) in enumerate(self.trackOrder) }
+        self.imageSize = len(self.trackOrder) * self.trackLength
+        self.completedTracks = set()
+        if patch is True:
+            if not os.path.exists(imagename) or os.path.getsize(imagename) != self.imageSize:
+                raise Exception("Image to patch doesn't exist or its size doesn't match the disk format: " + imagename)
+            self.file = open(imagename, 'r+b', buffering=0)
+            self.journal = None
+        else:
+            if resume is True:
+                self.loadJournal()
+            resuming = len(self.completedTracks) > 0
+            self.file = open(imagename, 'r+b' if resuming else 'w+b', buffering=0)
+            self.file.truncate(self.imageSize)
+            self.journal = open(self.journalName, 'a' if resuming else 'w')
+        self.hashes = [ hashlib.md5(), hashlib.sha1(), hashlib.sha256() ]
+        self.hashedTracks = 0
+        self.pendingTracks = {}
+        self.updateHashes()
+
+    def loadJournal(self):
+        if not os.path.exists(self.journalName) or not os.path.exists(self.imagename):
+            return
+        if os.path.getsize(self.imagename) != self.imageSize:
+            print ("Notice: Size of " + self.imagename + " doesn't match the disk format, not resuming")
+            return
+        with open(self.journalName, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    self.completedTracks.add( (int(fields[0]), int(fields[1])) )
+        print ("Resuming " + self.imagename + ", " + str(len(self.completedTracks)) + " tracks are complete already")
+
+    def isTrackComplete(self, trackno, headno):
+        return (trackno, headno) in self.completedTracks
+
+    def getMissingTracks(self):
+        return [ track for track in self.trackOrder if not track in self.completedTracks ]
+
+    def writeTrack(self, trackno, headno, trackData):
+        index = self.trackIndex[ (trackno, headno) ]
+        isComplete = len(trackData) == self.trackLength
+        if not isComplete:
+            trackData = bytes(trackData[:self.trackLength]).ljust(self.trackLength, b'\0')
+        self.writeAt(index * self.trackLength, trackData)
+        if isComplete and self.journal is not None:
+            self.completedTracks.add( (trackno, headno) )
+            self.journal.write( str(trackno) + " " + str(headno) + "\n" )
+            self.journal.flush()
+        if self.patch is False:
+            self.pendingTracks[index] = trackData
+            self.updateHashes()
+
+    def writeSectors(self, trackno, headno, sectors):
+        '''
+        writes single sectors (dict sector number -> data) of a track, the
+        other sectors of the track keep their content
+        '''
+        index = self.trackIndex[ (trackno, headno) ]
+        for sectorno in sorted(sectors):
+            if sectorno < 1 or sectorno > self.sectorsPerTrack or len(sectors[sectorno]) != self.sectorSize:
+                continue
+            self.writeAt(index * self.trackLength + (sectorno - 1) * self.sectorSize, sectors[sectorno])
+        if self.patch is False:
+            self.pendingTracks[index] = self.readTrack(index)
+            self.updateHashes()
+
+    def writeAt(self, offset, data):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self.file.fileno(), data, offset)
+        else:
+            self.file.seek(offset)
+            self.file.write(data)
+
+    def readTrack(self, index):
+        self.file.seek(index * self.trackLength)
+        return self.file.read(self.trackLength)
+
+    def updateHashes(self, flush = False):
+        '''
+        feeds all tracks that continue the hashed part of the image into the
+        hashes. tracks that were completed by an interrupted run (or that
+        were never written, on flush) are read back from the file
+        '''
+        while self.hashedTracks < len(self.trackOrder):
+            index = self.hashedTracks
+            if index in self.pendingTracks:
+                trackData = self.pendingTracks.pop(index)
+            elif flush is True or self.trackOrder[index] in self.completedTracks:
+                trackData = self.readTrack(index)
+            else:
+                break
+            for result in self.hashes:
+                result.update(trackData)
+            self.hashedTracks += 1
+
+    def close(self):
+        if self.file is None:
+            return
+        self.updateHashes(True)
+        self.file.close()
+        self.file = None
+        if self.journal is None:
+            printHashes(self.hashes)
+            return
+        self.journal.close()
+        if len(self.completedTracks) == len(self.trackOrder):
+            os.remove(self.journalName)
+        else:
+            print ("Notice: " + str(len(self.trackOrder) - len(self.completedTracks)) + " tracks are incomplete, keeping " + self.journalName)
+        printHashes(self.hashes)
@@ -19,113 +19,417 @@
 
 '''
 
-import ast
-import re
-import bitstring
 import binascii
-import hashlib
+import contextlib
+import functools
+import os
+import time
 from access1581.arduinointerface import *
+from access1581.bitstream import BitBuffer, BitPattern, TrackDecompressor, padPendingBits
+from access1581.capturefile import CaptureFileReader, CaptureFileWriter, defaultCaptureFile, loadRawTracks
 from access1581.diskformats import *
+from access1581.formatdetection import detectDiskFormat
+from access1581.imagefile import ImageFileWriter, loadBadSectorMap, saveBadSectorMap
+from access1581.mfm import mfmDecodeBytes
+from access1581.pipeline import PipelinedDiskCapture
+from access1581.scheduler import TrackScheduler
+
+trackDecompressor = TrackDecompressor()
+
+def isBlankTrack(diskFormat, compressedTrackData):
+    '''
+    an unformatted or erased track has no sync bytes a1a1a1 at all. their
+    interval codes are searched in the compressed track data directly, at
+    the offsets where a code starts
+    '''
+    syncOffsets = BitBuffer(compressedTrackData).finditer( diskFormat.getCompressedSyncPattern() )
+    return not any( offset & 1 == 0 for offset in syncOffsets )
+
+def decodeCompressedTrack(diskFormat, compressedTrackData, wantedSectors = None):
+    '''
+    decompresses and parses one track without any crc validation. lives on
+    module level so that it can also be handed over to a process pool
+    '''
+    if isBlankTrack(diskFormat, compressedTrackData):
+        return []
+    parser = SingleIBMTrackSectorParser(diskFormat, None)
+    return parser.parseBitstream( trackDecompressor.decompressToBitBuffer(compressedTrackData), wantedSectors )
 
 class IBMDoubleDensityFloppyDiskImager:
     '''
     loops over all 80 tracks using both heads
-    and collects all the sector data of all tracks
-    to store it into an image file
+    and writes the sector data of each track
+    into the image file as soon as it is complete.
+    selection limits the work to some tracks and sectors: a dict
+    (track, head) -> set of sector numbers (None for the whole track). an
+    existing image is patched in place then. repair reads the sectors listed
+    in the bad sector map next to the image again. sectors that stay bad are
+    written to the bad sector map <image>.badsectors
+    a record of every finished track is handed to instrumentation, profiler
+    is started for the read loop (see instrumentation). the disk format is
+    detected from the first track if diskFormat is None, a given one is
+    checked against the disk unless detectFormat is False. without
+    imagename the image is named after the disk format. streaming decodes
+    the tracks while they are being read. an emulated Arduino answers at
+    once if realtime is False
     '''
-    def __init__( self, diskFormat, imagename, retries, serialDevice, storeBitstream = False, stopOnError=False):
+    def __init__( self, diskFormat, imagename, retries, serialDevice, storeBitstream = False, stopOnError=False, pipelined = False, decodeWorkers = 2, useProcesses = False, revolutions = 1, resume = False, selection = None, repair = False, trackOrder = "sequential", deferRetries = False, decodePool = None, instrumentation = None, profiler = None, detectFormat = True, streaming = False, realtime = True):
         print ("pyAccess1581 - Copyright (C) 2019  Henning Pingel")
         print ("Reusing: Arduino Amiga Floppy Disk Reader/Writer Firmware - Copyright (C) 2019  Robert Smith")
-        print ("Selected disk format is " + diskFormat.name + ", we expect " + str(diskFormat.expectedSectorsPerTrack) + " sectors per track")
-        print ("Target image file is: " + imagename)
         print ("Serial device is: " + serialDevice)
-
-        image = b''
-        trackData = {}
-        rawTracks = {}
-        trackLength = diskFormat.expectedSectorsPerTrack * diskFormat.sectorSize
-        if serialDevice == "simulated":
-            with open('raw_debug_image_d81.py', 'r') as f:
-                rawTrackData = ast.literal_eval(f.read())
-            self.arduino = ArduinoSimulator(diskFormat, rawTrackData)
+        self.serialDevice = serialDevice
+        self.instrumentation = instrumentation
+        self.emulator = None
+
+        #the connection only needs the track range, which all formats share
+        connectionFormat = diskFormat if diskFormat is not None else getDiskFormat(defaultDiskType)
+        if serialDevice == "emulated" or serialDevice.startswith("emulated:"):
+            #the real serial code talks to an emulated Arduino via a pty,
+            #pseudo terminals only exist on Unix
+            from access1581.emulator import loadEmulatedDisk
+            self.emulator = loadEmulatedDisk(serialDevice, connectionFormat, realtime)
+            self.arduino = ArduinoFloppyControlInterface(self.emulator.start(), connectionFormat)
+            print ("Emulated Arduino is listening on " + self.emulator.devicePath + ("" if realtime is True else ", answering without the timing of the drive"))
+        elif serialDevice == "simulated" or serialDevice.endswith(".cap"):
+            captureFileName = defaultCaptureFile if serialDevice == "simulated" else serialDevice
+            if os.path.exists(captureFileName):
+                #only header and index are read here, tracks are decompressed on demand
+                rawTrackData = CaptureFileReader(captureFileName)
+                if storeBitstream is True and captureFileName == defaultCaptureFile:
+                    print ("Not storing raw track data, the simulation replays " + defaultCaptureFile + " already")
+                    storeBitstream = False
+            else:
+                print ("Notice: " + captureFileName + " not found, loading the old bitstream dump instead. Convert it with 'python -m access1581.capturefile' for a faster start.")
+                rawTrackData = loadRawTracks('raw_debug_image_d81.py')
+            self.arduino = ArduinoSimulator(connectionFormat, rawTrackData)
         else:
-            self.arduino = ArduinoFloppyControlInterface(serialDevice, diskFormat)
-        self.arduino.openSerialConnection()
-
-        vldtr = SingleTrackSectorListValidator( retries, diskFormat, self.arduino, storeBitstream, stopOnError )
-        for trackno in diskFormat.trackRange:
-            trackData[ trackno ] = {}
-            rawTracks[ trackno ] = {}
-            for headno in diskFormat.headRange:
-                trackDataTmp = vldtr.processTrack( trackno, headno )
-                if not len(trackDataTmp) == trackLength:
-                    print ("ERROR track should have " + str(trackLength) + " bytes but has " + str(len(trackData)))
-                trackData[ trackno ][ headno ] = trackDataTmp
-                image += trackData[ trackno ][ headno ]
-                if storeBitstream is True:
-                    rawTracks[trackno][headno] = vldtr.getDecompressedBitstream()
-        print ("Writing image to file " + imagename)
-        with open(imagename, 'wb') as f:
-            f.write( image)
-        result = hashlib.md5(image)
-        print("MD5   : " + result.hexdigest())
-        result = hashlib.sha1(image)
-        print("SHA1  : " + result.hexdigest())
-        result = hashlib.sha256(image)
-        print("SHA256: " + result.hexdigest())
-
-        if storeBitstream is True:
-            print ("Storing bitstream on disk")
-            with open('raw_debug_image_d81.py', "w") as f:
-                f.write(repr(rawTracks))
-        vldtr.printSerialStats()
+            self.arduino = ArduinoFloppyControlInterface(serialDevice, connectionFormat)
+        try:
+            self.arduino.openSerialConnection()
+            if diskFormat is None or detectFormat is True:
+                #a wrong disk format would only show up as bad sectors on every track
+                diskFormat = detectDiskFormat(self.arduino, diskFormat)
+            if imagename is None:
+                imagename = "image_" + diskFormat.name + "." + diskFormat.imageExtension
+            self.diskFormat = diskFormat
+            self.imagename = imagename
+            print ("Selected disk format is " + diskFormat.name + ", we expect " + str(diskFormat.expectedSectorsPerTrack) + " sectors per track")
+            print ("Target image file is: " + imagename)
+
+            badSectorMapName = imagename + '.badsectors'
+            badSectors = loadBadSectorMap(badSectorMapName)
+            if repair is True:
+                selection = { track: badSectors[track] for track in badSectors }
+                print ("Repairing " + str(sum( len(selection[track]) for track in selection )) + " bad sectors on " + str(len(selection)) + " tracks listed in " + badSectorMapName)
+            patch = selection is not None and os.path.exists(imagename)
+            if selection is not None and patch is False:
+                #a new image would look complete with only the selection filled in
+                if repair is True:
+                    raise Exception("Error: can't repair " + imagename + ", the image file doesn't exist")
+                if any( selection[track] is not None for track in selection ):
+                    raise Exception("Error: single sectors can only be read into an existing image file, " + imagename + " doesn't exist")
+                print ("Notice: " + imagename + " doesn't exist, a new image is written and the tracks that are not selected stay incomplete")
+            self.trackLength = diskFormat.expectedSectorsPerTrack * diskFormat.sectorSize
+            if streaming is True:
+                if pipelined is True:
+                    print ("Notice: Pipelined capture decodes in its workers, --streaming is ignored")
+                    streaming = False
+                elif revolutions > 1:
+                    print ("Notice: Only single revolution reads can be decoded while streaming, --streaming is ignored")
+                    streaming = False
+                else:
+                    print ("Track data is decoded while it arrives from the Arduino")
+
+            vldtr = SingleTrackSectorListValidator( retries, diskFormat, self.arduino, storeBitstream, stopOnError, revolutions, streaming )
+            if revolutions > 1:
+                if pipelined is True:
+                    print ("Notice: Pipelined capture reads a single revolution per track read")
+                else:
+                    print ("Reading " + str(revolutions) + " revolutions per track read")
+            if storeBitstream is True:
+                print ("Storing raw track data in capture file " + defaultCaptureFile)
+                captureFile = CaptureFileWriter(defaultCaptureFile, diskFormat.name, retries)
+            print ( ("Patching image file " if patch is True else "Writing image to file ") + imagename )
+            imageFile = ImageFileWriter(imagename, diskFormat, resume, patch)
+            if selection is None:
+                selection = { track: None for track in imageFile.getMissingTracks() }
+            jobs = [ (trackno, headno) for trackno in diskFormat.trackRange for headno in diskFormat.headRange if (trackno, headno) in selection ]
+            scheduler = TrackScheduler(
+                self.arduino,
+                lambda: SingleTrackSectorListValidator( retries, diskFormat, self.arduino, storeBitstream, stopOnError, revolutions, streaming ),
+                retries,
+                trackOrder,
+                deferRetries
+            )
+            if trackOrder != "sequential" or deferRetries is True:
+                print ("Reading tracks in " + trackOrder + " order" + (", retries are deferred to later sweeps" if deferRetries is True else ""))
+            with profiler if profiler is not None else contextlib.nullcontext():
+                if pipelined is True:
+                    if deferRetries is True:
+                        print ("Notice: Pipelined capture schedules its retries itself, --defer-retries is ignored")
+                    print ("Pipelined capture with " + str(decodeWorkers) + " decode " + ("processes" if useProcesses is True else "threads"))
+                    capture = PipelinedDiskCapture(
+                        self.arduino,
+                        lambda: SingleTrackSectorListValidator( retries, diskFormat, None, storeBitstream, stopOnError ),
+                        functools.partial(decodeCompressedTrack, diskFormat),
+                        vldtr.trackParser.getPhysicalHead,
+                        retries,
+                        decodeWorkers,
+                        useProcesses,
+                        pool = decodePool
+                    )
+                    for (trackno, headno, trackVldtr, compressedTrackData, attempt) in capture.run(scheduler.order(jobs), selection):
+                        badSectors[ (trackno, headno) ] = self.storeTrack(imageFile, trackVldtr, trackno, headno, badSectors.get( (trackno, headno), set() ))
+                        self.emitTrackRecord(trackVldtr, trackno, headno)
+                        if storeBitstream is True:
+                            captureFile.addTrack(trackno, vldtr.trackParser.getPhysicalHead(headno), compressedTrackData, attempt)
+                else:
+                    for (trackno, headno, trackVldtr) in scheduler.run(jobs, selection):
+                        badSectors[ (trackno, headno) ] = self.storeTrack(imageFile, trackVldtr, trackno, headno, badSectors.get( (trackno, headno), set() ))
+                        self.emitTrackRecord(trackVldtr, trackno, headno)
+                        if storeBitstream is True:
+                            captureFile.addTrack(trackno, vldtr.trackParser.getPhysicalHead(headno), self.arduino.getLastCompressedTrackData(), trackVldtr.getReadAttempts())
+            imageFile.close()
+            saveBadSectorMap(badSectorMapName, badSectors)
+            remainingBadSectors = sum( len(badSectors[track]) for track in badSectors )
+            #summary for callers that run several imagers (see farm)
+            self.trackCount = len(jobs)
+            self.badSectorCount = remainingBadSectors
+            if remainingBadSectors > 0:
+                print ("Notice: " + str(remainingBadSectors) + " bad sectors are listed in " + badSectorMapName + ", read them again with --repair")
+
+            if storeBitstream is True:
+                captureFile.close()
+            vldtr.printSerialStats()
+            if pipelined is True:
+                capture.printStats()
+            else:
+                scheduler.printStats()
+        finally:
+            self.closeConnection()
+
+    def closeConnection(self):
+        '''
+        rewinds the drive, switches the motor off and shuts down an emulated
+        Arduino
+        '''
+        self.arduino.closeSerialConnection()
+        if self.emulator is not None:
+            self.emulator.stop()
+            self.emulator = None
+
+    def storeTrack(self, imageFile, vldtr, trackno, headno, previousBadSectors):
+        '''
+        writes the sectors read by the validator into the image and returns
+        the updated set of bad sectors of the track
+        '''
+        if vldtr.isCompleteTrackWanted() is True:
+            trackData = vldtr.assembleTrackData()
+            self.checkTrackLength(trackData)
+            if len(trackData) == self.trackLength:
+                imageFile.writeTrack(trackno, headno, trackData)
+            else:
+                #keep at least the sectors that were found
+                imageFile.writeSectors(trackno, headno, vldtr.getValidSectorData())
+            return vldtr.getBadSectors()
+        imageFile.writeSectors(trackno, headno, vldtr.getValidSectorData())
+        return (previousBadSectors - vldtr.wantedSectors) | vldtr.getBadSectors()
+
+    def emitTrackRecord(self, vldtr, trackno, headno):
+        if self.instrumentation is None:
+            return
+        record = { "drive": self.serialDevice }
+        record.update( vldtr.getTrackRecord(trackno, headno) )
+        self.instrumentation.emit(record)
+
+    def checkTrackLength(self, trackData):
+        if not len(trackData) == self.trackLength:
+            print ("ERROR track should have " + str(self.trackLength) + " bytes but has " + str(len(trackData)))
 
 class SingleTrackSectorListValidator:
     '''
     asks track reader to read a specific track from disk (processTrack). gets
     structured data of all found sectors of one track. validates crc values and
-    manages optional read retries.
+    manages optional read retries. with streaming set, single revolution
+    reads are decoded while the track data arrives (StreamingTrackDecoder).
     '''
-    def __init__(self, retries, diskFormat, arduinoInterface, storeBitstream = False, stopOnError = False):
+    def __init__(self, retries, diskFormat, arduinoInterface, storeBitstream = False, stopOnError = False, revolutions = 1, streaming = False):
         self.maxRetries = retries
+        self.revolutions = max(1, revolutions)
+        self.streaming = streaming is True and self.revolutions == 1
         self.diskFormat = diskFormat
         self.minSectorNumber = 1
         self.validSectorData = {}
         self.storeBitstream = storeBitstream
-        self.decompressedBitstream = ""
+        self.decompressedBitstream = BitBuffer()
         self.arduino = arduinoInterface
         self.trackParser = SingleIBMTrackSectorParser(self.diskFormat, self.arduino)
         self.stopOnError = stopOnError
         self.printSectorDebugInfo = False
+        self.readAttempts = 0
+        #sector data with failed crc check of all reads, per sector number
+        self.sectorCandidates = {}
+        #sectors only added with failed crc check
+        self.badSectors = set()
+        #sector numbers to read, None for the complete track
+        self.wantedSectors = None
+        #set if the first read found no sync bytes at all
+        self.blankTrack = False
+        self.trackStats = {}
 
     def printSerialStats(self):
         self.trackParser.printSerialStats()
 
     def processTrack(self, trackno, headno):
-        trackData = b''
+        self.readTrack(trackno, headno)
+        return self.assembleTrackData()
+
+    def startTrack(self, wantedSectors = None):
+        '''
+        forgets everything about the previous track. if wantedSectors is
+        given, only these sector numbers are read
+        '''
         self.validSectorData = {}
-        self.retries = self.maxRetries
-        while self.retries > 0:
-            if self.retries < self.maxRetries:
-                print ("  Repeat track read - attempt " + str( self.maxRetries - self.retries +1 ) + " of " + str(self.maxRetries) )
-            self.addValidSectors( self.trackParser.detectSectors(trackno, headno), trackno, headno, (self.retries == 1))
+        self.sectorCandidates = {}
+        self.badSectors = set()
+        self.wantedSectors = None if wantedSectors is None else set(wantedSectors)
+        self.readAttempts = 0
+        self.blankTrack = False
+        self.trackStats = {
+            "read_latency"   : 0,
+            "bytes_received" : 0,
+            "decode_time"    : 0,
+            "crc_failures"   : 0,
+            "marker_offsets" : []
+        }
+
+    def readTrack(self, trackno, headno, wantedSectors = None):
+        '''
+        reads the track until all wanted sectors are valid or all retries are
+        used, the collected sectors are kept in validSectorData
+        '''
+        self.startTrack(wantedSectors)
+        while self.readAttempts < self.maxRetries:
+            self.readAttempt(trackno, headno, self.readAttempts + 1 == self.maxRetries)
+            if self.isTrackComplete() is True:
+                break
+
+    def readAttempt(self, trackno, headno, lastChance):
+        '''
+        a single track read request (one or several revolutions) for the
+        sectors still missing. with lastChance set, sectors that never passed
+        the crc check are added anyway
+        '''
+        self.readAttempts += 1
+        wantedSectors = self.wantedSectors
+        if self.readAttempts > 1:
+            print ("  Repeat track read - attempt " + str( self.readAttempts ) + " of " + str(self.maxRetries) )
+            #sectors recovered by earlier reads don't need to be decoded again
+            wantedSectors = self.getMissingSectors()
+        starttime = time.time()
+        if self.streaming is True:
+            readLatency = self.readStreamed(trackno, headno, wantedSectors, lastChance)
+            self.recordRead( readLatency, self.arduino.lastReadBytes, time.time() - starttime - readLatency )
+            self.printTrackStatus(trackno, headno)
+            return
+        revolutionData = self.trackParser.readCompressedRevolutions(trackno, headno, self.revolutions)
+        bitstreams = []
+        if self.checkBlankTrack( revolutionData[-1] ) is True:
+            #nothing to decompress or parse and no reason to read the track again
+            self.decompressedBitstream = BitBuffer()
+        else:
+            bitstreams = [ self.arduino.decompressTrackData(compressedBytes) for compressedBytes in revolutionData ]
+        for (revolution, bitstream) in enumerate(bitstreams):
+            lastRevolution = lastChance and revolution == len(bitstreams) - 1
+            self.addValidSectors( self.trackParser.parseBitstream(bitstream, wantedSectors), trackno, headno, lastRevolution )
             #also make raw stream accessible for debug or other purposes
-            self.decompressedBitstream = self.trackParser.getDecompressedBitstream()
-            vsc = len(self.validSectorData)
+            self.decompressedBitstream = bitstream
+            if self.isTrackComplete() is True:
+                break
+            wantedSectors = self.getMissingSectors()
+        #everything but waiting for the Arduino is decoding
+        self.recordRead( self.arduino.lastReadDuration, self.arduino.lastReadBytes, time.time() - starttime - self.arduino.lastReadDuration )
+        self.printTrackStatus(trackno, headno)
+
+    def readStreamed(self, trackno, headno, wantedSectors, lastChance):
+        '''
+        a single revolution read that validates each sector as soon as it
+        has arrived, the decoding is done while the disk keeps turning.
+        returns the time spent waiting for the track data
+        '''
+        decoder = StreamingTrackDecoder(
+            self.trackParser,
+            wantedSectors,
+            lambda sectorprops: self.addStreamedSector(sectorprops, trackno, headno),
+            self.arduino.decompressor
+        )
+        self.arduino.streamCompressedTrackData(trackno, self.trackParser.getPhysicalHead(headno), decoder.feed)
+        self.decompressedBitstream = decoder.getBitstream()
+        if self.checkBlankTrack( self.arduino.getLastCompressedTrackData() ) is False and lastChance is True:
+            self.addValidSectors([], trackno, headno, True)
+        return self.arduino.lastReadDuration - decoder.duration
+
+    def addStreamedSector(self, sectorprops, trackno, headno):
+        self.addValidSectors([sectorprops], trackno, headno, False)
+        return self.isTrackComplete()
+
+    def checkBlankTrack(self, compressedTrackData):
+        '''
+        the first read of a track tells if it is blank, such a track counts
+        as complete, retries would only find nothing again
+        '''
+        if self.readAttempts == 1 and len(self.validSectorData) == 0 and isBlankTrack(self.diskFormat, compressedTrackData):
+            self.blankTrack = True
+        return self.blankTrack
+
+    def printTrackStatus(self, trackno, headno):
+        vsc = len(self.validSectorData)
+        if self.blankTrack is True:
+            print (f"Reading track: {trackno:2d}, head: {headno}. Track is blank, no sync marks found")
+        elif self.wantedSectors is not None:
+            print (f"Reading track: {trackno:2d}, head: {headno}. Number of valid sectors found: {vsc}/{len(self.wantedSectors)} (sectors {','.join(str(n) for n in sorted(self.wantedSectors))})")
+        else:
             print (f"Reading track: {trackno:2d}, head: {headno}. Number of valid sectors found: {vsc}/{self.diskFormat.expectedSectorsPerTrack}")
-            if vsc == self.diskFormat.expectedSectorsPerTrack:
-                self.retries = 0
-            else:
-                self.retries = self.retries -1
-        if len(self.validSectorData) == self.diskFormat.expectedSectorsPerTrack:
-            for sectorno in sorted(self.validSectorData):
-                if not len(self.validSectorData[sectorno]) == self.diskFormat.sectorSize * 2:
+
+    def isTrackComplete(self):
+        if self.blankTrack is True:
+            return True
+        return len(self.getMissingSectors()) == 0
+
+    def getMissingSectors(self):
+        if self.wantedSectors is not None:
+            return self.wantedSectors - set( self.validSectorData )
+        return set( range(self.minSectorNumber, self.diskFormat.expectedSectorsPerTrack + 1) ) - set( self.validSectorData )
+
+    def getValidSectorData(self):
+        return self.validSectorData
+
+    def isCompleteTrackWanted(self):
+        return self.wantedSectors is None
+
+    def getBadSectors(self):
+        '''
+        sectors that are missing or were only added with failed crc check.
+        a blank track has none, it is filled with zeros
+        '''
+        if self.blankTrack is True:
+            return set()
+        return self.badSectors | self.getMissingSectors()
+
+    def assembleTrackData(self):
+        '''
+        joins the collected sectors of the current track in sector order,
+        every sector number has its own slot of the track
+        '''
+        trackData = b''
+        sectorNumbers = range(self.minSectorNumber, self.diskFormat.expectedSectorsPerTrack + 1)
+        if all( sectorno in self.validSectorData for sectorno in sectorNumbers ):
+            for sectorno in sectorNumbers:
+                if not len(self.validSectorData[sectorno]) == self.diskFormat.sectorSize:
                     print("  Invalid sector data length." + str(len(self.validSectorData[sectorno])) )
-                #print ("Adding sector no " + str(sectorno))
-                trackData += binascii.unhexlify(self.validSectorData[sectorno])
+            trackData = b''.join( self.validSectorData[sectorno] for sectorno in sectorNumbers )
         elif len(self.validSectorData) == 0:
-            trackData = bytes(chr(0) * self.diskFormat.sectorSize * self.diskFormat.expectedSectorsPerTrack ,'utf-8')
-            #print ("bytes: " + str(len(trackData)))
+            trackData = bytes( self.diskFormat.sectorSize * self.diskFormat.expectedSectorsPerTrack )
             print("  Notice: Filled up empty track with zeros.");
         else:
             print("  Not enough sectors found.");
@@ -137,6 +441,9 @@ class SingleTrackSectorListValidator:
     def getDecompressedBitstream(self):
         return self.decompressedBitstream
 
+    def getReadAttempts(self):
+        return self.readAttempts
+
     def getCRC(self, data):
         '''
         to calculate crc, we can either use binascii.crc_hqx(data, value) or crcmod
@@ -144,14 +451,44 @@ class SingleTrackSectorListValidator:
 
         the following code works fine with crcmod:
         xmodem_crc_func = crcmod.predefined.mkCrcFun('crc-ccitt-false')
-        return hex(xmodem_crc_func( binascii.unhexlify(data)))[2:].zfill(4)
+        return xmodem_crc_func(data).to_bytes(2, 'big')
         '''
-        return hex(binascii.crc_hqx(binascii.unhexlify(data), 0xffff))[2:].zfill(4)
+        return binascii.crc_hqx(data, 0xffff).to_bytes(2, 'big')
+
+    def getCRCResidue(self, *chunks):
+        '''
+        crc over the chunks one after the other without joining them. run
+        over the data followed by its crc, the result is 0 if the data is
+        intact, so no crc has to be converted for a comparison
+        '''
+        crc = 0xffff
+        for chunk in chunks:
+            crc = binascii.crc_hqx(chunk, crc)
+        return crc
+
+    def isValidHeader(self, sectorprops):
+        '''
+        the header crc is fine and the sector number belongs to the track
+        '''
+        return self.getCRCResidue( sectorprops["headermeta"], sectorprops["crc_header"] ) == 0 and \
+            self.minSectorNumber <= sectorprops["sectorno"] <= self.diskFormat.expectedSectorsPerTrack
 
     def isValidCRC(self, sectorprops):
-        crc_data_check   = sectorprops["crc_data"] == self.getCRC( sectorprops["datameta"] + sectorprops["data"] )
-        crc_header_check = sectorprops["crc_header"] == self.getCRC( sectorprops["headermeta"])
-        return (crc_header_check and crc_data_check)
+        return self.getCRCResidue( sectorprops["headermeta"], sectorprops["crc_header"] ) == 0 and \
+            self.getCRCResidue( sectorprops["datameta"], sectorprops["data"], sectorprops["crc_data"] ) == 0
+
+    def checkSectorCRCs(self, sectors):
+        '''
+        checks header and data crc of all sectors of a parsed track in one go,
+        returns a bitmap with bit n set if sectors[n] is valid
+        '''
+        residue = self.getCRCResidue
+        bitmap = 0
+        for (index, sectorprops) in enumerate(sectors):
+            if residue( sectorprops["headermeta"], sectorprops["crc_header"] ) == 0 and \
+                residue( sectorprops["datameta"], sectorprops["data"], sectorprops["crc_data"] ) == 0:
+                bitmap |= 1 << index
+        return bitmap
 
     def handleError(self, msg, sectorprops):
         if self.stopOnError is True:
@@ -162,10 +499,35 @@ class SingleTrackSectorListValidator:
             print ("  Error: " + msg)
             self.printSectorDebugInfo = True
 
+    def recordRead(self, readLatency, bytesReceived, decodeTime):
+        self.trackStats["read_latency"] += readLatency
+        self.trackStats["bytes_received"] += bytesReceived
+        self.trackStats["decode_time"] += decodeTime
+
+    def getTrackRecord(self, trackno, headno):
+        '''
+        the instrumentation record of the current track, see instrumentation
+        '''
+        record = { "track": trackno, "head": headno, "timestamp": time.time(), "attempts": self.readAttempts, "retries": max(0, self.readAttempts - 1) }
+        record.update(self.trackStats)
+        record["blank"] = self.blankTrack
+        record["sectors_recovered"] = len(self.validSectorData)
+        record["bad_sectors"] = sorted(self.getBadSectors())
+        return record
+
     def addValidSectors(self, sectors, t, h, lastChance):
         self.printSectorDebugInfo = False
         printDebug = False
         for sectorprops in sectors:
+            if "offset" in sectorprops and "marker_offsets" in self.trackStats:
+                self.trackStats["marker_offsets"].append( sectorprops["offset"] )
+        #sectors recovered by an earlier read already need no check
+        sectors = [ sectorprops for sectorprops in sectors if not sectorprops["sectorno"] in self.validSectorData ]
+        validSectors = self.checkSectorCRCs(sectors)
+        for (index, sectorprops) in enumerate(sectors):
+            if sectorprops["sectorno"] in self.validSectorData:
+                #the same sector was found twice in this read
+                continue
             isSameTrack = True if sectorprops['trackno'] == t else False
             isSameHead  = True if sectorprops['sideno'] == h else False
 
@@ -177,25 +539,63 @@ class SingleTrackSectorListValidator:
                 int(sectorprops["sectorno"]) > self.diskFormat.expectedSectorsPerTrack:
                 self.handleError( "Sector number is out of expected bounds: "+ str(sectorprops["sectorno"]),sectorprops )
 
-            crcCheck = self.isValidCRC(sectorprops)
-            if not sectorprops["sectorno"] in self.validSectorData:
-                if not sectorprops["sectorlength"] == 2:
-                    self.handleError("Detected a non-512 byte sector length!",sectorprops)
-                if crcCheck is False and lastChance is True:
-                    print (f'  Invalid CRC for sector found, but adding sector data anyway: Head {h}, Track {t}, sector #{sectorprops["sectorno"]}')
-                    self.printSectorDebugInfo = True
-                if crcCheck is True or lastChance is True:
-                    self.validSectorData[ sectorprops["sectorno"] ] = sectorprops["data"]
+            crcCheck = validSectors >> index & 1 == 1
+            if not sectorprops["sectorlength"] == 2:
+                self.handleError("Detected a non-512 byte sector length!",sectorprops)
+            if crcCheck is False:
+                self.trackStats["crc_failures"] = self.trackStats.get("crc_failures", 0) + 1
+            #the sector number of a damaged header can't tell the slot of the data
+            validHeader = self.isValidHeader(sectorprops)
+            if crcCheck is True and validHeader is True:
+                self.validSectorData[ sectorprops["sectorno"] ] = sectorprops["data"]
+            elif validHeader is True:
+                self.sectorCandidates.setdefault( sectorprops["sectorno"], [] ).append( sectorprops )
             #self.printSectorDebugInfo = True
 
             if self.printSectorDebugInfo is True:
                 self.printSectorDebugOutput(sectorprops, crcCheck)
+        if lastChance is True:
+            self.addBestCandidates(t, h)
+
+    def addBestCandidates(self, t, h):
+        '''
+        fills in the sectors that never passed the crc check with the best
+        guess over all reads of the track
+        '''
+        for sectorno in sorted(self.sectorCandidates):
+            if sectorno in self.validSectorData:
+                continue
+            candidates = self.sectorCandidates[sectorno]
+            sectorprops = self.voteSectorData(candidates)
+            crcCheck = self.isValidCRC(sectorprops)
+            if crcCheck is True:
+                print (f'  Recovered sector by majority vote over {len(candidates)} reads: Head {h}, Track {t}, sector #{sectorno}')
+            else:
+                print (f'  Invalid CRC for sector found, but adding sector data anyway: Head {h}, Track {t}, sector #{sectorno}')
+                self.printSectorDebugOutput(sectorprops, crcCheck)
+                self.badSectors.add(sectorno)
+            self.validSectorData[ sectorno ] = sectorprops["data"]
+
+    def voteSectorData(self, candidates):
+        '''
+        merges several damaged reads of a sector by a majority vote per byte
+        of data and crc, on a tie the most recent read wins
+        '''
+        if len(candidates) == 1:
+            return candidates[0]
+        columns = zip( *[ c["data"] + c["crc_data"] for c in reversed(candidates) ] )
+        voted = bytes( max( column, key=column.count ) for column in columns )
+        sectorprops = dict( candidates[-1] )
+        sectorprops["data"] = voted[:-2]
+        sectorprops["crc_data"] = voted[-2:]
+        return sectorprops
 
     def printSectorDebugOutput(self, sectorprops, crcCheck):
         infostring =""
         for prop in sectorprops:
             if prop != "datameta" and prop != "data" and prop != "headermeta":
-                infostring += prop + ":" + str(sectorprops[prop]) + ", "
+                value = sectorprops[prop]
+                infostring += prop + ":" + (value.hex() if isinstance(value, bytes) else str(value)) + ", "
         infostring += "CRC check "
         infostring += "FAILED" if crcCheck is False else "SUCCESSFUL"
         print ("  DEBUGINFO - Sector properties: "+ infostring)
@@ -210,120 +610,218 @@ class SingleIBMTrackSectorParser:
         self.diskFormat = diskFormat
         self.arduino = arduinoFloppyControlInterface
         self.sectorDataBitSize = self.diskFormat.sectorSize * 16
-        self.decompressedBitstream = ""
-        self.sectorStartMarkerLength = len(self.diskFormat.sectorStartMarker)
+        self.decompressedBitstream = BitBuffer()
+        #both address mark patterns end with the mark byte (fe or fb), what
+        #comes before is the gap and the sync bytes a1a1a1
+        (self.sectorStartPattern, self.syncPattern) = self.diskFormat.getMarkerPatterns()
+        self.addressMarkLength = len(self.diskFormat.mfmFE)
+        self.idAddressMark = int(self.diskFormat.mfmFE, 2)
+        self.dataAddressMark = int(self.diskFormat.mfmFB, 2)
+        if not self.diskFormat.sectorStartMarker[:-self.addressMarkLength].endswith(self.syncPattern.bitString):
+            raise Exception("Sector start marker and sector data start marker need to share the sync bytes")
         self.firstSectorOffset = -1
+        self.pendingSectorMarker = -1
 
-    def detectSectors(self, trackno, headno):
+    def detectSectors(self, trackno, headno, wantedSectors = None):
+        return self.parseBitstream( self.arduino.getDecompressedBitstream(trackno, self.getPhysicalHead(headno)), wantedSectors )
+
+    def readCompressedRevolutions(self, trackno, headno, revolutions):
+        '''
+        reads one or several consecutive revolutions of a track with a
+        single read request and returns their compressed track data, which
+        the Arduino interface decompresses (decompressTrackData)
+        '''
+        if revolutions == 1:
+            return [ self.arduino.getCompressedTrackData(trackno, self.getPhysicalHead(headno)) ]
+        return self.arduino.getCompressedRevolutions(trackno, self.getPhysicalHead(headno), revolutions)
+
+    def getPhysicalHead(self, headno):
+        return self.diskFormat.getPhysicalHead(headno)
+
+    def parseBitstream(self, bitstream, wantedSectors = None):
+        '''
+        if wantedSectors is given, only the sectors with these numbers are
+        decoded completely, all others are skipped after their header
+        '''
         self.firstSectorOffset = -1
-        cnt = 0
+        self.decompressedBitstream = bitstream
         sectors = []
-        if self.diskFormat.swapsides is False:
-            headno = 1 if headno == 0 else 0
-        self.decompressedBitstream = self.arduino.getDecompressedBitstream(trackno, headno)
-        (sectorMarkers, dataMarkers) = self.getMarkers()
-        for sectorStart in sectorMarkers:
-            if len(dataMarkers) <= cnt:
-                pass
-            elif dataMarkers[cnt] <= sectorStart:
-                print ("Datamarker is being ignored. " + str( dataMarkers[cnt] ) + " " + str(sectorStart))
-            else:
-                sectors.append(self.parseSingleSector(sectorStart, dataMarkers[cnt]))
-            cnt += 1
+        for (sectorStart, dataMarker) in self.getMarkers():
+            sectorprops = self.parseSingleSector(sectorStart, dataMarker, wantedSectors)
+            if sectorprops is not None:
+                sectors.append(sectorprops)
         return sectors
 
     def getDecompressedBitstream(self):
         return self.decompressedBitstream
 
-    def mfmDecode(self, stream):
-        result = ""
-        keep = False;
-        for char in stream:
-            if keep is True:
-                result += char
-            keep = not keep
-        return result
-
-    def convertBitstreamBytes( self, data, flagHexInt ):
-        if data is "":
-            return ""
-        ba = bitstring.BitArray('0b'+data )
-        return ba.hex if flagHexInt is True else ba.int
-
-    def grabSectorChunkHex( self, start, length):
-        return self.convertBitstreamBytes( self.mfmDecode( self.currentSectorBitstream[ start: start+length ]), True)
-
-    def grabSectorChunkInt( self, start, length):
-        sfrom = start*8
-        sto = sfrom + length*8
-        return self.convertBitstreamBytes( self.mfmDecode( self.currentSectorBitstream[ sfrom: sto ]), False)
+    def grabSectorChunk( self, start, byteCount):
+        return mfmDecodeBytes( self.currentSectorBitstream, start, byteCount )
 
     def getMarkers(self):
-        sectorMarkers = []
-        dataMarkers = []
-        dataMarkersTmp = []
-        rawSectors = re.split( self.diskFormat.sectorStartMarker, self.decompressedBitstream)
-        if len(rawSectors) > 0:
-            self.firstSectorOffset = len( rawSectors[0] )
-            del rawSectors[-1] #delete last entry
-            previousBits = 0
-            for rawSector in rawSectors:
-                previousBits += len( rawSector ) + self.sectorStartMarkerLength
-                sectorMarkers.append( previousBits )
-        if len(sectorMarkers) > 0:
-            dataMarkerMatchesIterator = re.finditer( self.diskFormat.sectorDataStartMarker, self.decompressedBitstream)
-            for dataMarker in dataMarkerMatchesIterator:
-                (startPosDataMarker, endPosDataMarker) = (dataMarker.span() )
-                if endPosDataMarker >= sectorMarkers[0] + self.diskFormat.legalOffsetRangeLowerBorder:
-                    dataMarkersTmp.append(endPosDataMarker)
-                #else:
-                #    print("Notice: Ignoring datamarker - is in front of first sector marker")
-            cnt = 0
-            for dataMarker in dataMarkersTmp:
-                offset = dataMarker - sectorMarkers[cnt]
-                if not offset in self.diskFormat.legalOffsetRange:
-                    print ("getMarkers / Unusual offset found: "+str(offset))
-                #now we check if the sector's data might be cut off at the end
-                #of the chunk of the track we have, the added 32 represents
-                #the length of the CRC checksum of the sector data
-                overshoot = dataMarker + self.sectorDataBitSize + 32
-                if overshoot <= len( self.decompressedBitstream ):
-                    dataMarkers.append( dataMarker )
-                    cnt+=1
-                else:
-                    #print("Removing sector marker because it overshot the bitstream")
-                    sectorMarkers.remove(sectorMarkers[cnt])
-        #print (sectorMarkers)
-        #print (dataMarkers)
-        return (sectorMarkers, dataMarkers)
+        '''
+        scans the bitstream once for the sync bytes a1a1a1 that both kinds of
+        address marks share and tells the ID address marks (fe) and the data
+        address marks (fb) apart by the bits that follow. returns the matching
+        pairs of end offsets of both marks.
+        '''
+        markerPairs = []
+        self.pendingSectorMarker = -1
+        bitstream = self.decompressedBitstream
+        for syncStart in bitstream.finditer(self.syncPattern):
+            if syncStart + self.syncPattern.length + self.addressMarkLength > len(bitstream):
+                break
+            markerPair = self.checkAddressMark(bitstream, syncStart)
+            #now we check if the sector's data might be cut off at the end
+            #of the chunk of the track we have, the added 32 represents
+            #the length of the CRC checksum of the sector data
+            if markerPair is not None and markerPair[1] + self.sectorDataBitSize + 32 <= len(bitstream):
+                markerPairs.append(markerPair)
+        if self.firstSectorOffset == -1:
+            self.firstSectorOffset = len(bitstream)
+        return markerPairs
+
+    def checkAddressMark(self, bitstream, syncStart):
+        '''
+        looks at the address mark behind the sync bytes starting at syncStart.
+        an ID address mark is remembered, a data address mark at the right
+        distance to it returns the pair of end offsets of both marks
+        '''
+        markerEnd = syncStart + self.syncPattern.length + self.addressMarkLength
+        addressMark = bitstream.getBits(markerEnd - self.addressMarkLength, self.addressMarkLength)
+        if addressMark == self.idAddressMark:
+            #ID address marks are preceded by a longer gap than data marks
+            markerStart = markerEnd - self.sectorStartPattern.length
+            if markerStart < 0 or bitstream.getBits(markerStart, self.sectorStartPattern.length) != self.sectorStartPattern.value:
+                return None
+            if self.firstSectorOffset == -1:
+                self.firstSectorOffset = markerStart
+            self.pendingSectorMarker = markerEnd
+        elif addressMark == self.dataAddressMark and self.pendingSectorMarker != -1:
+            offset = markerEnd - self.pendingSectorMarker
+            if offset < self.diskFormat.legalOffsetRangeLowerBorder:
+                return None
+            if not offset in self.diskFormat.legalOffsetRange:
+                print ("getMarkers / Unusual offset found: "+str(offset))
+            markerPair = (self.pendingSectorMarker, markerEnd)
+            self.pendingSectorMarker = -1
+            return markerPair
+        return None
 
     def getFirstSectorOffset(self):
         if self.firstSectorOffset == -1:
             raise Exception("Don't call getFirstSectorOffset before parsing the track")
         return self.firstSectorOffset
 
-    def parseSingleSector(self, sectorStart, dataMarker):
+    def parseSingleSector(self, sectorStart, dataMarker, wantedSectors = None):
+        sectorprops = self.decodeSector( *self.cutSector(sectorStart, dataMarker), wantedSectors )
+        if sectorprops is not None:
+            sectorprops["offset"] = sectorStart
+        return sectorprops
+
+    def cutSector(self, sectorStart, dataMarker):
+        '''
+        returns the part of the bitstream holding the sector (without copying
+        it) and the offset of the data address mark within that part
+        '''
         prelude = 4 * 16 # a1a1a1fe or a1a1a1fb
         dataMarker = prelude + dataMarker - sectorStart
-        self.currentSectorBitstream = self.decompressedBitstream[sectorStart - prelude : sectorStart + self.sectorDataBitSize + 32 + dataMarker]
-        #rawMfmDecoded = self.mfmDecode( self.currentSectorBitstream)
-        #rdl = len(rawMfmDecoded)
-        #rawstream = self.convertBitstreamBytes( rawMfmDecoded[0:int(rdl/4)*4], True)
+        return (self.decompressedBitstream[sectorStart - prelude : sectorStart + self.sectorDataBitSize + 32 + dataMarker], dataMarker)
+
+    def decodeSector(self, sectorBitstream, dataMarker, wantedSectors = None):
+        prelude = 4 * 16
+        self.currentSectorBitstream = sectorBitstream
+        header = self.grabSectorChunk( 0, 10 ) #a1a1a1fe, track, side, sector, length, crc
+        if wantedSectors is not None and not header[6] in wantedSectors:
+            return None
+        dataChunk = self.grabSectorChunk( dataMarker - prelude, self.diskFormat.sectorSize + 6 ) #a1a1a1fb, data, crc
 
         return {
-            "headermeta"   : self.grabSectorChunkHex(  0, 128),#complete raw header data for crc check
-            "trackno"      : self.grabSectorChunkInt(  8,  2),
-            "sideno"       : self.grabSectorChunkInt( 10,  2),
-            "sectorno"     : self.grabSectorChunkInt( 12,  2),
-            "sectorlength" : self.grabSectorChunkInt( 15,  1),
-            "crc_header"   : self.grabSectorChunkHex( 128, 32),
-            "datameta"     : self.grabSectorChunkHex( dataMarker - prelude, prelude), #a1a1a1fb
-            "data"         : self.grabSectorChunkHex( dataMarker, self.sectorDataBitSize),
-            "crc_data"     : self.grabSectorChunkHex( dataMarker + self.sectorDataBitSize, 32)
+            "headermeta"   : header[0:8],#complete raw header data for crc check
+            "trackno"      : header[4],
+            "sideno"       : header[5],
+            "sectorno"     : header[6],
+            "sectorlength" : header[7],
+            "crc_header"   : header[8:10],
+            "datameta"     : dataChunk[0:4], #a1a1a1fb
+            "data"         : dataChunk[4:-2],
+            "crc_data"     : dataChunk[-2:]
         }
 
     def printSerialStats(self):
         (tdtr,tdtc,tdtd) = self.arduino.getStats()
         print ( "Total duration of all track reads   : " + tdtr + " seconds")
         print ( "Total duration other serial commands: " + tdtc + " seconds")
+        print ( "Serial commands sent                : " + str(self.arduino.commandsSent) + " in " + str(self.arduino.serialWrites) + " serial writes")
         print ( "Total duration of all decompressions: " + tdtd + " seconds")
+
+class StreamingTrackDecoder:
+    '''
+    decodes a track while its compressed data is still arriving from the
+    Arduino: feed takes the chunks as they come in. a byte holds four
+    complete interval codes, so every chunk is decompressed on its own and
+    only the new part of the bitstream is scanned for address marks. a
+    sector is decoded and handed to onSector as soon as the crc of its data
+    has arrived. if onSector returns True, no more sectors are wanted and
+    the rest of the revolution is only collected
+    '''
+    def __init__(self, parser, wantedSectors = None, onSector = None, decompressor = trackDecompressor):
+        self.parser = parser
+        self.wantedSectors = wantedSectors
+        self.onSector = onSector
+        self.decompressor = decompressor
+        self.sectors = []
+        self.bitstream = BitBuffer()
+        self.packedBits = bytearray()
+        #bits that don't fill a whole byte yet
+        self.pendingValue = 0
+        self.pendingCount = 0
+        #sync bytes starting here or later have not been looked at yet
+        self.scanPosition = 0
+        self.markerPairs = []
+        self.done = False
+        #time spent decoding within feed
+        self.duration = 0
+        parser.firstSectorOffset = -1
+        parser.pendingSectorMarker = -1
+
+    def feed(self, chunk):
+        if self.done is True:
+            return
+        starttime = time.time()
+        (packed, self.pendingValue, self.pendingCount) = self.decompressor.packBits(chunk, self.pendingValue, self.pendingCount)
+        self.packedBits += packed
+        self.bitstream = BitBuffer( bytes(self.packedBits) + padPendingBits(self.pendingValue, self.pendingCount), 0, (len(self.packedBits) << 3) + self.pendingCount )
+        self.scan()
+        self.duration += time.time() - starttime
+
+    def scan(self):
+        parser = self.parser
+        bitstream = self.bitstream
+        parser.decompressedBitstream = bitstream
+        #the address mark behind the sync bytes has to be there already
+        scanEnd = len(bitstream) - parser.addressMarkLength
+        for syncStart in bitstream.finditer(parser.syncPattern, self.scanPosition, scanEnd):
+            markerPair = parser.checkAddressMark(bitstream, syncStart)
+            if markerPair is not None:
+                self.markerPairs.append(markerPair)
+        self.scanPosition = max( self.scanPosition, scanEnd - parser.syncPattern.length + 1 )
+        #the added 32 represents the length of the crc of the sector data
+        while len(self.markerPairs) > 0 and self.markerPairs[0][1] + parser.sectorDataBitSize + 32 <= len(bitstream):
+            (sectorStart, dataMarker) = self.markerPairs.pop(0)
+            sectorprops = parser.parseSingleSector(sectorStart, dataMarker, self.wantedSectors)
+            if sectorprops is None:
+                continue
+            self.sectors.append(sectorprops)
+            if self.onSector is not None and self.onSector(sectorprops) is True:
+                self.done = True
+                break
+
+    def getBitstream(self):
+        '''
+        the bitstream decoded so far, it ends early if the decoding was done
+        before the end of the revolution
+        '''
+        if self.parser.firstSectorOffset == -1:
+            self.parser.firstSectorOffset = len(self.bitstream)
+        return self.bitstream
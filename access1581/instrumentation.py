@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    TRACK RECORDS
+
+    the imager emits one record (a dict) per finished track:
+        drive             serial device the track was read with
+        track, head       logical track and head number
+        timestamp         time the track was finished
+        attempts          number of track read requests
+        retries           attempts - 1
+        read_latency      seconds spent waiting for the track data
+        bytes_received    compressed bytes received from the Arduino
+        decode_time       seconds spent decompressing and parsing
+        blank             no sync marks found, the track was read only once
+        sectors_recovered number of sectors that made it into the image
+        bad_sectors       sector numbers that are missing or failed the crc
+        crc_failures      number of sector reads that failed the crc check
+        marker_offsets    bit offsets of the ID address marks of all reads
+
+'''
+
+import cProfile
+import io
+import json
+import pstats
+import threading
+import tracemalloc
+
+class Instrumentation:
+    '''
+    hands every track record to the registered hooks, a hook is any
+    callable taking the record. hooks with a close method are closed
+    together with the instrumentation
+    '''
+    def __init__(self):
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def emit(self, record):
+        #drives of a farm emit from their own threads
+        with self.lock:
+            for hook in self.hooks:
+                hook(record)
+
+    def close(self):
+        for hook in self.hooks:
+            if hasattr(hook, 'close'):
+                hook.close()
+
+class JsonLinesWriter:
+    '''
+    hook writing each record as one line of JSON
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+
+    def __call__(self, record):
+        self.file.write( json.dumps(record) + "\n" )
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class Profiler:
+    '''
+    opt-in profiling of the read loop: cProfile (results are written to
+    profilePath and the top entries are printed) and/or tracemalloc (the
+    lines that allocated most are printed). cProfile only sees the thread
+    that started it, the reader and decoder threads of a pipelined capture
+    are not covered
+    '''
+    def __init__(self, profilePath = None, traceMemory = False, topEntries = 15):
+        self.profilePath = profilePath
+        self.traceMemory = traceMemory
+        self.topEntries = topEntries
+        self.profile = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+    def start(self):
+        if self.traceMemory is True:
+            tracemalloc.start()
+        if self.profilePath is not None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profilePath)
+            output = io.StringIO()
+            pstats.Stats(self.profile, stream=output).sort_stats('cumulative').print_stats(self.topEntries)
+            print ("Profile written to " + self.profilePath + ", top entries by cumulative time:")
+            print (output.getvalue())
+            self.profile = None
+        if self.traceMemory is True and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print ( f"Peak memory allocated by Python     : {peak/1000000:.1f} MB, top allocations:" )
+            for statistic in snapshot.statistics('lineno')[:self.topEntries]:
+                print ("  " + str(statistic))
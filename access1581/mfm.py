@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+def buildDataBitTables():
+    '''
+    an MFM encoded byte is a 16 bit cell word where clock and data bits
+    alternate (c7 d7 c6 d6 ... c0 d0). the two tables pick the four data bits
+    out of the upper and the lower half of such a word.
+    '''
+    upper = bytearray(256)
+    lower = bytearray(256)
+    for byte in range(256):
+        nibble = ((byte >> 3) & 8) | ((byte >> 2) & 4) | ((byte >> 1) & 2) | (byte & 1)
+        upper[byte] = nibble << 4
+        lower[byte] = nibble
+    return (bytes(upper), bytes(lower))
+
+(mfmUpperDataBits, mfmLowerDataBits) = buildDataBitTables()
+
+def mfmDecodeBytes(bitstream, start, byteCount):
+    '''
+    decodes byteCount MFM encoded bytes beginning at bit offset start of a
+    BitBuffer. both halves of all cell words are translated at once, the
+    results are merged with a single big integer "or".
+    '''
+    raw = bitstream.toBytes(start, byteCount * 16)
+    if len(raw) < byteCount * 2:
+        raise Exception("Not enough bits left to MFM decode " + str(byteCount) + " bytes")
+    upper = raw[0::2].translate(mfmUpperDataBits)
+    lower = raw[1::2].translate(mfmLowerDataBits)
+    return ( int.from_bytes(upper, 'big') | int.from_bytes(lower, 'big') ).to_bytes(byteCount, 'big')
+
+def buildCellWordTables():
+    '''
+    the opposite direction: the 16 bit cell word of every byte, split into
+    upper and lower half. a clock bit is only set between two 0 data bits,
+    the tables assume that the data bit before the byte is 0
+    '''
+    upper = bytearray(256)
+    lower = bytearray(256)
+    for byte in range(256):
+        word = 0
+        previous = 0
+        for shift in range(7, -1, -1):
+            bit = (byte >> shift) & 1
+            clock = 1 if previous == 0 and bit == 0 else 0
+            word = (word << 2) | (clock << 1) | bit
+            previous = bit
+        upper[byte] = word >> 8
+        lower[byte] = word & 0xff
+    return (bytes(upper), bytes(lower))
+
+(mfmUpperCells, mfmLowerCells) = buildCellWordTables()
+#clears the first clock bit of a cell word if the byte before ends with a 1
+mfmClockMask = bytes( 0x7f if byte & 1 else 0xff for byte in range(256) )
+
+def mfmEncodeBytes(data, previousByte = 0):
+    '''
+    MFM encodes data into packed bit cells, two bytes per data byte. like
+    the decoder it works on all bytes at once: two table lookups for the
+    cell words, the clock bits that depend on the previous byte are fixed
+    with a single big integer "and". sync marks with missing clock bits are
+    not handled here
+    '''
+    data = bytes(data)
+    if len(data) == 0:
+        return b''
+    masks = ( bytes( (previousByte,) ) + data[:-1] ).translate(mfmClockMask)
+    upper = ( int.from_bytes(data.translate(mfmUpperCells), 'big') & int.from_bytes(masks, 'big') ).to_bytes(len(data), 'big')
+    encoded = bytearray( len(data) * 2 )
+    encoded[0::2] = upper
+    encoded[1::2] = data.translate(mfmLowerCells)
+    return bytes(encoded)
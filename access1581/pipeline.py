@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+class PipelinedDiskCapture:
+    '''
+    overlaps reading tracks via serial with decoding them. one reader thread
+    owns the Arduino interface and streams the compressed tracks into a
+    bounded queue while decode workers (threads, optionally backed by a
+    process pool) turn them into sectors. crc validation and retry decisions
+    stay in the calling thread. tracks that need another read are handed
+    back to the reader thread and are read before any track not read yet.
+    '''
+    def __init__(self, arduino, validatorFactory, decodeFunction, physicalHead, maxRetries, workers = 2, useProcesses = False, queueSize = 4, pool = None):
+        self.arduino = arduino
+        self.validatorFactory = validatorFactory
+        #maps the logical head number to the head that has to be read
+        self.physicalHead = physicalHead
+        #decodeFunction gets the compressed track data and the set of sector
+        #numbers still needed (None for all) and returns the list of
+        #sectors, it has to be picklable if useProcesses is set
+        self.decodeFunction = decodeFunction
+        self.maxRetries = maxRetries
+        self.workers = max(1, workers)
+        self.useProcesses = useProcesses
+        #a process pool shared with other captures, it is not shut down here
+        self.sharedPool = pool
+        self.queueSize = queueSize
+        self.total_duration_decode = 0
+        self.statsLock = threading.Lock()
+
+    def run(self, jobs, selection = None):
+        '''
+        reads and decodes the given (track, head) jobs. selection optionally
+        maps a job to the set of sector numbers to read. yields a tuple
+        (trackno, headno, validator, compressedTrackData, attempt) for each
+        finished track in the order the tracks are finished
+        '''
+        self.readRequests = queue.PriorityQueue()
+        self.rawTracks = queue.Queue(self.queueSize)
+        self.decodedTracks = queue.Queue()
+        self.sequence = itertools.count()
+        if self.sharedPool is not None:
+            self.pool = self.sharedPool
+        else:
+            self.pool = ProcessPoolExecutor(self.workers) if self.useProcesses is True else None
+        validators = {}
+        for (trackno, headno) in jobs:
+            vldtr = self.validatorFactory()
+            vldtr.startTrack( selection.get( (trackno, headno) ) if selection is not None else None )
+            validators[ (trackno, headno) ] = vldtr
+            self.requestRead(1, trackno, headno, 1, vldtr.wantedSectors)
+        reader = threading.Thread(target=self.readTracks, name="trackreader", daemon=True)
+        decoders = [ threading.Thread(target=self.decodeTracks, name="trackdecoder" + str(i), daemon=True) for i in range(0, self.workers) ]
+        reader.start()
+        for decoder in decoders:
+            decoder.start()
+        remaining = len(validators)
+        try:
+            while remaining > 0:
+                item = self.decodedTracks.get()
+                if isinstance(item, BaseException):
+                    raise item
+                (trackno, headno, attempt, compressedTrackData, sectors, readDuration, decodeDuration) = item
+                vldtr = validators[ (trackno, headno) ]
+                vldtr.readAttempts = attempt
+                vldtr.recordRead(readDuration, len(compressedTrackData), decodeDuration)
+                vldtr.checkBlankTrack(compressedTrackData)
+                lastChance = attempt >= self.maxRetries
+                if attempt > 1:
+                    print ("  Repeat track read - attempt " + str(attempt) + " of " + str(self.maxRetries) )
+                vldtr.addValidSectors(sectors, trackno, headno, lastChance)
+                vldtr.printTrackStatus(trackno, headno)
+                if vldtr.isTrackComplete() is True or lastChance is True:
+                    remaining -= 1
+                    yield (trackno, headno, vldtr, compressedTrackData, attempt)
+                else:
+                    #re-reads go in front of all tracks not read yet, only
+                    #the sectors still missing are decoded again
+                    self.requestRead(0, trackno, headno, attempt + 1, vldtr.getMissingSectors())
+        finally:
+            self.requestRead(-1, None, None, 0, None)
+            reader.join()
+            for decoder in decoders:
+                self.rawTracks.put(None)
+            for decoder in decoders:
+                decoder.join()
+            if self.pool is not None and self.pool is not self.sharedPool:
+                self.pool.shutdown()
+
+    def requestRead(self, priority, trackno, headno, attempt, wantedSectors):
+        self.readRequests.put( (priority, next(self.sequence), trackno, headno, attempt, wantedSectors) )
+
+    def readTracks(self):
+        try:
+            while True:
+                (priority, seq, trackno, headno, attempt, wantedSectors) = self.readRequests.get()
+                if trackno is None:
+                    break
+                starttime_read = time.time()
+                compressedTrackData = self.arduino.getCompressedTrackData(trackno, self.physicalHead(headno))
+                self.rawTracks.put( (trackno, headno, attempt, compressedTrackData, wantedSectors, time.time() - starttime_read) )
+        except Exception as e:
+            self.decodedTracks.put(e)
+
+    def decodeTracks(self):
+        while True:
+            item = self.rawTracks.get()
+            if item is None:
+                break
+            (trackno, headno, attempt, compressedTrackData, wantedSectors, readDuration) = item
+            try:
+                starttime_decode = time.time()
+                if self.pool is not None:
+                    sectors = self.pool.submit(self.decodeFunction, compressedTrackData, wantedSectors).result()
+                else:
+                    sectors = self.decodeFunction(compressedTrackData, wantedSectors)
+                decodeDuration = time.time() - starttime_decode
+                with self.statsLock:
+                    self.total_duration_decode += decodeDuration
+                self.decodedTracks.put( (trackno, headno, attempt, compressedTrackData, sectors, readDuration, decodeDuration) )
+            except Exception as e:
+                self.decodedTracks.put(e)
+
+    def printStats(self):
+        print ( "Total duration of all track decodes : " + str(int(self.total_duration_decode*100)/100) + " seconds")
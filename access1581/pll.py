@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    SOFTWARE PLL DATA SEPARATOR
+
+    the Arduino firmware classifies every flux interval with fixed windows
+    (shorter than 2.5 bit cells: "01", shorter than 3.5: "001", else
+    "0001"). if a disk was written on a drive that ran too fast or too slow
+    and the intervals jitter on top of that, intervals end up in the wrong
+    window and the sector fails the crc check on every read.
+    the data separator here follows the bit cell clock of the disk instead:
+    every flux reversal pulls the phase and the period of the clock towards
+    it, so a speed deviation is tracked after a few bytes and the windows
+    stay centered on the bit cells.
+    it works on flux interval timings. the interval codes of firmware V1.3
+    carry no timing beyond the window they fell into, so it is not used for
+    reading disks (it would return the bitstream of the fixed windows, only
+    much slower). the evaluation in main() therefore turns recorded tracks
+    into flux timings with a speed deviation and jitter and compares both
+    ways of separating them.
+
+'''
+
+import math
+import random
+import time
+from optparse import OptionParser
+from access1581.benchmark import loadCompressedTracks
+from access1581.bitstream import BitBuffer, TrackDecompressor
+from access1581.diskformats import *
+
+#bits of a run of n bit cells
+runBits = [ '0' * (cells - 1) + '1' if cells > 0 else '' for cells in range(17) ]
+
+def fixedWindowSeparate(intervals, cellTime = 2.0):
+    '''
+    what the firmware does: fixed windows around 2, 3 and 4 bit cells
+    '''
+    short = 2.5 * cellTime
+    medium = 3.5 * cellTime
+    return BitBuffer.fromBitString( "".join( runBits[2] if interval < short else runBits[3] if interval < medium else runBits[4] for interval in intervals ) )
+
+class PLLDataSeparator:
+    '''
+    adaptive data separator for flux interval timings. cellTime is the
+    nominal bit cell length (2 microseconds for double density at 300 rpm)
+    in the unit of the intervals. phaseGain is the part of the phase error
+    of a flux reversal that is corrected at once, frequencyGain the part
+    that goes into the clock period, which can drift maxDrift off the
+    nominal cell length
+    '''
+    def __init__(self, cellTime = 2.0, phaseGain = 0.5, frequencyGain = 0.05, maxDrift = 0.2):
+        self.cellTime = cellTime
+        self.phaseGain = phaseGain
+        self.frequencyGain = frequencyGain
+        self.maxDrift = maxDrift
+
+    def separate(self, intervals):
+        '''
+        returns the bitstream of the flux intervals as a BitBuffer
+        '''
+        clock = self.cellTime
+        minClock = self.cellTime * (1 - self.maxDrift)
+        maxClock = self.cellTime * (1 + self.maxDrift)
+        phaseKeep = 1 - self.phaseGain
+        frequencyGain = self.frequencyGain
+        maxCells = len(runBits) - 1
+        runs = []
+        #time since the center of the bit cell of the last flux reversal
+        phase = 0.0
+        for interval in intervals:
+            phase += interval
+            if phase < clock * 0.5:
+                #a glitch within the bit cell of the last flux reversal
+                continue
+            cells = int(phase / clock + 0.5)
+            error = phase - cells * clock
+            if cells <= 4:
+                #long runs are no MFM data, they tell nothing about the clock
+                clock += error * frequencyGain / cells
+                if clock < minClock:
+                    clock = minClock
+                elif clock > maxClock:
+                    clock = maxClock
+            runs.append( runBits[ min(cells, maxCells) ] )
+            phase = error * phaseKeep
+        return BitBuffer.fromBitString( "".join(runs) )
+
+def fluxFromBitstream(bitString, cellTime = 2.0, speed = 1.0, wobble = 0.0, jitter = 0.0, seed = 0):
+    '''
+    flux interval timings of a recorded bitstream as a drive with a speed
+    deviation (speed 1.05: intervals are 5% longer), a sinusoidal wobble
+    of the speed (relative amplitude, 5 wobbles per track) and gaussian
+    jitter of the flux reversals (in microseconds) would see them
+    '''
+    rng = random.Random(seed)
+    length = max(1, len(bitString))
+    intervals = []
+    #time of the flux reversals: the speed error adds up, the jitter doesn't
+    elapsed = 0.0
+    last = 0.0
+    previous = bitString.find('1')
+    current = bitString.find('1', previous + 1)
+    while current > 0:
+        factor = speed * ( 1 + wobble * math.sin( 2 * math.pi * 5 * current / length ) )
+        elapsed += (current - previous) * cellTime * factor
+        reversal = elapsed + rng.gauss(0, jitter)
+        intervals.append( max( 0.1, reversal - last ) )
+        last = reversal
+        previous = current
+        current = bitString.find('1', current + 1)
+    return intervals
+
+def countValidSectors(validator, bitstream):
+    sectors = validator.trackParser.parseBitstream(bitstream)
+    bitmap = validator.checkSectorCRCs(sectors)
+    return len( set( sectorprops["sectorno"] for (index, sectorprops) in enumerate(sectors) if bitmap >> index & 1 ) )
+
+def main():
+    from access1581.imager import SingleTrackSectorListValidator
+    parser = OptionParser("usage: %prog [options] [capturefile|dump ...]")
+    parser.add_option("-i", "--input", dest="input",
+        help="bitstream dump to use, default is raw_debug_image_d81.zip",
+        default="raw_debug_image_d81.zip"
+    )
+    parser.add_option("-d", "--disktype", dest="disktype",
+        help="disk format of the recorded tracks: " + getDiskFormatNames(),
+        default=defaultDiskType
+    )
+    parser.add_option("--speed", dest="speed",
+        help="flux intervals are this factor longer than nominal, default: 1.1",
+        default=1.1
+    )
+    parser.add_option("--wobble", dest="wobble",
+        help="relative amplitude of the speed wobble, default: 0.02",
+        default=0.02
+    )
+    parser.add_option("--jitter", dest="jitter",
+        help="standard deviation of the flux reversal timing jitter in microseconds, default: 0.15",
+        default=0.15
+    )
+    parser.add_option("-t", "--tracks", dest="tracks",
+        help="number of tracks to evaluate, default: all",
+        default=None
+    )
+    (options, args) = parser.parse_args()
+    diskFormat = getDiskFormat(options.disktype)
+    inputs = args if len(args) > 0 else [ options.input ]
+    tracks = [ track for path in inputs for track in loadCompressedTracks(path, diskFormat) ]
+    if options.tracks is not None:
+        tracks = tracks[:int(options.tracks)]
+    decompressor = TrackDecompressor()
+    separator = PLLDataSeparator()
+    validator = SingleTrackSectorListValidator(1, diskFormat, None)
+    print ( f"Separating {len(tracks)} tracks with speed {float(options.speed):.3f}, wobble {float(options.wobble):.3f} and jitter {float(options.jitter):.2f} us" )
+    results = { "fixed windows": [0, 0], "software PLL": [0, 0] }
+    for (index, (trackno, headno, compressedTrackData)) in enumerate(tracks):
+        bitString = decompressor.decompress(compressedTrackData)
+        intervals = fluxFromBitstream(bitString, 2.0, float(options.speed), float(options.wobble), float(options.jitter), index)
+        for (name, separate) in ( ("fixed windows", fixedWindowSeparate), ("software PLL", separator.separate) ):
+            starttime = time.time()
+            bitstream = separate(intervals)
+            results[name][1] += time.time() - starttime
+            results[name][0] += countValidSectors(validator, bitstream)
+    expected = len(tracks) * diskFormat.expectedSectorsPerTrack
+    for name in results:
+        (validSectors, duration) = results[name]
+        print ( f"{name:14s}: {validSectors}/{expected} sectors valid on the first read, {duration * 1000 / max(1, len(tracks)):.1f} ms per track" )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import contextlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+from access1581.bitstream import BitBuffer
+from access1581.capturefile import CaptureFileReader, isCaptureFile, loadRawTracks
+from access1581.diskformats import *
+from access1581.imagefile import ImageFileWriter
+from access1581.imager import SingleTrackSectorListValidator, trackDecompressor
+
+@contextlib.contextmanager
+def loadTracks(dumpPath, diskFormat):
+    '''
+    context manager delivering a function that returns the archived data of
+    a track: bitstreams for old dumps, compressed track data for capture
+    files. a capture file is closed again when the context is left
+    '''
+    if isCaptureFile(dumpPath):
+        with CaptureFileReader(dumpPath) as capture:
+            yield lambda trackno, headno: capture.getCompressedTrackData(trackno, diskFormat.getPhysicalHead(headno))
+        return
+    rawTracks = loadRawTracks(dumpPath)
+    yield lambda trackno, headno: rawTracks[trackno][headno]
+
+def reprocessTrack(diskFormat, trackno, headno, bitstream):
+    '''
+    parses and validates one archived track. the output of the validator is
+    captured and returned, so that the output of tracks decoded in parallel
+    can be printed in track order
+    '''
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        if isinstance(bitstream, bytes):
+            bitstream = trackDecompressor.decompressToBitBuffer(bitstream)
+        elif not isinstance(bitstream, BitBuffer):
+            bitstream = BitBuffer.fromBitString(bitstream)
+        #an archived dump holds a single read per track, there is no retry
+        vldtr = SingleTrackSectorListValidator(1, diskFormat, None)
+        vldtr.addValidSectors( vldtr.trackParser.parseBitstream(bitstream), trackno, headno, True )
+        vldtr.printTrackStatus(trackno, headno)
+        trackData = vldtr.assembleTrackData()
+        trackLength = diskFormat.expectedSectorsPerTrack * diskFormat.sectorSize
+        if not len(trackData) == trackLength:
+            print ("ERROR track should have " + str(trackLength) + " bytes but has " + str(len(trackData)))
+    return (trackno, headno, trackData, log.getvalue())
+
+def reprocessDump(diskFormat, dumpPath, imagename):
+    '''
+    decodes a complete dump sequentially, used when many dumps are decoded
+    in parallel (one dump per worker process)
+    '''
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        print ("Reprocessing dump " + dumpPath)
+        with loadTracks(dumpPath, diskFormat) as getTrack:
+            print ("Writing image to file " + imagename)
+            imageFile = ImageFileWriter(imagename, diskFormat)
+            for trackno in diskFormat.trackRange:
+                for headno in diskFormat.headRange:
+                    (t, h, trackData, trackLog) = reprocessTrack(diskFormat, trackno, headno, getTrack(trackno, headno))
+                    print (trackLog, end='')
+                    imageFile.writeTrack(trackno, headno, trackData)
+            imageFile.close()
+    return log.getvalue()
+
+class RawTrackDumpReprocessor:
+    '''
+    decodes capture files and old bitstream dumps (see storeBitstream of the
+    imager) again and writes the resulting disk images. the work is spread
+    across a process pool: the tracks of a single dump are decoded in
+    parallel, if there are several dumps each worker decodes complete dumps.
+    '''
+    def __init__(self, diskFormat, workers = None):
+        self.diskFormat = diskFormat
+        self.workers = workers if workers is not None else os.cpu_count()
+
+    def getImageName(self, dumpPath, outputDir = None):
+        basename = os.path.splitext( os.path.basename(dumpPath) )[0] + '.' + self.diskFormat.imageExtension
+        return os.path.join( outputDir if outputDir is not None else os.path.dirname(dumpPath), basename )
+
+    def reprocessSingleDump(self, dumpPath, imagename):
+        print ("Reprocessing dump " + dumpPath + " with " + str(self.workers) + " processes")
+        print ("Writing image to file " + imagename)
+        imageFile = ImageFileWriter(imagename, self.diskFormat)
+        with loadTracks(dumpPath, self.diskFormat) as getTrack, ProcessPoolExecutor(self.workers) as pool:
+            futures = [
+                pool.submit( reprocessTrack, self.diskFormat, trackno, headno, getTrack(trackno, headno) )
+                for trackno in self.diskFormat.trackRange for headno in self.diskFormat.headRange
+            ]
+            for future in futures:
+                (trackno, headno, trackData, trackLog) = future.result()
+                print (trackLog, end='')
+                imageFile.writeTrack(trackno, headno, trackData)
+        imageFile.close()
+
+    def reprocessDumps(self, dumpPaths, outputDir = None):
+        print ("Reprocessing " + str(len(dumpPaths)) + " dumps with " + str(self.workers) + " processes")
+        if outputDir is not None:
+            os.makedirs(outputDir, exist_ok=True)
+        with ProcessPoolExecutor(self.workers) as pool:
+            futures = [
+                pool.submit( reprocessDump, self.diskFormat, dumpPath, self.getImageName(dumpPath, outputDir) )
+                for dumpPath in dumpPaths
+            ]
+            for future in futures:
+                print (future.result(), end='')
+
+def findDumps(paths):
+    dumps = []
+    for path in paths:
+        if os.path.isdir(path):
+            dumps.extend( sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if os.path.splitext(name)[1] in ('.cap', '.py', '.zip')
+            ) )
+        else:
+            dumps.append(path)
+    return dumps
+
+def main():
+    parser = OptionParser("usage: %prog [options] dump|directory [dump|directory ...]")
+    parser.add_option("-d", "--disktype", dest="disktype",
+        help="disk format of the dumps: " + getDiskFormatNames(),
+        default=defaultDiskType
+    )
+    parser.add_option("-o", "--output", dest="output",
+        help="image file to write for a single dump or directory for the images of several dumps, default: next to each dump",
+        default=None
+    )
+    parser.add_option("-w", "--workers", dest="workers",
+        help="number of worker processes, default: number of CPU cores",
+        default=None
+    )
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        parser.error("no dump file or directory given")
+    dumps = findDumps(args)
+    reprocessor = RawTrackDumpReprocessor(
+        getDiskFormat(options.disktype),
+        int(options.workers) if options.workers is not None else None
+    )
+    starttime = time.time()
+    if len(dumps) == 1 and not os.path.isdir(args[0]):
+        imagename = options.output if options.output is not None else reprocessor.getImageName(dumps[0])
+        reprocessor.reprocessSingleDump(dumps[0], imagename)
+    else:
+        reprocessor.reprocessDumps(dumps, options.output)
+    duration = int((time.time() - starttime)*100)/100
+    print ("Total duration of reprocessing       : " + str(duration) + " seconds")
+
+if __name__ == '__main__':
+    main()
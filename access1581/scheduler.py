@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import time
+
+trackOrders = ("sequential", "serpentine", "elevator")
+
+class TrackScheduler:
+    '''
+    sits between the imager and the Arduino interface: decides in which
+    order a set of (track, head) jobs is read and drives one validator per
+    job. the orders:
+        sequential  track by track, head 0 before head 1
+        serpentine  track by track, each cylinder starts with the head the
+                    previous one ended with, saving a head switch
+        elevator    starts with the end of the job list closer to the
+                    current head position and sweeps to the other end
+    with deferRetries, each job gets a single read at first. tracks that
+    still miss sectors are read again in further sweeps (in elevator order
+    from wherever the head is) instead of retrying in place.
+    '''
+    def __init__(self, arduino, validatorFactory, maxRetries, trackOrder = "sequential", deferRetries = False):
+        if not trackOrder in trackOrders:
+            raise Exception("Error: track order " + trackOrder + " is unknown")
+        self.arduino = arduino
+        self.validatorFactory = validatorFactory
+        self.maxRetries = maxRetries
+        self.trackOrder = trackOrder
+        self.deferRetries = deferRetries
+        #(trackno, headno) -> [read attempts, seconds, tracks stepped]
+        self.timings = {}
+
+    def getHeadPosition(self):
+        if self.arduino is not None and self.arduino.currentTrack in self.arduino.trackRange:
+            return self.arduino.currentTrack
+        return 0
+
+    def order(self, jobs, trackOrder = None, position = None):
+        trackOrder = self.trackOrder if trackOrder is None else trackOrder
+        if trackOrder == "sequential":
+            return sorted(jobs)
+        position = self.getHeadPosition() if position is None else position
+        cylinders = {}
+        for (trackno, headno) in jobs:
+            cylinders.setdefault(trackno, []).append(headno)
+        cylinderOrder = sorted(cylinders)
+        if trackOrder == "elevator":
+            below = [ c for c in cylinderOrder if c < position ]
+            above = [ c for c in cylinderOrder if c >= position ]
+            if len(above) == 0 or ( len(below) > 0 and position - below[-1] < above[0] - position ):
+                cylinderOrder = below[::-1] + above
+            else:
+                cylinderOrder = above + below[::-1]
+        ordered = []
+        for trackno in cylinderOrder:
+            heads = sorted(cylinders[trackno])
+            if len(ordered) > 0 and ordered[-1][1] == heads[-1]:
+                heads.reverse()
+            ordered.extend( (trackno, headno) for headno in heads )
+        return ordered
+
+    def readJob(self, vldtr, trackno, headno, lastChance = None):
+        '''
+        reads one job, completely or with a single read attempt if
+        lastChance is given
+        '''
+        position = self.getHeadPosition()
+        starttime = time.time()
+        if lastChance is None:
+            vldtr.readTrack(trackno, headno, vldtr.wantedSectors)
+        else:
+            vldtr.readAttempt(trackno, headno, lastChance)
+        timing = self.timings.setdefault( (trackno, headno), [0, 0, 0] )
+        timing[0] = vldtr.getReadAttempts()
+        timing[1] += time.time() - starttime
+        timing[2] += abs(trackno - position)
+
+    def run(self, jobs, selection = None):
+        '''
+        reads all jobs. yields (trackno, headno, validator) as soon as a job
+        is finished
+        '''
+        validators = {}
+        for job in jobs:
+            vldtr = self.validatorFactory()
+            vldtr.startTrack( selection.get(job) if selection is not None else None )
+            validators[job] = vldtr
+        if self.deferRetries is False:
+            for (trackno, headno) in self.order(jobs):
+                self.readJob( validators[ (trackno, headno) ], trackno, headno )
+                yield (trackno, headno, validators.pop( (trackno, headno) ))
+            return
+        pending = list(jobs)
+        trackOrder = self.trackOrder
+        attempt = 1
+        while len(pending) > 0 and attempt <= self.maxRetries:
+            if attempt > 1:
+                print ("Retry sweep " + str(attempt) + " of " + str(self.maxRetries) + " for " + str(len(pending)) + " tracks")
+            stillPending = []
+            for (trackno, headno) in self.order(pending, trackOrder):
+                vldtr = validators[ (trackno, headno) ]
+                self.readJob( vldtr, trackno, headno, attempt == self.maxRetries )
+                if vldtr.isTrackComplete() is True or attempt == self.maxRetries:
+                    yield (trackno, headno, validators.pop( (trackno, headno) ))
+                else:
+                    stillPending.append( (trackno, headno) )
+            pending = stillPending
+            #later sweeps start wherever the head is
+            trackOrder = "elevator"
+            attempt += 1
+
+    def printStats(self):
+        if len(self.timings) == 0:
+            return
+        steps = sum( t[2] for t in self.timings.values() )
+        print ( "Tracks read                         : " + str(len(self.timings)) + ", " + str(sum( t[0] for t in self.timings.values() )) + " read attempts, " + str(steps) + " tracks stepped")
+        slowest = sorted( self.timings, key=lambda job: self.timings[job][1], reverse=True )[:5]
+        for (trackno, headno) in slowest:
+            (attempts, duration, trackSteps) = self.timings[ (trackno, headno) ]
+            print ( f"  Track {trackno:2d}, head {headno}: {duration:6.3f} seconds, {attempts} read attempts, {trackSteps} tracks stepped" )
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# coding: utf8
+
+'''
+    Copyright (C) 2019  Henning Pingel
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    TRACK LAYOUT (bytes before MFM encoding, lengths from the disk format)
+
+    gap 4a       gapByte * gap4aLength
+    index mark   only if indexMark is set: 00 * syncLength, c2c2c2 (missing
+                 clock), fc, gapByte * gap1Length
+    per sector   00 * syncLength, a1a1a1 (missing clock), fe, track, side,
+                 sector, size code, crc
+                 gapByte * gap2Length
+                 00 * syncLength, a1a1a1 (missing clock), fb, data, crc
+                 gapByte * gap3Length
+    gap 4b       gapByte up to trackCapacity
+
+'''
+
+import binascii
+import time
+from optparse import OptionParser
+from access1581.bitstream import BitBuffer, compressBitstream
+from access1581.capturefile import CaptureFileWriter
+from access1581.diskformats import *
+from access1581.mfm import mfmEncodeBytes
+
+#mask for the lower half of the cell word that removes the missing clock bit
+syncMarks = {
+    0xa1: 0xdf, #4489 instead of 44a9
+    0xc2: 0x7f  #5224 instead of 52a4
+}
+
+class MFMTrackEncoder:
+    '''
+    turns the sector data of tracks into MFM encoded track images, the
+    packed bit cells (most significant bit first) that writeTrackData sends
+    to the Arduino. all tracks of an image are laid out in one go and MFM
+    encoded with a single call of mfmEncodeBytes, only the few sync marks
+    get their clock bits removed one by one afterwards
+    '''
+    def __init__(self, diskFormat):
+        self.diskFormat = diskFormat
+        self.sectorSize = diskFormat.sectorSize
+        self.sectorsPerTrack = diskFormat.expectedSectorsPerTrack
+        self.trackLength = self.sectorsPerTrack * self.sectorSize
+        self.sizeCode = { 128: 0, 256: 1, 512: 2, 1024: 3 }[self.sectorSize]
+        gap = bytes( (diskFormat.gapByte,) )
+        sync = bytes(diskFormat.syncLength)
+        self.gap2 = gap * diskFormat.gap2Length + sync + b'\xa1\xa1\xa1\xfb'
+        self.gap3 = gap * diskFormat.gap3Length
+        self.trackStart = gap * diskFormat.gap4aLength
+        if diskFormat.indexMark is True:
+            self.trackStart += sync + b'\xc2\xc2\xc2\xfc' + gap * diskFormat.gap1Length
+        self.idStart = sync + b'\xa1\xa1\xa1\xfe'
+        self.sectorLayoutLength = len(self.idStart) + 6 + len(self.gap2) + self.sectorSize + 2 + len(self.gap3)
+        usedLength = len(self.trackStart) + self.sectorsPerTrack * self.sectorLayoutLength
+        if usedLength > diskFormat.trackCapacity:
+            raise Exception("Track layout of " + diskFormat.name + " needs " + str(usedLength) + " of " + str(diskFormat.trackCapacity) + " bytes")
+        self.gap4b = gap * (diskFormat.trackCapacity - usedLength)
+        self.syncOffsets = self.getSyncOffsets()
+
+    def getSyncOffsets(self):
+        '''
+        positions of the sync mark bytes within every track
+        '''
+        offsets = []
+        if self.diskFormat.indexMark is True:
+            start = self.diskFormat.gap4aLength + self.diskFormat.syncLength
+            offsets.extend( range(start, start + 3) )
+        for sector in range(0, self.sectorsPerTrack):
+            start = len(self.trackStart) + sector * self.sectorLayoutLength + self.diskFormat.syncLength
+            offsets.extend( range(start, start + 3) )
+            start += 4 + 6 + len(self.gap2) - 4
+            offsets.extend( range(start, start + 3) )
+        return offsets
+
+    def layoutTrack(self, trackno, headno, trackData):
+        '''
+        the bytes of a track before MFM encoding
+        '''
+        if len(trackData) != self.trackLength:
+            raise Exception("Track " + str(trackno) + " head " + str(headno) + " has " + str(len(trackData)) + " bytes instead of " + str(self.trackLength))
+        pieces = [ self.trackStart ]
+        for sector in range(0, self.sectorsPerTrack):
+            header = self.idStart + bytes( (trackno, headno, sector + 1, self.sizeCode) )
+            data = b'\xa1\xa1\xa1\xfb' + trackData[sector * self.sectorSize : (sector + 1) * self.sectorSize]
+            pieces.append(header)
+            pieces.append( binascii.crc_hqx(header[-8:], 0xffff).to_bytes(2, 'big') )
+            pieces.append(self.gap2[:-4])
+            pieces.append(data)
+            pieces.append( binascii.crc_hqx(data, 0xffff).to_bytes(2, 'big') )
+            pieces.append(self.gap3)
+        pieces.append(self.gap4b)
+        return b''.join(pieces)
+
+    def encodeTracks(self, tracks):
+        '''
+        tracks is a list of (trackno, headno, trackData), returns the list of
+        their MFM track images
+        '''
+        layout = b''.join( self.layoutTrack(trackno, headno, trackData) for (trackno, headno, trackData) in tracks )
+        #every track ends with a gap byte, so the tracks can be encoded as one
+        encoded = bytearray( mfmEncodeBytes(layout, self.diskFormat.gapByte) )
+        capacity = self.diskFormat.trackCapacity
+        for track in range(0, len(tracks)):
+            for offset in self.syncOffsets:
+                position = track * capacity + offset
+                encoded[2 * position + 1] &= syncMarks[ layout[position] ]
+        return [ bytes( encoded[track * capacity * 2 : (track + 1) * capacity * 2] ) for track in range(0, len(tracks)) ]
+
+    def encodeTrack(self, trackno, headno, trackData):
+        return self.encodeTracks( [ (trackno, headno, trackData) ] )[0]
+
+    def encodeImage(self, imageData):
+        '''
+        encodes a complete disk image, returns a dict (track, head) -> MFM
+        track image with logical head numbers
+        '''
+        trackOrder = [ (trackno, headno) for trackno in self.diskFormat.trackRange for headno in self.diskFormat.headRange ]
+        if len(imageData) != len(trackOrder) * self.trackLength:
+            raise Exception("Image has " + str(len(imageData)) + " bytes, " + self.diskFormat.name + " images have " + str(len(trackOrder) * self.trackLength))
+        tracks = [ (trackno, headno, imageData[index * self.trackLength : (index + 1) * self.trackLength]) for (index, (trackno, headno)) in enumerate(trackOrder) ]
+        return dict( zip( trackOrder, self.encodeTracks(tracks) ) )
+
+def mfmToCompressed(mfmTrack):
+    '''
+    turns packed MFM bit cells into the compressed flux format the Arduino
+    sends when it reads a track. like the firmware the read goes on for a
+    ninth of a revolution past the index, so the first sectors show up
+    twice and the track is as long as a recorded one. the cells up to the
+    first flux reversal and after the last one are dropped
+    '''
+    mfmTrack = mfmTrack + mfmTrack[ : len(mfmTrack) // 9 ]
+    bitString = BitBuffer(mfmTrack).toBitString()
+    bitString = bitString[ bitString.find('1') + 1 : bitString.rfind('1') + 1 ]
+    return compressBitstream(bitString)
+
+def writeImage(arduino, diskFormat, imageData, mfmTracks = None):
+    '''
+    writes a complete disk image with an ArduinoFloppyControlInterface,
+    mfmTracks are the already encoded tracks of the image
+    '''
+    if mfmTracks is None:
+        mfmTracks = MFMTrackEncoder(diskFormat).encodeImage(imageData)
+    for (trackno, headno) in sorted(mfmTracks):
+        print ("Writing track: " + str(trackno) + ", head: " + str(headno))
+        arduino.writeTrackData( trackno, diskFormat.getPhysicalHead(headno), mfmTracks[ (trackno, headno) ] )
+
+def imageToCapture(imageData, capturePath, diskFormat, mfmTracks = None):
+    '''
+    writes a capture file that looks like the disk the image was written
+    to, for the simulator, the emulator and benchmarks. mfmTracks are the
+    already encoded tracks of the image, if there are any
+    '''
+    if mfmTracks is None:
+        mfmTracks = MFMTrackEncoder(diskFormat).encodeImage(imageData)
+    with CaptureFileWriter(capturePath, diskFormat.name, 0) as capture:
+        for (trackno, headno) in sorted(mfmTracks):
+            capture.addTrack( trackno, diskFormat.getPhysicalHead(headno), mfmToCompressed( mfmTracks[ (trackno, headno) ] ) )
+
+def main():
+    parser = OptionParser("usage: %prog [options] image")
+    parser.add_option("-d", "--disktype", dest="disktype",
+        help="disk format of the image: " + getDiskFormatNames(),
+        default=defaultDiskType
+    )
+    parser.add_option("-s", "--serialdevice", dest="serialDeviceName",
+        help="write the image to the disk in the drive of this serial device",
+        default=None
+    )
+    parser.add_option("-c", "--capture", dest="capture",
+        help="write a capture file of the encoded tracks instead",
+        default=None
+    )
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expecting the image file to encode")
+    diskFormat = getDiskFormat(options.disktype)
+    with open(args[0], 'rb') as f:
+        imageData = f.read()
+    starttime = time.time()
+    mfmTracks = MFMTrackEncoder(diskFormat).encodeImage(imageData)
+    print ("Encoded " + str(len(mfmTracks)) + " tracks in " + str(int((time.time() - starttime)*1000)/1000) + " seconds")
+    if options.capture is not None:
+        imageToCapture(imageData, options.capture, diskFormat, mfmTracks)
+        print ("Wrote capture file " + options.capture)
+    if options.serialDeviceName is not None:
+        from access1581.arduinointerface import ArduinoFloppyControlInterface
+        arduino = ArduinoFloppyControlInterface(options.serialDeviceName, diskFormat)
+        arduino.openSerialConnection()
+        writeImage(arduino, diskFormat, imageData, mfmTracks)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+# coding: utf8
+
+import os
+
+#bitstream dump of a 1581 disk shipped with the repository
+debugDump = os.path.join( os.path.dirname(__file__), "..", "raw_debug_image_d81.zip" )
+#MD5 of its disk image
+debugImageMD5 = "b3bdbc62fb96e3893dac3bccbde59ab0"
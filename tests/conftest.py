@@ -0,0 +1,15 @@
+# coding: utf8
+
+import pytest
+from access1581.capturefile import convertRawTracks
+from access1581.diskformats import getDiskFormat
+from tests import debugDump
+
+@pytest.fixture(scope="session")
+def debugCapture(tmp_path_factory):
+    '''
+    the debug dump of the repository as capture file
+    '''
+    path = str( tmp_path_factory.mktemp("capture") / "debug.cap" )
+    convertRawTracks( debugDump, path, getDiskFormat("cbm1581") )
+    return path
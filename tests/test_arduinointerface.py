@@ -0,0 +1,105 @@
+# coding: utf8
+
+import platform
+import pytest
+from access1581.arduinointerface import ArduinoFloppyControlInterface, ArduinoSimulator
+from access1581.capturefile import CaptureFileReader, loadRawTracks
+from access1581.diskformats import getDiskFormat
+from access1581.emulator import ArduinoFirmwareEmulator
+from tests import debugDump
+
+@pytest.fixture
+def emulatedArduino():
+    diskFormat = getDiskFormat("cbm1581")
+    emulator = ArduinoFirmwareEmulator( loadRawTracks(debugDump), diskFormat, realtime = False )
+    arduino = ArduinoFloppyControlInterface( emulator.start(), diskFormat )
+    arduino.openSerialConnection()
+    yield (emulator, arduino)
+    arduino.closeSerialConnection()
+    emulator.stop()
+
+def test_revolutions_are_cut_at_their_terminators_on_every_platform(emulatedArduino, monkeypatch):
+    (emulator, arduino) = emulatedArduino
+    monkeypatch.setattr(platform, "system", lambda: "Windows")
+    revolutions = arduino.getCompressedRevolutions(5, 1, 3)
+    emulator.currentTrack = 5
+    emulator.currentHead = 1
+    expected = bytes( emulator.getCompressedTrackData() ) + b'\0'
+    assert revolutions == [ expected ] * 3
+
+def test_short_revolutions_are_not_merged(emulatedArduino, monkeypatch):
+    (emulator, arduino) = emulatedArduino
+    monkeypatch.setattr(platform, "system", lambda: "Windows")
+    #an erased track is answered with the terminating zero byte only
+    emulator.writtenTracks[ (7, 0) ] = None
+    assert arduino.getCompressedRevolutions(7, 0, 3) == [ b'\0' ] * 3
+
+def test_simulator_cache(debugCapture):
+    diskFormat = getDiskFormat("cbm1581")
+    simulator = ArduinoSimulator( diskFormat, CaptureFileReader(debugCapture), cacheSize = 2 )
+    reads = []
+    decompressions = []
+    readTrack = simulator.rawTrackData.getCompressedTrackData
+    decompress = simulator.decompressor.decompressToBitBuffer
+    simulator.rawTrackData.getCompressedTrackData = lambda track, head: reads.append( (track, head) ) or readTrack(track, head)
+    simulator.decompressor.decompressToBitBuffer = lambda compressedBytes: decompressions.append(compressedBytes) or decompress(compressedBytes)
+    #miss
+    bitstream = simulator.getDecompressedBitstream(0, 0)
+    assert (len(reads), len(decompressions)) == (1, 1)
+    #hit, also when the compressed data is fetched first as the imager does
+    assert simulator.getDecompressedBitstream(0, 0) is bitstream
+    compressedBytes = simulator.getCompressedTrackData(0, 0)
+    assert simulator.getLastCompressedTrackData() is compressedBytes
+    assert simulator.decompressTrackData(compressedBytes) is bitstream
+    assert (len(reads), len(decompressions)) == (1, 1)
+    #the least recently used track is evicted
+    simulator.getDecompressedBitstream(1, 0)
+    simulator.getDecompressedBitstream(0, 0)
+    simulator.getDecompressedBitstream(2, 0)
+    assert list(simulator.trackCache) == [ (0, 0), (2, 0) ]
+    simulator.getDecompressedBitstream(1, 0)
+    assert reads == [ (0, 0), (1, 0), (2, 0), (1, 0) ]
+    assert len(decompressions) == 4
+    simulator.closeSerialConnection()
+
+def test_commands_are_batched_with_the_read(emulatedArduino):
+    (emulator, arduino) = emulatedArduino
+    (writes, commands, received) = (arduino.serialWrites, arduino.commandsSent, emulator.commandCount)
+    arduino.getCompressedTrackData(5, 1)
+    #track, head and the read itself go out with a single write, the motor
+    #is running since the rewind of openSerialConnection
+    assert arduino.serialWrites == writes + 1
+    assert arduino.commandsSent == commands + 2
+    assert emulator.commandCount == received + 3
+    assert (emulator.currentTrack, emulator.currentHead) == (5, 1)
+    #nothing has to be selected again for the same track
+    arduino.getCompressedTrackData(5, 1)
+    assert arduino.serialWrites == writes + 2
+    assert arduino.commandsSent == commands + 2
+    assert emulator.commandCount == received + 4
+
+def test_redundant_motor_commands_are_skipped(emulatedArduino):
+    (emulator, arduino) = emulatedArduino
+    arduino.sendCommand("motor_on_read")
+    commands = arduino.commandsSent
+    arduino.queueCommand("motor_on_read")
+    assert arduino.commandQueue == []
+    arduino.flushCommands()
+    assert arduino.commandsSent == commands
+    #a different mode is switched
+    arduino.queueCommand("motor_off")
+    arduino.queueCommand("motor_on_read")
+    assert [ cmdname for (cmdname, param) in arduino.commandQueue ] == [ "motor_off", "motor_on_read" ]
+    arduino.flushCommands()
+
+def test_failed_command_forgets_the_head_position(emulatedArduino):
+    (emulator, arduino) = emulatedArduino
+    arduino.getCompressedTrackData(5, 1)
+    arduino.queueCommand("select_track", b'99')
+    with pytest.raises(Exception, match="Something went wrong"):
+        arduino.flushCommands()
+    assert (arduino.currentTrack, arduino.currentHead) == (100, 2)
+    #the next read selects track and head again
+    compressedTrackData = arduino.getCompressedTrackData(5, 1)
+    assert (emulator.currentTrack, emulator.currentHead) == (5, 1)
+    assert compressedTrackData == bytes( emulator.getCompressedTrackData() ) + b'\0'
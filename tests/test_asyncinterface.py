@@ -0,0 +1,67 @@
+# coding: utf8
+
+import asyncio
+import os
+import pytest
+from access1581.asyncinterface import AsyncArduinoFloppyController, AsyncSerialTransport, FdTransport, PySerialAsyncioTransport
+from access1581.capturefile import loadRawTracks
+from access1581.diskformats import getDiskFormat
+from access1581.emulator import ArduinoFirmwareEmulator
+from access1581.imager import SingleTrackSectorListValidator, decodeCompressedTrack
+from tests import debugDump
+
+def test_transport_interface_is_abstract():
+    with pytest.raises(TypeError):
+        AsyncSerialTransport()
+
+def test_read_until_stops_at_max_bytes():
+    (readEnd, writeEnd) = os.pipe()
+    async def readReplies():
+        transport = FdTransport(fd = readEnd)
+        await transport.open()
+        #a reply without terminator is cut like the blocking read does
+        os.write(writeEnd, b'\x55' * 20000 + b'\x66\x00\x77')
+        replies = [ await transport.readUntil(b'\x00', 12200) for i in range(0, 2) ]
+        replies.append( await transport.read(1) )
+        transport.close()
+        return replies
+    try:
+        assert asyncio.run( readReplies() ) == [ b'\x55' * 12200, b'\x55' * 7800 + b'\x66\x00', b'\x77' ]
+    finally:
+        os.close(readEnd)
+        os.close(writeEnd)
+
+async def readTracks(controller, diskFormat, tracks):
+    validSectors = 0
+    async with controller:
+        for trackno in tracks:
+            for headno in diskFormat.headRange:
+                compressedTrackData = await controller.readTrack( trackno, diskFormat.getPhysicalHead(headno) )
+                vldtr = SingleTrackSectorListValidator(1, diskFormat, None)
+                vldtr.startTrack()
+                vldtr.addValidSectors( decodeCompressedTrack(diskFormat, compressedTrackData), trackno, headno, False )
+                validSectors += len(vldtr.validSectorData)
+    return validSectors
+
+def test_two_emulated_drives_on_one_event_loop():
+    diskFormat = getDiskFormat("cbm1581")
+    emulators = [ ArduinoFirmwareEmulator( loadRawTracks(debugDump), diskFormat, realtime = False ) for i in range(0, 2) ]
+    controllers = [ AsyncArduinoFloppyController( FdTransport( emulator.start() ), diskFormat ) for emulator in emulators ]
+    async def readDrives():
+        return await asyncio.gather( *[ readTracks(controller, diskFormat, range(0, 3)) for controller in controllers ] )
+    try:
+        assert asyncio.run( readDrives() ) == [ 60, 60 ]
+        assert all( controller.tracksRead == 6 for controller in controllers )
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+def test_pyserial_asyncio_transport():
+    pytest.importorskip("serial_asyncio")
+    diskFormat = getDiskFormat("cbm1581")
+    emulator = ArduinoFirmwareEmulator( loadRawTracks(debugDump), diskFormat, realtime = False )
+    controller = AsyncArduinoFloppyController( PySerialAsyncioTransport( emulator.start() ), diskFormat )
+    try:
+        assert asyncio.run( readTracks(controller, diskFormat, range(0, 1)) ) == 20
+    finally:
+        emulator.stop()
@@ -0,0 +1,40 @@
+# coding: utf8
+
+import pytest
+import random
+from access1581.bitstream import BitBuffer, TrackDecompressor, compressBitstream, padPendingBits
+
+def randomTrack(seed, length):
+    rng = random.Random(seed)
+    return bytes( rng.randrange(256) for i in range(length) )
+
+def test_packed_decompression_matches_bit_string():
+    decompressor = TrackDecompressor()
+    for (seed, length) in ( (0, 0), (1, 1), (2, 7), (3, 10000), (4, 10001) ):
+        compressedBytes = randomTrack(seed, length)
+        expected = BitBuffer.fromBitString( decompressor.decompress(compressedBytes) )
+        assert decompressor.decompressToBitBuffer(compressedBytes) == expected
+
+def test_packed_decompression_in_chunks():
+    decompressor = TrackDecompressor()
+    compressedBytes = randomTrack(5, 3001)
+    packed = b''
+    (value, count) = (0, 0)
+    for start in range(0, len(compressedBytes), 333):
+        (chunk, value, count) = decompressor.packBits(compressedBytes[start : start + 333], value, count)
+        packed += chunk
+    bitstream = BitBuffer( packed + padPendingBits(value, count), 0, (len(packed) << 3) + count )
+    assert bitstream == decompressor.decompressToBitBuffer(compressedBytes)
+
+def test_compression_round_trip():
+    bitString = "01" + "001" * 5 + "0001" * 3 + "01"
+    decompressor = TrackDecompressor()
+    assert decompressor.decompressToBitBuffer( compressBitstream(bitString) ).toBitString() == bitString
+
+def test_numpy_decompression_matches_lookup_table():
+    pytest.importorskip("numpy")
+    decompressor = TrackDecompressor(useNumpy = True)
+    tracks = [ randomTrack(seed, length) for (seed, length) in ( (6, 0), (7, 3), (8, 10000), (9, 0), (10, 9999) ) ]
+    expected = [ decompressor.decompress(t) for t in tracks ]
+    assert decompressor.decompressBatch(tracks) == expected
+    assert [ decompressor.decompressNumpy(t) for t in tracks ] == expected
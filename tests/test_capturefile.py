@@ -0,0 +1,36 @@
+# coding: utf8
+
+import os
+import pytest
+from access1581.capturefile import CaptureFileReader, CaptureFileWriter
+
+def writeCapture(path):
+    with CaptureFileWriter(path, "cbm1581", 3) as capture:
+        capture.addTrack(0, 0, b'\x55' * 100)
+        capture.addTrack(0, 1, b'\xaa' * 50)
+        capture.addTrack(0, 0, b'\x66' * 80, 2)
+
+def test_capture_round_trip(tmp_path):
+    path = str(tmp_path / "disk.cap")
+    writeCapture(path)
+    with CaptureFileReader(path) as capture:
+        assert capture.diskFormatName == "cbm1581"
+        assert capture.retries == 3
+        assert capture.getCompressedTrackData(0, 0) == b'\x66' * 80
+        assert capture.getCompressedTrackReads(0, 0) == [ b'\x55' * 100, b'\x66' * 80 ]
+        assert capture.getCompressedTrackData(0, 1) == b'\xaa' * 50
+    assert capture.map is None and capture.file is None
+
+def test_empty_file_is_no_capture_file(tmp_path):
+    path = str(tmp_path / "empty.cap")
+    open(path, 'wb').close()
+    with pytest.raises(Exception, match="Not a capture file"):
+        CaptureFileReader(path)
+
+def test_truncated_capture_file(tmp_path):
+    path = str(tmp_path / "disk.cap")
+    writeCapture(path)
+    with open(path, 'r+b') as f:
+        f.truncate( os.path.getsize(path) - 10 )
+    with pytest.raises(Exception, match="truncated"):
+        CaptureFileReader(path)
@@ -0,0 +1,37 @@
+# coding: utf8
+
+import os
+import subprocess
+import sys
+import threading
+from access1581.capturefile import loadRawTracks
+from access1581.diskformats import getDiskFormat
+from access1581.emulator import ArduinoFirmwareEmulator
+from tests import debugDump
+
+def test_stop_while_a_reply_is_sent(monkeypatch):
+    failures = []
+    monkeypatch.setattr(threading, "excepthook", failures.append)
+    emulator = ArduinoFirmwareEmulator( loadRawTracks(debugDump), getDiskFormat("cbm1581"), realtime = False )
+    host = os.open( emulator.start(), os.O_RDWR | os.O_NOCTTY )
+    #track reads nobody picks up, the emulator blocks in its write
+    os.write(host, b'+' + b'<\0' * 4)
+    emulator.thread.join(0.5)
+    emulator.stop()
+    os.close(host)
+    assert not emulator.thread.is_alive()
+    assert emulator.master is None
+    assert failures == []
+
+def test_stop_while_the_host_is_connected():
+    emulator = ArduinoFirmwareEmulator( loadRawTracks(debugDump), getDiskFormat("cbm1581"), realtime = False )
+    host = os.open( emulator.start(), os.O_RDWR | os.O_NOCTTY )
+    emulator.stop()
+    os.close(host)
+    assert not emulator.thread.is_alive()
+
+def test_imager_imports_without_termios():
+    #pseudo terminals are Unix only, the emulator is only loaded when used.
+    #pyserial is loaded before, on Windows it doesn't need termios either
+    code = "import sys, serial; sys.modules['termios'] = None; import access1581.cli_launcher, access1581.farm"
+    subprocess.run( [sys.executable, "-c", code], check = True, cwd = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) )
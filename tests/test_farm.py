@@ -0,0 +1,25 @@
+# coding: utf8
+
+import hashlib
+import shutil
+from access1581.diskformats import getDiskFormat
+from access1581.farm import DiskImagingFarm
+from tests import debugImageMD5
+
+def fileMD5(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5( f.read() ).hexdigest()
+
+def test_farm_of_two_captures(debugCapture, tmp_path):
+    devices = []
+    for name in ("left.cap", "right.cap"):
+        devices.append( str(tmp_path / name) )
+        shutil.copyfile(debugCapture, devices[-1])
+    farm = DiskImagingFarm( getDiskFormat("cbm1581"), devices, str(tmp_path / "image_{index:02d}_{device}.{ext}"), workers = 2 )
+    assert farm.run() is True
+    for (index, device) in enumerate(devices):
+        (imagename, duration, trackCount, badSectorCount, error) = farm.results[ (index, device) ]
+        assert error is None
+        assert (trackCount, badSectorCount) == (160, 0)
+        assert fileMD5(imagename) == debugImageMD5
+    assert sorted( path.name for path in tmp_path.glob("*.d81") ) == [ "image_00_left.d81", "image_01_right.d81" ]
@@ -0,0 +1,59 @@
+# coding: utf8
+
+import hashlib
+import random
+import sys
+import pytest
+from access1581.arduinointerface import ArduinoSimulator
+from access1581.capturefile import CaptureFileReader
+from access1581.cli_launcher import launcher
+from access1581.diskformats import getDiskFormat
+from access1581.formatdetection import detectDiskFormat
+from access1581.trackencoder import imageToCapture
+from tests import debugImageMD5
+
+@pytest.fixture(scope="module")
+def dosCapture(tmp_path_factory):
+    '''
+    a capture of a disk written with random data in the ibmdos format
+    '''
+    diskFormat = getDiskFormat("ibmdos")
+    rng = random.Random(1)
+    imageSize = len(diskFormat.trackRange) * len(diskFormat.headRange) * diskFormat.expectedSectorsPerTrack * diskFormat.sectorSize
+    path = str( tmp_path_factory.mktemp("dos") / "dos.cap" )
+    imageToCapture( bytes( rng.randrange(256) for i in range(imageSize) ), path, diskFormat )
+    return path
+
+def simulate(path):
+    return ArduinoSimulator( getDiskFormat("cbm1581"), CaptureFileReader(path) )
+
+@pytest.mark.parametrize("name", ["cbm1581", "ibmdos"])
+def test_detection(debugCapture, dosCapture, name):
+    arduino = simulate( debugCapture if name == "cbm1581" else dosCapture )
+    assert detectDiskFormat(arduino).name == name
+    #a given format that fits is accepted
+    assert detectDiskFormat(arduino, getDiskFormat(name)).name == name
+    arduino.closeSerialConnection()
+
+def test_wrong_format_is_refused(debugCapture, dosCapture):
+    arduino = simulate(dosCapture)
+    with pytest.raises(Exception, match="doesn't match disk format cbm1581.*looks like ibmdos"):
+        detectDiskFormat( arduino, getDiskFormat("cbm1581") )
+    arduino.closeSerialConnection()
+
+def test_track_without_headers(debugCapture):
+    arduino = simulate(debugCapture)
+    blankTrack = arduino.decompressTrackData( b'\x55' * 10000 )
+    arduino.getDecompressedBitstream = lambda trackno, head: blankTrack
+    #a given format can't be checked, but is used
+    assert detectDiskFormat( arduino, getDiskFormat("ibmdos") ).name == "ibmdos"
+    with pytest.raises(Exception, match="could not be detected"):
+        detectDiskFormat(arduino)
+    arduino.closeSerialConnection()
+
+def test_auto_disk_type(debugCapture, tmp_path, monkeypatch):
+    imagename = str(tmp_path / "disk.d81")
+    monkeypatch.setattr( sys, "argv", [ "disk2image.py", "-d", "auto", "-s", debugCapture, "-o", imagename ] )
+    launcher()
+    with open(imagename, 'rb') as f:
+        assert hashlib.md5( f.read() ).hexdigest() == debugImageMD5
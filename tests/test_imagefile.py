@@ -0,0 +1,87 @@
+# coding: utf8
+
+import hashlib
+import os
+import pytest
+from access1581.diskformats import getDiskFormat
+from access1581.imagefile import ImageFileWriter
+from access1581.imager import IBMDoubleDensityFloppyDiskImager
+from tests import debugImageMD5
+
+diskFormat = getDiskFormat("cbm1581")
+trackLength = diskFormat.expectedSectorsPerTrack * diskFormat.sectorSize
+trackOrder = [ (trackno, headno) for trackno in diskFormat.trackRange for headno in diskFormat.headRange ]
+
+@pytest.fixture(scope="module")
+def debugImage(debugCapture, tmp_path_factory):
+    imagename = str( tmp_path_factory.mktemp("image") / "debug.d81" )
+    IBMDoubleDensityFloppyDiskImager( diskFormat, imagename, 5, debugCapture )
+    with open(imagename, 'rb') as f:
+        return f.read()
+
+def getTrack(imageData, track):
+    index = trackOrder.index(track)
+    return imageData[ index * trackLength : (index + 1) * trackLength ]
+
+def writeInterruptedImage(imagename, imageData, tracks):
+    imageFile = ImageFileWriter(imagename, diskFormat)
+    for track in tracks:
+        imageFile.writeTrack( *track, getTrack(imageData, track) )
+    imageFile.close()
+
+def test_journal_of_an_interrupted_run(debugImage, tmp_path):
+    imagename = str(tmp_path / "disk.d81")
+    #tracks arrive in any order, incomplete tracks are not journaled
+    imageFile = ImageFileWriter(imagename, diskFormat)
+    imageFile.writeTrack( 3, 1, getTrack(debugImage, (3, 1)) )
+    imageFile.writeTrack( 0, 0, getTrack(debugImage, (0, 0)) )
+    imageFile.writeTrack( 1, 0, getTrack(debugImage, (1, 0))[:100] )
+    imageFile.close()
+    assert os.path.getsize(imagename) == len(debugImage)
+    with open(imagename + ".journal") as f:
+        assert f.read() == "3 1\n0 0\n"
+
+def test_journal_is_removed_when_complete(debugImage, tmp_path):
+    imagename = str(tmp_path / "disk.d81")
+    imageFile = ImageFileWriter(imagename, diskFormat)
+    for track in reversed(trackOrder):
+        imageFile.writeTrack( *track, getTrack(debugImage, track) )
+    imageFile.close()
+    assert not os.path.exists(imagename + ".journal")
+    assert imageFile.hashes[0].hexdigest() == debugImageMD5
+
+def test_resume(debugImage, tmp_path):
+    imagename = str(tmp_path / "disk.d81")
+    writeInterruptedImage(imagename, debugImage, trackOrder[:60])
+    imageFile = ImageFileWriter(imagename, diskFormat, resume = True)
+    assert imageFile.getMissingTracks() == trackOrder[60:]
+    for track in imageFile.getMissingTracks():
+        imageFile.writeTrack( *track, getTrack(debugImage, track) )
+    imageFile.close()
+    #the tracks of the first run are read back for the hashes
+    assert imageFile.hashes[0].hexdigest() == debugImageMD5
+    assert not os.path.exists(imagename + ".journal")
+
+def test_no_resume_without_matching_image(debugImage, tmp_path):
+    imagename = str(tmp_path / "disk.d81")
+    writeInterruptedImage(imagename, debugImage, trackOrder[:60])
+    with open(imagename, 'r+b') as f:
+        f.truncate(1000)
+    imageFile = ImageFileWriter(imagename, diskFormat, resume = True)
+    assert imageFile.getMissingTracks() == trackOrder
+    imageFile.close()
+    #without resume a new image and journal are started
+    writeInterruptedImage(imagename, debugImage, trackOrder[:60])
+    imageFile = ImageFileWriter(imagename, diskFormat)
+    assert imageFile.getMissingTracks() == trackOrder
+    imageFile.close()
+    assert os.path.getsize(imagename + ".journal") == 0
+
+def test_imager_resumes_the_missing_tracks(debugImage, debugCapture, tmp_path):
+    imagename = str(tmp_path / "disk.d81")
+    writeInterruptedImage(imagename, debugImage, trackOrder[:100])
+    imager = IBMDoubleDensityFloppyDiskImager( diskFormat, imagename, 5, debugCapture, resume = True )
+    assert imager.trackCount == len(trackOrder) - 100
+    assert not os.path.exists(imagename + ".journal")
+    with open(imagename, 'rb') as f:
+        assert hashlib.md5( f.read() ).hexdigest() == debugImageMD5
@@ -0,0 +1,120 @@
+# coding: utf8
+
+import hashlib
+import os
+import threading
+import tracemalloc
+import pytest
+from access1581.capturefile import CaptureFileReader, CaptureFileWriter
+from access1581.diskformats import getDiskFormat
+from access1581.imager import IBMDoubleDensityFloppyDiskImager, SingleTrackSectorListValidator, decodeCompressedTrack
+from access1581.instrumentation import Profiler
+from tests import debugImageMD5
+
+def fileMD5(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5( f.read() ).hexdigest()
+
+def test_image_of_capture(debugCapture, tmp_path):
+    imagename = str(tmp_path / "disk.d81")
+    imager = IBMDoubleDensityFloppyDiskImager( getDiskFormat("cbm1581"), imagename, 5, debugCapture )
+    assert imager.badSectorCount == 0
+    assert fileMD5(imagename) == debugImageMD5
+
+def test_repair_needs_an_existing_image(debugCapture, tmp_path):
+    with pytest.raises(Exception, match="doesn't exist"):
+        IBMDoubleDensityFloppyDiskImager( getDiskFormat("cbm1581"), str(tmp_path / "missing.d81"), 5, debugCapture, repair = True )
+    assert not (tmp_path / "missing.d81").exists()
+
+def test_sector_selection_needs_an_existing_image(debugCapture, tmp_path):
+    selection = { (0, 0): {1, 2} }
+    with pytest.raises(Exception, match="doesn't exist"):
+        IBMDoubleDensityFloppyDiskImager( getDiskFormat("cbm1581"), str(tmp_path / "missing.d81"), 5, debugCapture, selection = selection )
+
+def openFileDescriptors():
+    return set( os.listdir("/proc/self/fd") )
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to count the file descriptors")
+def test_image_of_emulated_capture(debugCapture, tmp_path):
+    imagename = str(tmp_path / "disk.d81")
+    descriptors = openFileDescriptors()
+    imager = IBMDoubleDensityFloppyDiskImager( getDiskFormat("cbm1581"), imagename, 5, "emulated:" + debugCapture, realtime = False )
+    assert imager.badSectorCount == 0
+    assert fileMD5(imagename) == debugImageMD5
+    #the pseudo terminal, the serial port and the capture file are closed again
+    assert imager.emulator is None
+    assert openFileDescriptors() <= descriptors
+    assert not any( thread.name == "firmwareemulator" for thread in threading.enumerate() )
+
+def test_profiler_is_stopped_when_imaging_fails(debugCapture, tmp_path, monkeypatch):
+    def failingStore(*args):
+        raise IOError("disk full")
+    monkeypatch.setattr(IBMDoubleDensityFloppyDiskImager, "storeTrack", failingStore)
+    with pytest.raises(IOError, match="disk full"):
+        IBMDoubleDensityFloppyDiskImager( getDiskFormat("cbm1581"), str(tmp_path / "disk.d81"), 5, debugCapture, profiler = Profiler(traceMemory = True) )
+    assert not tracemalloc.is_tracing()
+
+@pytest.mark.parametrize("mode", [ {}, { "streaming": True }, { "pipelined": True } ])
+def test_blank_tracks_are_no_bad_sectors(debugCapture, tmp_path, mode):
+    diskFormat = getDiskFormat("cbm1581")
+    capturePath = str(tmp_path / "blank.cap")
+    #flux reversals every two bit cells and no sync marks, like an erased track
+    blankTrack = b'\x55' * 10500 + b'\0'
+    with CaptureFileReader(debugCapture) as capture, CaptureFileWriter(capturePath, diskFormat.name, 0) as blankCapture:
+        for (trackno, headno) in sorted(capture.index):
+            blankCapture.addTrack( trackno, headno, blankTrack if trackno >= 70 else capture.getCompressedTrackData(trackno, headno) )
+    imagename = str(tmp_path / "disk.d81")
+    imager = IBMDoubleDensityFloppyDiskImager( diskFormat, imagename, 5, capturePath, **mode )
+    assert imager.badSectorCount == 0
+    assert not os.path.exists(imagename + ".badsectors")
+    trackLength = diskFormat.expectedSectorsPerTrack * diskFormat.sectorSize
+    with open(imagename, 'rb') as f:
+        imageData = f.read()
+    assert imageData[ 70 * 2 * trackLength : ] == bytes( 10 * 2 * trackLength )
+
+def test_damaged_header_does_not_shift_sectors(debugCapture):
+    diskFormat = getDiskFormat("cbm1581")
+    with CaptureFileReader(debugCapture) as capture:
+        compressedTrackData = capture.getCompressedTrackData(0, diskFormat.getPhysicalHead(0))
+    sectors = decodeCompressedTrack(diskFormat, compressedTrackData)
+    original = { sectorprops["sectorno"]: sectorprops["data"] for sectorprops in sectors }
+    #the id field of sector 7 reads as sector 55, its header crc fails
+    damaged = [ dict(sectorprops) for sectorprops in sectors ]
+    for sectorprops in damaged:
+        if sectorprops["sectorno"] == 7:
+            sectorprops["sectorno"] = 55
+            sectorprops["headermeta"] = sectorprops["headermeta"][:6] + b'\x37' + sectorprops["headermeta"][7:]
+    vldtr = SingleTrackSectorListValidator(2, diskFormat, None)
+    vldtr.startTrack()
+    vldtr.addValidSectors(damaged, 0, 0, True)
+    assert vldtr.isTrackComplete() is False
+    assert vldtr.getBadSectors() == {7}
+    assert 55 not in vldtr.getValidSectorData()
+    assert vldtr.assembleTrackData() == b''
+    #a second read brings sector 7, every sector ends up in its own slot
+    vldtr.addValidSectors(sectors, 0, 0, True)
+    assert vldtr.isTrackComplete() is True
+    assert vldtr.assembleTrackData() == b''.join( original[sectorno] for sectorno in range(1, 11) )
+
+def test_repair_reads_only_the_bad_sectors(debugCapture, tmp_path):
+    diskFormat = getDiskFormat("cbm1581")
+    damagedPath = str(tmp_path / "damaged.cap")
+    physicalHead = diskFormat.getPhysicalHead(0)
+    with CaptureFileReader(debugCapture) as capture, CaptureFileWriter(damagedPath, diskFormat.name, 0) as damagedCapture:
+        for (trackno, headno) in sorted(capture.index):
+            compressedTrackData = capture.getCompressedTrackData(trackno, headno)
+            if (trackno, headno) == (5, physicalHead):
+                #garbles the data of a sector in the middle of the track
+                compressedTrackData = compressedTrackData[:5000] + bytes( b ^ 0x0f for b in compressedTrackData[5000:5040] ) + compressedTrackData[5040:]
+            damagedCapture.addTrack(trackno, headno, compressedTrackData)
+    imagename = str(tmp_path / "disk.d81")
+    imager = IBMDoubleDensityFloppyDiskImager( diskFormat, imagename, 2, damagedPath )
+    assert imager.badSectorCount > 0
+    with open(imagename + ".badsectors") as f:
+        assert all( line.split()[:2] == ["5", "0"] for line in f )
+    assert fileMD5(imagename) != debugImageMD5
+    #the good copy of the disk fixes the listed sectors, nothing else is read
+    imager = IBMDoubleDensityFloppyDiskImager( diskFormat, imagename, 2, debugCapture, repair = True )
+    assert (imager.trackCount, imager.badSectorCount) == (1, 0)
+    assert not os.path.exists(imagename + ".badsectors")
+    assert fileMD5(imagename) == debugImageMD5
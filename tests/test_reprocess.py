@@ -0,0 +1,14 @@
+# coding: utf8
+
+import hashlib
+import os
+from access1581.diskformats import getDiskFormat
+from access1581.reprocess import RawTrackDumpReprocessor
+from tests import debugDump, debugImageMD5
+
+def test_reprocess_dumps_into_new_directory(tmp_path):
+    outputDir = str(tmp_path / "images" / "new")
+    reprocessor = RawTrackDumpReprocessor( getDiskFormat("cbm1581"), 1 )
+    reprocessor.reprocessDumps( [ debugDump ], outputDir )
+    with open( os.path.join(outputDir, "raw_debug_image_d81.d81"), 'rb' ) as f:
+        assert hashlib.md5( f.read() ).hexdigest() == debugImageMD5
@@ -0,0 +1,68 @@
+# coding: utf8
+
+from access1581.scheduler import TrackScheduler
+
+jobs = [ (trackno, headno) for trackno in (0, 1, 2, 5, 6) for headno in (0, 1) ]
+
+class FakeValidator:
+    '''
+    a track that is complete after a given number of reads
+    '''
+    def __init__(self, readsNeeded, log):
+        self.readsNeeded = readsNeeded
+        self.log = log
+        self.wantedSectors = None
+        self.reads = 0
+
+    def startTrack(self, wantedSectors = None):
+        self.wantedSectors = wantedSectors
+
+    def readTrack(self, trackno, headno, wantedSectors = None):
+        while self.isTrackComplete() is False:
+            self.readAttempt(trackno, headno, False)
+
+    def readAttempt(self, trackno, headno, lastChance):
+        self.reads += 1
+        self.log.append( (trackno, headno, lastChance) )
+
+    def isTrackComplete(self):
+        return self.reads >= self.readsNeeded
+
+    def getReadAttempts(self):
+        return self.reads
+
+def makeScheduler(readsNeeded, maxRetries, deferRetries):
+    log = []
+    pending = list(readsNeeded)
+    scheduler = TrackScheduler( None, lambda: FakeValidator(pending.pop(0), log), maxRetries, "sequential", deferRetries )
+    return (scheduler, log)
+
+def test_orders():
+    scheduler = TrackScheduler(None, None, 5)
+    assert scheduler.order( list(reversed(jobs)) ) == jobs
+    assert scheduler.order(jobs, "serpentine") == [ (0, 0), (0, 1), (1, 1), (1, 0), (2, 0), (2, 1), (5, 1), (5, 0), (6, 0), (6, 1) ]
+    #the head is closer to the upper end of the jobs, that end comes first
+    assert scheduler.order(jobs, "elevator", 4) == [ (5, 0), (5, 1), (6, 1), (6, 0), (2, 0), (2, 1), (1, 1), (1, 0), (0, 0), (0, 1) ]
+    assert scheduler.order(jobs, "elevator", 3) == [ (2, 0), (2, 1), (1, 1), (1, 0), (0, 0), (0, 1), (5, 1), (5, 0), (6, 0), (6, 1) ]
+
+def test_default_order_is_sequential():
+    assert TrackScheduler(None, None, 5).trackOrder == "sequential"
+
+def test_retries_in_place():
+    (scheduler, log) = makeScheduler( [1, 3, 1], 5, False )
+    finished = [ (trackno, headno) for (trackno, headno, vldtr) in scheduler.run( [ (0, 0), (0, 1), (1, 0) ] ) ]
+    assert finished == [ (0, 0), (0, 1), (1, 0) ]
+    assert [ (trackno, headno) for (trackno, headno, lastChance) in log ] == [ (0, 0), (0, 1), (0, 1), (0, 1), (1, 0) ]
+
+def test_deferred_retry_sweeps():
+    #(0, 1) needs three reads, (1, 0) never becomes complete
+    (scheduler, log) = makeScheduler( [1, 3, 99], 3, True )
+    finished = [ (trackno, headno) for (trackno, headno, vldtr) in scheduler.run( [ (0, 0), (0, 1), (1, 0) ] ) ]
+    assert finished == [ (0, 0), (0, 1), (1, 0) ]
+    #every sweep reads the pending tracks once, starting where the head is
+    assert log == [
+        (0, 0, False), (0, 1, False), (1, 0, False),
+        (0, 1, False), (1, 0, False),
+        (0, 1, True), (1, 0, True)
+    ]
+    assert scheduler.timings[ (1, 0) ][0] == 3
@@ -0,0 +1,25 @@
+# coding: utf8
+
+import hashlib
+from access1581.capturefile import CaptureFileReader
+from access1581.diskformats import getDiskFormat
+from access1581.imager import IBMDoubleDensityFloppyDiskImager
+from access1581.trackencoder import MFMTrackEncoder, imageToCapture
+from tests import debugImageMD5
+
+def test_encoded_capture_reads_back(debugCapture, tmp_path, capsys):
+    diskFormat = getDiskFormat("cbm1581")
+    IBMDoubleDensityFloppyDiskImager( diskFormat, str(tmp_path / "original.d81"), 5, debugCapture )
+    with open(str(tmp_path / "original.d81"), 'rb') as f:
+        imageData = f.read()
+    mfmTracks = MFMTrackEncoder(diskFormat).encodeImage(imageData)
+    imageToCapture( imageData, str(tmp_path / "encoded.cap"), diskFormat, mfmTracks )
+    with CaptureFileReader( str(tmp_path / "encoded.cap") ) as capture:
+        #the reads span the index like the ones of the firmware
+        assert min( len( capture.getCompressedTrackData(trackno, headno) ) for (trackno, headno) in capture.index ) >= 10223
+    capsys.readouterr()
+    imager = IBMDoubleDensityFloppyDiskImager( diskFormat, str(tmp_path / "copy.d81"), 5, str(tmp_path / "encoded.cap") )
+    assert imager.badSectorCount == 0
+    assert "suspicously short" not in capsys.readouterr().out
+    with open(str(tmp_path / "copy.d81"), 'rb') as f:
+        assert hashlib.md5( f.read() ).hexdigest() == debugImageMD5